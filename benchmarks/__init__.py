@@ -0,0 +1,5 @@
+"""Throughput benchmarks for the sshed packet, diff and patch hot paths.
+
+Run with "python -m benchmarks.bench --help" from the top level source
+directory. These are not installed with sshed.
+"""
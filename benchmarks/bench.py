@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""Benchmark runner for the sshed packet, diff and patch hot paths.
+
+Each benchmark case runs in a freshly spawned process so that the peak RSS
+reported for it isn't polluted by earlier cases. For cases that use worker
+processes, the peak RSS is that of the largest single process. Results are
+written as JSON and can be compared against a stored baseline to catch
+regressions:
+
+    python -m benchmarks.bench --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench --baseline benchmarks/baseline.json
+"""
+
+import argparse
+import difflib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+from sshed import (
+    diffstate, largefile, linehash, packethandler, paralleldiff, sshed,
+    sshed_client, trace)
+
+from . import workloads
+
+DEFAULT_MAX_SIZE = '16M'
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.2
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, int(round(percent / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def drain(sock):
+    """Read from a socket until the other end closes it."""
+    while sock.recv(packethandler.BUFFER_SIZE):
+        pass
+
+
+def make_handler(sock):
+    """Return a SocketRequestHandler that sends on sock.
+
+    The handler isn't attached to a server, so it doesn't handle a request.
+    """
+    handler = sshed_client.SocketRequestHandler.__new__(
+        sshed_client.SocketRequestHandler)
+    packethandler.PacketHandler.__init__(handler, sock)
+    handler.tracer = trace.Tracer()
+    return handler
+
+
+def time_with_drain(function):
+    """Time function(sock) while another thread drains the socket pair."""
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=drain, args=(receiver,))
+    thread.start()
+    start = time.perf_counter()
+    function(sender)
+    elapsed = time.perf_counter() - start
+    sender.close()
+    thread.join()
+    receiver.close()
+    return elapsed
+
+
+def bench_packet(original, edited, repeat):
+    """Send the edited file through PacketHandler over a socket pair."""
+    del original
+    times = []
+    for _ in range(repeat):
+        sender, receiver = socket.socketpair()
+        result = {}
+
+        def receive(sock=receiver):
+            """Receive one packet into a spooled file."""
+            with tempfile.SpooledTemporaryFile(
+                    max_size=sshed_client.FOUR_MEGS) as data_file:
+                result['headers'] = packethandler.PacketHandler(sock).get(
+                    data_file=data_file)
+
+        thread = threading.Thread(target=receive)
+        thread.start()
+        start = time.perf_counter()
+        with open(edited, 'rb') as file:
+            packethandler.PacketHandler(sender).send(
+                {'Differential': False}, file)
+        thread.join()
+        times.append(time.perf_counter() - start)
+        sender.close()
+        receiver.close()
+    return times
+
+
+def bench_send_diff(original, edited, repeat):
+    """Generate and send a diff with SocketRequestHandler.send_diff.
+
+    As for a save within a session, the original is already indexed.
+    """
+    with open(original, 'rb') as file:
+        diff_state = diffstate.DiffState(linehash.Lines(file.read()))
+    with open(edited, 'rb') as file:
+        edited_lines = linehash.Lines(file.read())
+    return [
+        time_with_drain(
+            lambda sock: make_handler(sock).send_diff(
+                diff_state, edited_lines))
+        for _ in range(repeat)]
+
+
+def _diff_bytes(original, edited):
+    """Return the unified diff between two files as bytes."""
+    with open(original, 'rb') as file:
+        original_strings = [line.decode() for line in file]
+    with open(edited, 'rb') as file:
+        edited_strings = [line.decode() for line in file]
+    return ''.join(difflib.unified_diff(
+        original_strings, edited_strings)).encode('utf-8')
+
+
+def bench_index_lines(original, edited, repeat, vectorised=None):
+    """Split the edited file into lines and key them with linehash.Lines.
+
+    Lines are hashed with NumPy if it's installed.
+    """
+    del original
+    with open(edited, 'rb') as file:
+        data = file.read()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        linehash.Lines(data, vectorised=vectorised)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_index_lines_python(original, edited, repeat):
+    """As bench_index_lines, but without NumPy."""
+    return bench_index_lines(original, edited, repeat, vectorised=False)
+
+
+def bench_patch(original, edited, repeat):
+    """Apply the diff with Patcher.patch to a temporary file."""
+    diff = _diff_bytes(original, edited).splitlines(keepends=True)
+    times = []
+    for _ in range(repeat):
+        with open(original, 'rb') as file, \
+                tempfile.TemporaryFile() as output:
+            start = time.perf_counter()
+            sshed.Patcher(file, list(diff)).patch(output=output)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_mapped_patch(original, edited, repeat):
+    """Apply the diff with MappedPatcher.patch to a temporary file."""
+    diff = _diff_bytes(original, edited).splitlines(keepends=True)
+    times = []
+    for _ in range(repeat):
+        with open(original, 'rb') as file, \
+                tempfile.TemporaryFile() as output:
+            start = time.perf_counter()
+            sshed.MappedPatcher(file, list(diff)).patch(output=output)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_write_differential(original, edited, repeat):
+    """Apply the diff in place with write_differential."""
+    diff = _diff_bytes(original, edited)
+    times = []
+    for _ in range(repeat):
+        with tempfile.NamedTemporaryFile() as target:
+            with open(original, 'rb') as file:
+                shutil.copyfileobj(file, target)
+            target.flush()
+            with open(target.name, 'r+b') as file:
+                start = time.perf_counter()
+                sshed.write_differential(diff, file)
+                times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_large_diff(original, edited, repeat):
+    """Write a diff in one process, as large file mode does by default."""
+    times = []
+    for _ in range(repeat):
+        with open(original, 'rb') as original_file, \
+                open(edited, 'rb') as edited_file, \
+                tempfile.TemporaryFile() as output:
+            start = time.perf_counter()
+            original_run = largefile.LineHashRun(original_file)
+            edited_run = largefile.LineHashRun(edited_file)
+            largefile.write_unified_diff(
+                largefile.group_opcodes(
+                    largefile.diff_opcodes(original_run, edited_run)),
+                original_run, edited_run, output)
+            times.append(time.perf_counter() - start)
+            original_run.close()
+            edited_run.close()
+    return times
+
+
+def bench_parallel_diff(original, edited, repeat):
+    """Write a diff across every CPU with paralleldiff."""
+    times = []
+    pool = paralleldiff.WorkerPool()
+    for _ in range(repeat):
+        with open(original, 'rb') as original_file, \
+                open(edited, 'rb') as edited_file, \
+                tempfile.TemporaryFile() as output:
+            start = time.perf_counter()
+            opcodes, original_lines, edited_lines = paralleldiff.diff_files(
+                pool, original_file, edited_file)
+            largefile.write_unified_diff(
+                largefile.group_opcodes(opcodes),
+                original_lines, edited_lines, output)
+            times.append(time.perf_counter() - start)
+            original_lines.close()
+            edited_lines.close()
+    pool.close()
+    return times
+
+
+OPERATIONS = {
+    'packet': bench_packet,
+    'send_diff': bench_send_diff,
+    'index_lines': bench_index_lines,
+    'index_lines_python': bench_index_lines_python,
+    'patch': bench_patch,
+    'mapped_patch': bench_mapped_patch,
+    'write_differential': bench_write_differential,
+    'large_diff': bench_large_diff,
+    'parallel_diff': bench_parallel_diff,
+}
+
+
+def run_case(operation, original, edited, repeat):
+    """Run a single benchmark case. Called in a child process."""
+    times = OPERATIONS[operation](original, edited, repeat)
+    return {
+        'times': times,
+        'peak_rss_kb': max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+    }
+
+
+def summarise(name, size, times, peak_rss_kb):
+    """Turn the raw timings of a case into a result dictionary."""
+    return {
+        'case': name,
+        'bytes': size,
+        'repeat': len(times),
+        'mb_per_s': size / 2 ** 20 / percentile(times, 50),
+        'latency_ms': dict(
+            ('p%d' % percent, percentile(times, percent) * 1000)
+            for percent in PERCENTILES),
+        'peak_rss_kb': peak_rss_kb,
+    }
+
+
+def run(args):
+    """Run every selected case and return the results document."""
+    context = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench-') as directory:
+        for size_name in args.sizes:
+            size = workloads.parse_size(size_name)
+            original = os.path.join(directory, 'original-%s' % size_name)
+            line_count = workloads.generate_original(
+                original, size, seed=args.seed)
+            for pattern in args.patterns:
+                edited = os.path.join(
+                    directory, 'edited-%s-%s' % (size_name, pattern))
+                workloads.generate_edited(
+                    edited, line_count, pattern, seed=args.seed)
+                edited_size = os.path.getsize(edited)
+                for operation in args.operations:
+                    name = '%s/%s/%s' % (operation, size_name, pattern)
+                    print('Running %s' % name, file=sys.stderr)
+                    with futures.ProcessPoolExecutor(
+                            max_workers=1, mp_context=context) as executor:
+                        raw = executor.submit(
+                            run_case, operation, original, edited,
+                            args.repeat).result()
+                    results.append(summarise(
+                        name, edited_size, raw['times'], raw['peak_rss_kb']))
+                os.remove(edited)
+            os.remove(original)
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+        },
+        'results': results,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compare results against a baseline.
+
+    Returns:
+        A list of strings, each describing one regression.
+    """
+    previous = dict((case['case'], case) for case in baseline['results'])
+    regressions = []
+    for case in results['results']:
+        old = previous.get(case['case'])
+        if old is None:
+            continue
+        if case['mb_per_s'] < old['mb_per_s'] * (1 - tolerance):
+            regressions.append('%s: throughput %.2f MB/s (baseline %.2f)' % (
+                case['case'], case['mb_per_s'], old['mb_per_s']))
+        if case['latency_ms']['p50'] > old['latency_ms']['p50'] * (
+                1 + tolerance):
+            regressions.append('%s: p50 latency %.2f ms (baseline %.2f)' % (
+                case['case'], case['latency_ms']['p50'],
+                old['latency_ms']['p50']))
+        if case['peak_rss_kb'] > old['peak_rss_kb'] * (1 + tolerance):
+            regressions.append('%s: peak RSS %d KiB (baseline %d)' % (
+                case['case'], case['peak_rss_kb'], old['peak_rss_kb']))
+    return regressions
+
+
+def parse_arguments(args=None):
+    """Parse the benchmark arguments and return a namespace."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '--sizes', nargs='+', default=workloads.SIZES,
+        help='File sizes to benchmark, e.g. 1K 64K 1M 1G.')
+    parser.add_argument(
+        '--max-size', default=DEFAULT_MAX_SIZE,
+        help=(
+            'Skip sizes larger than this. Pass "--max-size 1G" to run the '
+            'full ladder. Default: %s' % DEFAULT_MAX_SIZE))
+    parser.add_argument(
+        '--patterns', nargs='+', default=workloads.PATTERNS,
+        choices=workloads.PATTERNS, help='Edit patterns to benchmark.')
+    parser.add_argument(
+        '--operations', nargs='+', default=sorted(OPERATIONS),
+        choices=sorted(OPERATIONS), help='Hot paths to benchmark.')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+        help='Repetitions per case. Default: %d' % DEFAULT_REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '-o', '--output', help='Write the JSON results here, not to stdout.')
+    parser.add_argument(
+        '--baseline',
+        help='Compare against this results file. Exits 1 on regression.')
+    parser.add_argument(
+        '--save-baseline', help='Also write the results to this file.')
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help=(
+            'Fractional slowdown allowed before a case counts as a '
+            'regression. Default: %s' % DEFAULT_TOLERANCE))
+    args = parser.parse_args(args=args)
+    max_size = workloads.parse_size(args.max_size)
+    args.sizes = [
+        size for size in args.sizes if workloads.parse_size(size) <= max_size]
+    return args
+
+
+def main(args=None):
+    """Entry point for the benchmark runner."""
+    args = parse_arguments(args)
+    results = run(args)
+    document = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(document + '\n')
+    else:
+        print(document)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as file:
+            file.write(document + '\n')
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
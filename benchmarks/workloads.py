@@ -0,0 +1,117 @@
+"""Generated files and edit patterns for the sshed benchmarks.
+
+All generation is streamed to disk and deterministic for a given seed, so
+files up to a gigabyte can be generated without holding them in memory and
+results are comparable between runs.
+"""
+
+import random
+import string
+
+SIZE_SUFFIXES = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+SIZES = ['1K', '64K', '1M', '16M', '256M', '1G']
+"""The default ladder of file sizes to benchmark."""
+
+PATTERNS = ['append', 'scattered', 'insert-block', 'delete-block']
+"""Edit patterns. Each imitates a common kind of save in a text editor."""
+
+LINE_POOL_SIZE = 4096
+BLOCK_LINES = 100
+SCATTER_INTERVAL = 1000
+SCATTER_OFFSET = SCATTER_INTERVAL // 2
+WRITE_BATCH = 1024
+
+
+def parse_size(size):
+    """Convert a size such as '64K' or '1G' into a number of bytes."""
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def _line_pool(seed):
+    """Return a pool of random text lines resembling configs and logs."""
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + '    _-=:./'
+    return [
+        ''.join(rng.choice(alphabet) for _ in range(rng.randint(8, 120)))
+        for _ in range(LINE_POOL_SIZE)]
+
+
+def _line(pool, number, tag=''):
+    """Return line number from the pool as bytes, optionally tagged."""
+    return ('%010d %s%s\n' % (number, tag, pool[number % len(pool)])).encode()
+
+
+def generate_original(path, size, seed=0):
+    """Write a text file of approximately size bytes to path.
+
+    Every line is unique (it starts with its line number), as is typical of
+    logs and most source files.
+
+    Returns:
+        The number of lines written.
+    """
+    pool = _line_pool(seed)
+    written = 0
+    number = 0
+    with open(path, 'wb') as file:
+        while written < size:
+            batch = []
+            for _ in range(WRITE_BATCH):
+                line = _line(pool, number)
+                if written + len(line) > size and number > 0:
+                    break
+                batch.append(line)
+                written += len(line)
+                number += 1
+            if not batch:
+                break
+            file.writelines(batch)
+            if len(batch) < WRITE_BATCH:
+                break
+    return number
+
+
+def _edit(pool, number, line_count, pattern):
+    """Return the list of lines that replace original line number."""
+    line = _line(pool, number)
+    middle = line_count // 2
+    if pattern == 'scattered' and (
+            number % SCATTER_INTERVAL == SCATTER_OFFSET % line_count):
+        return [_line(pool, number, tag='edited ')]
+    if pattern == 'insert-block' and number == middle:
+        return [line] + [
+            _line(pool, line_count + offset, tag='inserted ')
+            for offset in range(BLOCK_LINES)]
+    if pattern == 'delete-block' and (
+            middle <= number < middle + BLOCK_LINES):
+        return []
+    return [line]
+
+
+def generate_edited(path, line_count, pattern, seed=0):
+    """Write an edited version of the generate_original output to path.
+
+    Positional arguments:
+        path: Where to write the edited file.
+        line_count: The number of lines in the original file.
+        pattern: One of PATTERNS.
+    Keyword arguments:
+        seed: The seed that was used to generate the original file.
+    """
+    if pattern not in PATTERNS:
+        raise ValueError('Unknown edit pattern: %s' % pattern)
+    pool = _line_pool(seed)
+    with open(path, 'wb') as file:
+        for start in range(0, line_count, WRITE_BATCH):
+            batch = []
+            for number in range(start, min(start + WRITE_BATCH, line_count)):
+                batch.extend(_edit(pool, number, line_count, pattern))
+            file.writelines(batch)
+        if pattern == 'append':
+            appended = max(1, line_count // 100)
+            file.writelines(
+                _line(pool, line_count + offset, tag='appended ')
+                for offset in range(appended))
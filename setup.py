@@ -11,10 +11,13 @@ setup(
     license='BSD 2-Clause',
     url='https://github.com/lengau/sshed',
     keywords=['ssh', 'editor', 'text'],
+    extras_require={'fast': ['numpy']},
     entry_points={
         'console_scripts': [
             'sshed_client = sshed.sshed_client:main',
             'sshed = sshed.sshed:main',
+            'sshed-loadtest = sshed.loadtest:main',
+            'sshed-replay = sshed.replay:main',
             'edssh = sshed.edssh:main'], },
     classifiers=[
         'Development Status :: 3 - Alpha',
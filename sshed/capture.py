@@ -0,0 +1,151 @@
+# Session capture for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Recording the packets of an sshed session, for replay with sshed-replay.
+
+A capture file starts with a line of JSON describing the capture. Each packet
+follows as a line of JSON holding the time (in seconds since the capture
+started), the direction ('sent' or 'received'), the headers and the size of
+the packet's data. If the capture includes payloads, the line is followed by
+the packet's data, exactly as many bytes as the size says.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+FORMAT = 'sshed-capture'
+VERSION = 1
+COPY_SIZE = 2 ** 20
+"""The number of bytes of a payload file to copy into a capture at once."""
+
+Packet = collections.namedtuple(
+    'Packet', ['time', 'direction', 'headers', 'size', 'payload'])
+"""One recorded packet. payload is None if the capture has no payloads."""
+
+
+class Recorder(object):
+    """Writes the packets a packethandler.PacketHandler sends and receives."""
+
+    def __init__(self, path, side, payloads=False):
+        """Initialise a Recorder, creating its capture file.
+
+        Positional arguments:
+            path: The capture file to write. It's replaced if it exists.
+            side: Which end of the session is recording, 'host' or 'client'.
+        Keyword arguments:
+            payloads: Whether to record the data of each packet, and not just
+                its size.
+        """
+        self.path = path
+        self.payloads = payloads
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        # With payloads, the capture holds the file, so only the user may
+        # read it.
+        self._file = os.fdopen(os.open(
+            path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb')
+        self._write_line(dict(
+            format=FORMAT, version=VERSION, side=side, start=time.time(),
+            payloads=payloads))
+
+    def now(self):
+        """Return the number of seconds since the capture started."""
+        return time.perf_counter() - self._start
+
+    def _write_line(self, record):
+        self._file.write(json.dumps(record, sort_keys=True).encode('utf-8'))
+        self._file.write(b'\n')
+
+    def record(self, direction, headers, payload=None, when=None):
+        """Record a packet.
+
+        Positional arguments:
+            direction: 'sent' or 'received'.
+            headers: The packet's headers, including its Size.
+        Keyword arguments:
+            payload: The packet's data, as bytes or as a file positioned at
+                the start of it. A file is left where it was.
+            when: The time (from now) at which the packet was sent or
+                received, if not now.
+        """
+        size = headers.get('Size', 0)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._write_line(dict(
+                time=self.now() if when is None else when,
+                direction=direction, headers=headers, size=size))
+            if self.payloads:
+                self._write_payload(payload, size)
+            self._file.flush()
+
+    def _write_payload(self, payload, size):
+        """Write size bytes of a payload, padding it if it's short."""
+        if payload is None:
+            payload = b''
+        if isinstance(payload, (bytes, bytearray)):
+            self._file.write(payload[:size])
+            written = min(size, len(payload))
+        else:
+            location = payload.tell()
+            written = 0
+            while written < size:
+                data = payload.read(min(COPY_SIZE, size - written))
+                if not data:
+                    break
+                self._file.write(data)
+                written += len(data)
+            payload.seek(location)
+        # The size is trusted when reading, so a short payload (which only
+        # a caller's mistake could give) mustn't misalign what follows.
+        self._file.write(bytes(size - written))
+
+    def close(self):
+        """Close the capture file."""
+        with self._lock:
+            self._file.close()
+
+
+def capture_path(directory, session):
+    """Return the path of a session's capture file in a directory."""
+    return os.path.join(directory, '%s.capture' % session)
+
+
+def read_capture(path):
+    """Read a capture file.
+
+    Returns:
+        A tuple of the dictionary describing the capture and a list of
+        Packets.
+
+    Raises:
+        ValueError: If the file isn't a capture, or it's truncated.
+    """
+    packets = []
+    with open(path, 'rb') as file:
+        try:
+            info = json.loads(file.readline().decode('utf-8'))
+        except ValueError:
+            info = None
+        if not isinstance(info, dict) or info.get('format') != FORMAT:
+            raise ValueError('%s is not an sshed capture.' % path)
+        if info.get('version') != VERSION:
+            raise ValueError(
+                'Unknown capture version: %s' % info.get('version'))
+        line = file.readline()
+        while line:
+            record = json.loads(line.decode('utf-8'))
+            payload = None
+            if info['payloads']:
+                payload = file.read(record['size'])
+                if len(payload) != record['size']:
+                    raise ValueError(
+                        'The capture ends in the middle of a packet.')
+            packets.append(Packet(
+                record['time'], record['direction'], record['headers'],
+                record['size'], payload))
+            line = file.readline()
+    return info, packets
@@ -0,0 +1,255 @@
+# Incremental diffing for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Diffing successive saves of a file against a baseline kept between them.
+
+The baseline is kept along with an index of the lines that appear in it
+exactly once. Diffing a save then only needs the save's own lines counted:
+lines that appear once in each version anchor the diff (as in patience
+diff), and difflib.SequenceMatcher only compares the short gaps between
+anchors. Once a save is sent it becomes the baseline, reusing the counts
+made while diffing it.
+
+Lines are compared by their keys in linehash.Lines. Where those are hashes,
+lines found equal are checked byte for byte before a diff is written.
+"""
+
+import bisect
+import collections
+from difflib import SequenceMatcher
+
+from . import largefile, linehash
+
+
+def _longest_increasing(pairs):
+    """Return the longest run of pairs whose first items increase.
+
+    Positional arguments:
+        pairs: A list of pairs, in order of their second items.
+    """
+    firsts = [first for first, _ in pairs]
+    if firsts == sorted(firsts):
+        return pairs
+    # The index of the pair ending the best run of each length so far.
+    tails = []
+    tail_values = []
+    previous = [None] * len(pairs)
+    for index, (value, _) in enumerate(pairs):
+        length = bisect.bisect_left(tail_values, value)
+        if length:
+            previous[index] = tails[length - 1]
+        if length == len(tails):
+            tails.append(index)
+            tail_values.append(value)
+        else:
+            tails[length] = index
+            tail_values[length] = value
+    run = []
+    index = tails[-1] if tails else None
+    while index is not None:
+        run.append(pairs[index])
+        index = previous[index]
+    run.reverse()
+    return run
+
+
+def _runs(anchors):
+    """Return runs of consecutive anchors, as (i, j, length) tuples."""
+    runs = []
+    for i, j in anchors:
+        if runs:
+            run_i, run_j, length = runs[-1]
+            if i == run_i + length and j == run_j + length:
+                runs[-1] = (run_i, run_j, length + 1)
+                continue
+        runs.append((i, j, 1))
+    return runs
+
+
+def _vectorised_runs(unique, counted):
+    """Return the runs of anchors between two versions' hashed lines.
+
+    The common case, where no unique line has moved past another, is found
+    with array operations alone.
+
+    Positional arguments:
+        unique: The DiffState.unique of the baseline.
+        counted: The result of numpy.unique for the new version's keys, with
+            indices and counts.
+    """
+    numpy = linehash.numpy
+    unique_keys, unique_indices = unique
+    values, first, counts = counted
+    once = counts == 1
+    keys, j = values[once], first[once]
+    if not len(keys) or not len(unique_keys):
+        return []
+    positions = numpy.searchsorted(unique_keys, keys)
+    positions[positions == len(unique_keys)] = 0
+    found = unique_keys[positions] == keys
+    i, j = unique_indices[positions[found]], j[found]
+    if not len(i):
+        return []
+    order = numpy.argsort(j)
+    i, j = i[order], j[order]
+    if numpy.any(numpy.diff(i) < 0):
+        return _runs(_longest_increasing(list(zip(i.tolist(), j.tolist()))))
+    breaks = numpy.flatnonzero(
+        (numpy.diff(i) != 1) | (numpy.diff(j) != 1)) + 1
+    starts = numpy.concatenate(([0], breaks))
+    lengths = numpy.diff(numpy.append(starts, len(i)))
+    return list(zip(i[starts].tolist(), j[starts].tolist(), lengths.tolist()))
+
+
+def _gap_opcodes(original, edited, i1, i2, j1, j2):
+    """Return the opcodes for a gap between matching lines."""
+    if i1 == i2 and j1 == j2:
+        return []
+    if i1 == i2:
+        return [('insert', i1, i2, j1, j2)]
+    if j1 == j2:
+        return [('delete', i1, i2, j1, j2)]
+    matcher = SequenceMatcher(
+        None, original.key_list(i1, i2), edited.key_list(j1, j2))
+    return [
+        (tag, i1 + a1, i1 + a2, j1 + b1, j1 + b2)
+        for tag, a1, a2, b1, b2 in matcher.get_opcodes()]
+
+
+class DiffState(object):
+    """The baseline against which the next save of a file is diffed."""
+
+    def __init__(self, lines):
+        """Initialise a DiffState.
+
+        Positional arguments:
+            lines: The baseline, as a linehash.Lines.
+        """
+        self.lines = None
+        """The baseline, as a linehash.Lines."""
+        self.unique = {}
+        """The lines that appear once in the baseline: a dictionary of their
+        indices by key or, if hashed, a tuple of an array of their sorted
+        keys and an array of their indices."""
+        self._counted = (None, None)
+        self.update(lines)
+
+    def _count(self, lines):
+        """Return how often each key appears, reusing the last count.
+
+        Hashed keys are counted with numpy.unique, along with the first
+        index of each.
+        """
+        if self._counted[0] is not lines:
+            if lines.hashed:
+                counts = linehash.numpy.unique(
+                    lines.keys, return_index=True, return_counts=True)
+            else:
+                counts = collections.Counter(lines.keys)
+            self._counted = (lines, counts)
+        return self._counted[1]
+
+    def update(self, lines):
+        """Make a linehash.Lines the new baseline, indexing it."""
+        counts = self._count(lines)
+        self.lines = lines
+        if lines.hashed:
+            values, first, counts = counts
+            self.unique = (values[counts == 1], first[counts == 1])
+        else:
+            self.unique = {
+                key: index for index, key in enumerate(lines.keys)
+                if counts[key] == 1}
+        self._counted = (None, None)
+
+    def _runs(self, lines):
+        """Return runs of lines that appear once in each version, in order.
+
+        Returns:
+            A list of (i, j, length) tuples, meaning that length lines from
+            line i of the baseline match those from line j of lines.
+        """
+        counts = self._count(lines)
+        if lines.hashed != self.lines.hashed:
+            return []
+        if lines.hashed:
+            return _vectorised_runs(self.unique, counts)
+        unique = self.unique
+        return _runs(_longest_increasing([
+            (unique[key], index) for index, key in enumerate(lines.keys)
+            if counts[key] == 1 and key in unique]))
+
+    def opcodes(self, lines):
+        """Return the opcodes that turn the baseline into a linehash.Lines.
+
+        Lines are matched by their keys alone.
+        """
+        original, edited = self.lines.keys, lines.keys
+        opcodes = []
+        i = j = 0
+        for run_i, run_j, length in self._runs(lines) + [
+                (len(original), len(edited), 0)]:
+            # Skip whatever extending an earlier run already matched.
+            skip = max(i - run_i, j - run_j, 0)
+            if skip and skip >= length:
+                continue
+            run_i, run_j, length = run_i + skip, run_j + skip, length - skip
+            start_i, start_j = run_i, run_j
+            while (
+                    start_i > i and start_j > j and
+                    original[start_i - 1] == edited[start_j - 1]):
+                start_i -= 1
+                start_j -= 1
+            opcodes.extend(
+                _gap_opcodes(self.lines, lines, i, start_i, j, start_j))
+            end_i, end_j = run_i + length, run_j + length
+            while (
+                    end_i < len(original) and end_j < len(edited) and
+                    original[end_i] == edited[end_j]):
+                end_i += 1
+                end_j += 1
+            if end_i > start_i:
+                opcodes.append(('equal', start_i, end_i, start_j, end_j))
+            i, j = end_i, end_j
+        return largefile.merge_equal(opcodes)
+
+    def _verified(self, opcodes, lines):
+        """Return whether lines matched on their hashes are really equal."""
+        if not (self.lines.hashed or lines.hashed):
+            return True
+        original = self.lines
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal' and (
+                    original.data[original.offset(i1):original.offset(i2)] !=
+                    lines.data[lines.offset(j1):lines.offset(j2)]):
+                return False
+        return True
+
+    def write_diff(self, lines, output):
+        """Write a unified diff from the baseline to a list of lines.
+
+        The baseline isn't changed; call update once the diff is sent.
+
+        Positional arguments:
+            lines: The new version, as a linehash.Lines.
+            output: A binary file-like object to which to write the diff.
+
+        Returns:
+            The number of bytes written, or None if nothing was written
+            because the diff would have to change a last line without a
+            newline, which unified diffs here can't express, or because two
+            different lines had the same hash.
+        """
+        opcodes = self.opcodes(lines)
+        if not self._verified(opcodes, lines):
+            return None
+        groups = list(largefile.group_opcodes(opcodes))
+        if groups:
+            _, _, original_end, _, end = groups[-1][-1]
+            if (
+                    original_end == len(self.lines) and
+                    not self.lines.terminated or
+                    end == len(lines) and not lines.terminated):
+                return None
+        return largefile.write_unified_diff(
+            groups, self.lines, lines, output)
@@ -7,13 +7,25 @@ modifications in order to pass an sshed tunnel through.
 # TODO: Check the resulting tunnelled socket.
 
 from distutils.spawn import find_executable
+import json
 import logging
 import os
+import socket
 import subprocess
 import sys
+import tempfile
 
 from . import sshed
 
+CONTROL_PERSIST = '10m'
+"""How long a master connection stays open after its last session ends."""
+VERSION_CACHE = 'ssh-versions.json'
+"""The file caching the versions of SSH clients, in the cache directory."""
+CLIENT_LINK = 'sshed-socket'
+"""A link to the socket of the sshed_client edssh started."""
+CLIENT_LOG = 'sshed_client.log'
+"""The file to which an sshed_client started by edssh logs."""
+
 
 class SshClient(object):
     """An SSH client."""
@@ -58,6 +70,14 @@ class SshClient(object):
             ('/usr/bin/ssh', 'OpenSSH', '6.7p1')
             ('/usr/bin/dbclient', 'Dropbear', 'v2014.65')
         """
+        cache_path = os.path.join(cache_directory(), VERSION_CACHE)
+        versions = _load_versions(cache_path)
+        modified = os.stat(self.executable).st_mtime_ns
+        cached = versions.get(self.executable)
+        if cached is not None and cached.get('mtime') == modified:
+            self.__project = cached['project']
+            self.__version = cached['version']
+            return (self.executable, self.__project, self.__version)
         version_data = subprocess.getoutput(' '.join([self.executable, '-V']))
         if version_data.startswith('OpenSSH'):
             self.__project = 'OpenSSH'
@@ -65,6 +85,12 @@ class SshClient(object):
         elif version_data.startswith('Dropbear'):
             self.__project = 'Dropbear'
             self.__version = version_data.split()[1]
+        versions[self.executable] = {
+            'mtime': modified,
+            'project': self.__project,
+            'version': self.__version,
+        }
+        _save_versions(cache_path, versions)
         return (self.executable, self.__project, self.__version)
 
     def is_valid(self):
@@ -76,28 +102,170 @@ class SshClient(object):
                 return True
         return False
 
+    @property
+    def multiplexes(self):
+        """Whether the client can share one connection between sessions."""
+        return self.project == 'OpenSSH'
+
+    def control_options(self):
+        """Return the options that share a master connection per host.
+
+        The first session to a host starts a master connection, which stays
+        open in the background for CONTROL_PERSIST after the last session
+        ends. Later sessions run over it without a new handshake.
+        """
+        return [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % os.path.join(
+                control_directory(), 'edssh-%C'),
+            '-o', 'ControlPersist=%s' % CONTROL_PERSIST,
+        ]
+
+    def forward_options(self):
+        """Return the options that forward the sshed socket to the host.
+
+        The socket on the host is made by sshd, so only the host's
+        sshd_config can let it replace a socket left behind by a connection
+        that died, with "StreamLocalBindUnlink yes".
+        """
+        return ['-R', ':'.join((self.socket, self.socket))]
+
     def run(self, arguments):
-        """Run the SSH client in its own thread."""
+        """Run the SSH client in its own thread.
+
+        When a master connection is reused, the master treats the socket
+        forward as one it already has, so no extra round trip is needed.
+        """
+        options = self.forward_options()
+        if self.multiplexes:
+            options = self.control_options() + options
         os.execv(
             # '/bin/echo',
             self.executable,
             [
                 os.path.basename(self.executable),
-                '-R', ':'.join((self.socket, self.socket)),
-                '-t',
-            ] + arguments + [
+            ] + options + ['-t'] + arguments + [
                 'SSHED_SOCK=%s ' % self.socket,
                 os.environ.get('SHELL', 'bash'),
             ])
 
 
+def cache_directory():
+    """Return the directory in which edssh caches data, creating it."""
+    directory = os.path.join(
+        os.environ.get('XDG_CACHE_HOME') or
+        os.path.join(os.path.expanduser('~'), '.cache'), 'sshed')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _load_versions(path):
+    """Load the cached SSH client versions, or return {} if unreadable."""
+    try:
+        with open(path) as file:
+            versions = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return versions if isinstance(versions, dict) else {}
+
+
+def _save_versions(path, versions):
+    """Save the cached SSH client versions, atomically."""
+    try:
+        with tempfile.NamedTemporaryFile(
+                'w', dir=os.path.dirname(path), delete=False) as file:
+            json.dump(versions, file)
+        os.replace(file.name, path)
+    except OSError as error:
+        logging.debug('Unable to cache the SSH client version: %s', error)
+
+
+def find_client():
+    """Return the socket of a running sshed_client, or None.
+
+    The socket in SSHED_SOCK is used if it's set. Otherwise, the socket of
+    an sshed_client that edssh started earlier is used if it still accepts
+    connections.
+    """
+    if os.environ.get('SSHED_SOCK'):
+        return sshed.find_socket()
+    link = os.path.join(control_directory(), CLIENT_LINK)
+    if not os.path.exists(link):
+        return None
+    socket_address = sshed.find_socket(os.path.realpath(link))
+    if socket_address is None:
+        return None
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(socket_address)
+    except OSError:
+        logging.debug('The sshed_client at %s has exited.', socket_address)
+        return None
+    finally:
+        probe.close()
+    return socket_address
+
+
+def start_client():
+    """Start sshed_client in the background and return its socket.
+
+    sshed_client prints the command exporting SSHED_SOCK only once its
+    socket is listening, so reading that line is all the waiting needed.
+
+    Returns:
+        The path to the socket, or None if sshed_client failed to start.
+    """
+    directory = control_directory()
+    with open(os.path.join(directory, CLIENT_LOG), 'ab') as log:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'sshed.sshed_client', '--bash'],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log,
+            start_new_session=True)
+    with process.stdout:
+        line = process.stdout.readline().decode('utf-8').strip()
+    prefix = 'export SSHED_SOCK='
+    if not line.startswith(prefix):
+        logging.error(
+            'sshed_client failed to start. See %s.',
+            os.path.join(directory, CLIENT_LOG))
+        return None
+    socket_address = line[len(prefix):]
+    link = os.path.join(directory, CLIENT_LINK)
+    temporary_link = '%s.%d' % (link, os.getpid())
+    os.symlink(socket_address, temporary_link)
+    os.replace(temporary_link, link)
+    logging.debug('Started sshed_client at %s.', socket_address)
+    return socket_address
+
+
+def control_directory():
+    """Return a private directory for the master connections' sockets.
+
+    This is the XDG runtime directory if there is one, and otherwise a
+    directory in the temporary directory that only the user may access.
+
+    Raises:
+        ValueError: If the directory in the temporary directory is owned by
+            somebody else or accessible by other users.
+    """
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if directory and os.path.isdir(directory):
+        return directory
+    directory = os.path.join(tempfile.gettempdir(), 'edssh-%d' % os.getuid())
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    directory_stats = os.lstat(directory)
+    if (
+            directory_stats.st_uid != os.getuid() or
+            directory_stats.st_mode & 0o077):
+        raise ValueError('%s is not private.' % directory)
+    return directory
+
+
 def main():
     """Entry point for edssh.
 
-    Parses the '--client' argument if set, generates a client object, and then
-    executes the client.
-
-    TODO: start sshed if necessary.
+    Parses the '--client' argument if set, generates a client object, starts
+    sshed_client if necessary, and then executes the client.
     """
     logging.basicConfig(format=sshed.LOGGING_FORMAT)
     if '--client' in sys.argv:
@@ -113,8 +281,7 @@ def main():
             'Invalid SSH client version: %s %s', client.project, client.version)
         logging.error('Client executable was: %s', client.executable)
         sys.exit(1)
-    client.socket = sshed.find_socket()
+    client.socket = find_client() or start_client()
     if client.socket is None:
-        # TODO: Open SSHEd client in another process.
-        raise NotImplementedError("Can't find an existing sshed socket.")
+        sys.exit(1)
     client.run(sys.argv[1:])
@@ -0,0 +1,364 @@
+# Large file support for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Diffing of files too large to hold in memory.
+
+Nothing in this module reads a whole file into memory. Diffs are generated
+from runs of line hashes that are spilled to disk and compared a window at a
+time.
+"""
+
+import os
+import struct
+import tempfile
+from difflib import SequenceMatcher
+
+DIFF_WINDOW_LINES = 2 ** 13
+"""The maximum number of lines from each file that are diffed in memory."""
+CONTEXT_LINES = 3
+RUN_BUFFER_RECORDS = 2 ** 14
+VERIFY_CHUNK_SIZE = 2 ** 20
+"""The number of bytes of each file compared at once by equal_lines_match."""
+
+
+class LineHashRun(object):
+    """The hash and offset of every line in a file, spilled to disk.
+
+    Hashes are only comparable between runs built in the same process.
+    """
+    RECORD = struct.Struct('<qQ')
+
+    def __init__(self, file):
+        """Build the run of line hashes for file.
+
+        Positional arguments:
+            file: A binary file-like object supporting iteration, seek and
+                read. The run keeps a reference to it in order to read lines
+                back for the diff, so it must stay open and unchanged.
+        """
+        self.file = file
+        self.spill = tempfile.TemporaryFile()
+        """The temporary file holding the records."""
+        self.length = 0
+        """The number of lines in the file."""
+        file.seek(0)
+        offset = 0
+        records = bytearray()
+        for line in file:
+            records += self.RECORD.pack(hash(line), offset)
+            offset += len(line)
+            self.length += 1
+            if self.length % RUN_BUFFER_RECORDS == 0:
+                self.spill.write(records)
+                records = bytearray()
+        self.spill.write(records)
+        self.size = offset
+        """The size of the file in bytes."""
+        file.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def close(self):
+        """Remove the spilled records from disk."""
+        self.spill.close()
+
+    def records(self, start, stop):
+        """Return a list of (hash, offset) tuples for lines start to stop."""
+        start = max(0, start)
+        stop = min(self.length, stop)
+        if stop <= start:
+            return []
+        self.spill.seek(start * self.RECORD.size)
+        data = self.spill.read((stop - start) * self.RECORD.size)
+        return list(self.RECORD.iter_unpack(data))
+
+    def hashes(self, start, stop):
+        """Return a list of the hashes of lines start to stop."""
+        return [record[0] for record in self.records(start, stop)]
+
+    def offset(self, line):
+        """Return the byte offset at which a line (numbered from 0) starts."""
+        if line >= self.length:
+            return self.size
+        return self.records(line, line + 1)[0][1]
+
+    def read_bytes(self, offset, size):
+        """Read size bytes back from the file, starting at offset."""
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def lines(self, start, stop):
+        """Read lines start to stop back from the file as a list of bytes."""
+        if stop <= start:
+            return []
+        begin = self.offset(start)
+        return split_lines(self.read_bytes(begin, self.offset(stop) - begin))
+
+    def blocks(self, reverse=False):
+        """Yield lists of line hashes in blocks, optionally from the end."""
+        starts = range(0, self.length, RUN_BUFFER_RECORDS)
+        if reverse:
+            for start in reversed(starts):
+                yield list(reversed(
+                    self.hashes(start, start + RUN_BUFFER_RECORDS)))
+        else:
+            for start in starts:
+                yield self.hashes(start, start + RUN_BUFFER_RECORDS)
+
+
+def split_lines(data):
+    """Split bytes into lines on newlines only, keeping the newlines.
+
+    Unlike bytes.splitlines, this splits exactly where iterating over a
+    binary file does.
+    """
+    lines = data.split(b'\n')
+    last = lines.pop()
+    lines = [line + b'\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _common_length(first, second):
+    """Return the number of leading hashes two block iterators share."""
+    common = 0
+    first_block, second_block = [], []
+    first_index = second_index = 0
+    while True:
+        if first_index == len(first_block):
+            first_block, first_index = next(first, None), 0
+        if second_index == len(second_block):
+            second_block, second_index = next(second, None), 0
+        if first_block is None or second_block is None:
+            return common
+        if first_block[first_index] != second_block[second_index]:
+            return common
+        common += 1
+        first_index += 1
+        second_index += 1
+
+
+def group_opcodes(opcodes, context=CONTEXT_LINES):
+    """Group opcodes into hunks with context lines.
+
+    This works like difflib.SequenceMatcher.get_grouped_opcodes, but on a
+    list of opcodes that didn't necessarily come from a single
+    SequenceMatcher.
+    """
+    codes = list(opcodes)
+    if not codes:
+        codes = [('equal', 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    width = context + context
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > width:
+            group.append(
+                (tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+            if [code for code in group if code[0] != 'equal']:
+                yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if [code for code in group if code[0] != 'equal']:
+        yield group
+
+
+def _format_range(start, stop):
+    """Format a line range the way difflib.unified_diff does."""
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '%d' % beginning
+    if not length:
+        beginning -= 1
+    return '%d,%d' % (beginning, length)
+
+
+def equal_lines_match(
+        opcodes, original, edited, chunk_size=VERIFY_CHUNK_SIZE):
+    """Return whether the lines that opcodes call equal have the same bytes.
+
+    Lines are matched on their 64-bit hashes alone, so two different lines
+    with the same hash would be left out of the diff. The lines are compared
+    a chunk at a time, so neither file is held in memory.
+
+    Positional arguments:
+        opcodes: The opcodes transforming original into edited.
+        original: An object with offset(line) and read_bytes(offset, size)
+            methods for the original file (e.g. a LineHashRun).
+        edited: Like original, but for the edited file.
+    Keyword arguments:
+        chunk_size: The number of bytes of each file to compare at once.
+    """
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != 'equal':
+            continue
+        begin, end = original.offset(i1), original.offset(i2)
+        edited_begin = edited.offset(j1)
+        if edited.offset(j2) - edited_begin != end - begin:
+            return False
+        for position in range(0, end - begin, chunk_size):
+            size = min(chunk_size, end - begin - position)
+            if (
+                    original.read_bytes(begin + position, size) !=
+                    edited.read_bytes(edited_begin + position, size)):
+                return False
+    return True
+
+
+def _terminated(lines):
+    """Return whether a file ends with a newline (or is empty).
+
+    Positional arguments:
+        lines: An object with offset(line), read_bytes(offset, size) and
+            __len__ methods for the file (e.g. a LineHashRun).
+    """
+    size = lines.offset(len(lines))
+    return not size or lines.read_bytes(size - 1, 1) == b'\n'
+
+
+def expressible(groups, original, edited):
+    """Return whether grouped opcodes can be written as a unified diff.
+
+    A hunk that reaches a last line without a newline can't be expressed by
+    the unified diffs written here, as its line would run into the next.
+
+    Positional arguments:
+        groups: A list of opcode groups, as from group_opcodes.
+        original: An object with offset(line), read_bytes(offset, size) and
+            __len__ methods for the original file (e.g. a LineHashRun).
+        edited: Like original, but for the edited file.
+    """
+    if not groups:
+        return True
+    _, _, original_end, _, end = groups[-1][-1]
+    return not (
+        original_end == len(original) and not _terminated(original) or
+        end == len(edited) and not _terminated(edited))
+
+
+def write_unified_diff(groups, original, edited, output):
+    """Write grouped opcodes to output as a unified diff.
+
+    Positional arguments:
+        groups: An iterable of opcode groups, as from group_opcodes.
+        original: An object with a lines(start, stop) method returning the
+            lines of the original file (e.g. a LineHashRun).
+        edited: Like original, but for the edited file.
+        output: A binary file-like object to which to write the diff.
+
+    Returns:
+        The number of bytes written.
+    """
+    written = 0
+    started = False
+    for group in groups:
+        if not started:
+            written += output.write(b'--- \n+++ \n')
+            started = True
+        first, last = group[0], group[-1]
+        written += output.write(('@@ -%s +%s @@\n' % (
+            _format_range(first[1], last[2]),
+            _format_range(first[3], last[4]))).encode('utf-8'))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in original.lines(i1, i2):
+                    written += output.write(b' ' + line)
+                continue
+            if tag in ('replace', 'delete'):
+                for line in original.lines(i1, i2):
+                    written += output.write(b'-' + line)
+            if tag in ('replace', 'insert'):
+                for line in edited.lines(j1, j2):
+                    written += output.write(b'+' + line)
+    return written
+
+
+def diff_opcodes(original, edited, window=DIFF_WINDOW_LINES):
+    """Return the opcodes transforming one LineHashRun into another.
+
+    The common prefix and suffix are found by streaming the spilled hashes.
+    The lines between them are compared a window at a time, so no more than
+    window lines from each file are ever held in memory.
+
+    Returns:
+        A list of opcodes like those of difflib.SequenceMatcher.get_opcodes.
+    """
+    prefix = _common_length(original.blocks(), edited.blocks())
+    suffix = _common_length(
+        original.blocks(reverse=True), edited.blocks(reverse=True))
+    suffix = min(suffix, len(original) - prefix, len(edited) - prefix)
+    original_stop = len(original) - suffix
+    edited_stop = len(edited) - suffix
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    opcodes.extend(_windowed_opcodes(
+        original, edited, prefix, original_stop, prefix, edited_stop, window))
+    if suffix:
+        opcodes.append((
+            'equal', original_stop, len(original), edited_stop, len(edited)))
+    return merge_equal(opcodes)
+
+
+def _windowed_opcodes(
+        original, edited, original_start, original_stop, edited_start,
+        edited_stop, window):
+    """Yield opcodes for a range of lines, comparing a window at a time.
+
+    Each window is diffed in memory and its opcodes are kept up to the end of
+    the last matching block. The next window starts from there, so a change
+    that crosses the end of a window is seen whole in the next one.
+    """
+    i, j = original_start, edited_start
+    while i < original_stop or j < edited_stop:
+        original_hashes = original.hashes(i, min(i + window, original_stop))
+        edited_hashes = edited.hashes(j, min(j + window, edited_stop))
+        codes = SequenceMatcher(
+            None, original_hashes, edited_hashes,
+            autojunk=False).get_opcodes()
+        last = len(codes) - 1
+        if (
+                i + len(original_hashes) < original_stop or
+                j + len(edited_hashes) < edited_stop):
+            while last >= 0 and codes[last][0] != 'equal':
+                last -= 1
+        if last < 0:
+            # Nothing in the window matches: replace all of it.
+            tag = 'replace'
+            if not original_hashes:
+                tag = 'insert'
+            elif not edited_hashes:
+                tag = 'delete'
+            codes, last = [
+                (tag, 0, len(original_hashes), 0, len(edited_hashes))], 0
+        for tag, i1, i2, j1, j2 in codes[:last + 1]:
+            yield (tag, i + i1, i + i2, j + j1, j + j2)
+        i, j = i + codes[last][2], j + codes[last][4]
+
+
+def merge_equal(opcodes):
+    """Merge adjacent 'equal' opcodes into one."""
+    merged = []
+    for code in opcodes:
+        if merged and code[0] == merged[-1][0] == 'equal':
+            code = ('equal', merged[-1][1], code[2], merged[-1][3], code[4])
+            merged.pop()
+        merged.append(code)
+    return merged
+
+
+def file_size(file):
+    """Return the size of a seekable file-like object, rewinding it."""
+    file.seek(0, os.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    return size
@@ -0,0 +1,143 @@
+# Line indexing for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Splitting files into lines, with a key for each line to diff on.
+
+If NumPy is installed, newlines are found and each line hashed to a 64-bit
+integer with vectorised operations over the file's bytes, so that no Python
+object is made for a line unless it ends up in a diff. The hash is a
+polynomial one, computed for a block of lines at a time from running sums.
+Without NumPy, the lines themselves (as bytes) are the keys.
+
+Hashes can collide, so anything matched on them must be checked against the
+lines' bytes before it's trusted. Lines.hashed says whether that's needed.
+"""
+
+from . import largefile
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+HASH_BLOCK_SIZE = 2 ** 16
+"""The number of bytes of lines hashed together."""
+_MULTIPLIER = 0x100000001b3
+_MODULUS = 2 ** 64
+
+
+def _powers(base, count):
+    """Return an array of base to the power of 0 to count - 1, mod 2 ** 64."""
+    powers = numpy.full(count, base, dtype=numpy.uint64)
+    powers[0] = 1
+    return numpy.cumprod(powers, dtype=numpy.uint64)
+
+
+def _line_ends(data):
+    """Return an array of the offset of the end of each line of data."""
+    ends = numpy.flatnonzero(
+        numpy.frombuffer(data, dtype=numpy.uint8) == ord('\n'))
+    ends += 1
+    if len(data) and data[-1:] != b'\n':
+        ends = numpy.append(ends, len(data))
+    return ends.astype(numpy.int64)
+
+
+def _line_hashes(data, ends, block_size=HASH_BLOCK_SIZE):
+    """Return an array of the hash of each line of data.
+
+    Positional arguments:
+        data: The bytes to which the lines belong.
+        ends: The array returned by _line_ends for data.
+    Keyword arguments:
+        block_size: The number of bytes of lines hashed together. A line
+            longer than this is hashed on its own.
+    """
+    values = numpy.frombuffer(data, dtype=numpy.uint8)
+    # The tables of powers need be no longer than the data.
+    block_size = max(1, min(block_size, len(data)))
+    starts = numpy.concatenate(([0], ends[:-1]))
+    hashes = numpy.empty(len(ends), dtype=numpy.uint64)
+    inverse = pow(_MULTIPLIER, -1, _MODULUS)
+    powers = _powers(_MULTIPLIER, block_size)
+    inverse_powers = _powers(inverse, block_size)
+    first = 0
+    with numpy.errstate(over='ignore'):
+        while first < len(ends):
+            offset = starts[first]
+            last = max(first + 1, int(numpy.searchsorted(
+                ends, offset + block_size, side='right')))
+            size = int(ends[last - 1] - offset)
+            if size > len(powers):
+                powers = _powers(_MULTIPLIER, size)
+                inverse_powers = _powers(inverse, size)
+            # sums[k] is the sum of each byte before k times the multiplier
+            # to the power of its position in the block.
+            sums = numpy.zeros(size + 1, dtype=numpy.uint64)
+            numpy.cumsum(
+                values[offset:offset + size] * powers[:size], out=sums[1:])
+            line_starts = starts[first:last] - offset
+            line_ends = ends[first:last] - offset
+            hashes[first:last] = (
+                (sums[line_ends] - sums[line_starts]) *
+                inverse_powers[line_starts] +
+                (line_ends - line_starts).astype(numpy.uint64))
+            first = last
+    return hashes
+
+
+class Lines(object):
+    """The lines of a file, with a key for each line to diff on."""
+
+    def __init__(self, data, vectorised=None):
+        """Initialise Lines.
+
+        Positional arguments:
+            data: The contents of the file, as bytes.
+        Keyword arguments:
+            vectorised: Whether to index and hash lines with NumPy. By
+                default, they are if NumPy is installed.
+        """
+        if vectorised is None:
+            vectorised = numpy is not None
+        self.data = data
+        """The contents of the file."""
+        self.hashed = vectorised
+        """Whether the keys are hashes, which may collide."""
+        if vectorised:
+            self._ends = _line_ends(data)
+            self.keys = _line_hashes(data, self._ends)
+            """A key for each line, equal for equal lines: a NumPy array of
+            hashes if hashed, or otherwise a list of the lines."""
+        else:
+            self.keys = largefile.split_lines(data)
+            self._ends = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def terminated(self):
+        """Whether the file is empty or ends with a newline."""
+        return not self.data or self.data.endswith(b'\n')
+
+    def offset(self, line):
+        """Return the offset in bytes at which a line starts."""
+        if not line:
+            return 0
+        if self._ends is None:
+            return sum(len(key) for key in self.keys[:line])
+        return int(self._ends[line - 1])
+
+    def key_list(self, start, stop):
+        """Return the keys of lines start to stop, as a list."""
+        if self._ends is None:
+            return self.keys[start:stop]
+        return self.keys[start:stop].tolist()
+
+    def lines(self, start, stop):
+        """Return lines start to stop, as a list of bytes objects."""
+        if self._ends is None:
+            return self.keys[start:stop]
+        return largefile.split_lines(
+            self.data[self.offset(start):self.offset(stop)])
@@ -0,0 +1,525 @@
+# Load testing for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Load test sshed_client with many simulated hosts and scripted editors.
+
+sshed-loadtest starts an sshed_client of its own and plays many host side
+sessions against it at once, each from a thread speaking the sshed protocol
+just as sshed does. The client's EDITOR is a fake editor (found through
+sshed.choose_editor like any other) that makes a fixed series of saves at set
+intervals, each a deterministic edit of the one before, and logs when it made
+each. The host side checks every save it receives against the expected
+contents, so that the report's latencies are from a save being written to
+the same contents being applied on the host.
+
+The report covers throughput, latency percentiles and the client's resource
+usage. For example, to size sshed_client for a burst of 200 edits:
+
+    sshed-loadtest --sessions 200 --saves 10 --interval 0.5
+"""
+
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from . import packethandler, sshed, trace
+
+DEFAULT_SESSIONS = 20
+DEFAULT_SAVES = 5
+DEFAULT_INTERVAL = 0.2
+DEFAULT_LINES = 1000
+DEFAULT_TIMEOUT = 60
+PERCENTILES = (50, 90, 99)
+EDITOR_NAME = 'loadtest-editor'
+SAVES_VARIABLE = 'LOADTEST_SAVES'
+INTERVAL_VARIABLE = 'LOADTEST_INTERVAL'
+LOG_VARIABLE = 'LOADTEST_LOG'
+"""The environment variables through which the fake editor is scripted."""
+_EDITOR_SCRIPT = """\
+#!%s
+import sys
+from sshed import loadtest
+sys.exit(loadtest.fake_editor())
+"""
+_STEP = 7919
+"""A prime, so that successive saves edit lines spread across the file."""
+
+
+def original_contents(session, lines=DEFAULT_LINES):
+    """Return the file a session starts by sending.
+
+    The first line names the session, so that the fake editor knows which
+    one it's editing.
+    """
+    return b'loadtest session %d\n' % session + b''.join(
+        b'line %d of session %d\n' % (line, session)
+        for line in range(lines))
+
+
+def session_of(contents):
+    """Return the session number named in the first line of a file."""
+    return int(contents.split(b'\n', 1)[0].split()[-1])
+
+
+def scripted_save(contents, number):
+    """Return the contents of a file after a scripted save.
+
+    Each save replaces one line, and every other save also adds one, so that
+    the saves are diffs of different shapes. The first line is left alone.
+
+    Positional arguments:
+        contents: The contents before the save, as bytes.
+        number: The number of the save, counting from 1.
+    """
+    lines = contents.splitlines(keepends=True)
+    line = 1 + number * _STEP % max(len(lines) - 1, 1)
+    lines[line:line + 1] = [b'save %d\n' % number]
+    if number % 2 == 0:
+        lines.insert(line, b'added by save %d\n' % number)
+    return b''.join(lines)
+
+
+def expected_saves(session, saves, lines=DEFAULT_LINES):
+    """Return the contents of a session's file after each save, in order.
+
+    The first item is the original, before any save.
+    """
+    versions = [original_contents(session, lines)]
+    for number in range(1, saves + 1):
+        versions.append(scripted_save(versions[-1], number))
+    return versions
+
+
+def fake_editor(args=None):
+    """Make the scripted saves of a file, then exit like an editor.
+
+    Each save is written to a temporary file renamed over the original, so
+    that sshed_client never sends a half written save. The session number,
+    save number and time of each save are appended to the file named by
+    LOG_VARIABLE.
+
+    Keyword arguments:
+        args: The command line arguments, the last being the file to edit.
+            Default: sys.argv[1:]
+    """
+    if args is None:
+        args = sys.argv[1:]
+    path = args[-1]
+    saves = int(os.environ.get(SAVES_VARIABLE, DEFAULT_SAVES))
+    interval = float(os.environ.get(INTERVAL_VARIABLE, DEFAULT_INTERVAL))
+    with open(path, 'rb') as file:
+        contents = file.read()
+    session = session_of(contents)
+    log = os.open(
+        os.environ[LOG_VARIABLE], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        for number in range(1, saves + 1):
+            time.sleep(interval)
+            contents = scripted_save(contents, number)
+            with open(path + '.new', 'wb') as file:
+                file.write(contents)
+            os.replace(path + '.new', path)
+            # One write per line, so lines from many editors don't interleave.
+            os.write(log, b'%d %d %.6f\n' % (session, number, time.time()))
+    finally:
+        os.close(log)
+    return 0
+
+
+def write_editor(directory, name=EDITOR_NAME, script=_EDITOR_SCRIPT):
+    """Write a script that runs fake_editor and return its path.
+
+    Keyword arguments:
+        name: The name of the script.
+        script: The script, with a placeholder for the Python interpreter.
+            Default: one running fake_editor
+
+    Raises:
+        ValueError: If the path contains "sshed", as choose_editor would then
+            pass over it for a real editor.
+    """
+    path = os.path.join(directory, name)
+    if 'sshed' in path:
+        raise ValueError(
+            'The fake editor would be ignored at %s. Set TMPDIR to a path '
+            'without "sshed" in it.' % path)
+    with open(path, 'w') as file:
+        file.write(script % sys.executable)
+    os.chmod(path, 0o700)
+    return path
+
+
+def percentile(values, percent):
+    """Return the nearest-rank percentile of a list of numbers."""
+    ordered = sorted(values)
+    rank = max(1, int(round(percent / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class HostSession(object):
+    """One simulated host editing a file through sshed_client."""
+
+    def __init__(self, number, socket_address, saves, lines=DEFAULT_LINES,
+                 timeout=DEFAULT_TIMEOUT):
+        """Initialise a HostSession.
+
+        Positional arguments:
+            number: The session's number, unique within the load test.
+            socket_address: The path of sshed_client's socket.
+            saves: The number of saves the fake editor will make.
+        Keyword arguments:
+            lines: The number of lines in the file to edit.
+            timeout: The longest time in seconds to wait on the socket.
+        """
+        self.number = number
+        self.socket_address = socket_address
+        self.timeout = timeout
+        self.versions = expected_saves(number, saves, lines)
+        self.applied = {}
+        """The time each save was applied, by save number."""
+        self.open_time = None
+        """Seconds taken to connect and send the file."""
+        self.unexpected = 0
+        """The number of saves whose contents matched no scripted save."""
+        self.error = None
+        self.bytes_sent = self.bytes_received = 0
+
+    @property
+    def complete(self):
+        """Whether the last save arrived without any error."""
+        return self.error is None and len(self.versions) - 1 in self.applied
+
+    def run(self):
+        """Send the file and apply saves until sshed_client hangs up."""
+        tracer = trace.Tracer()
+        contents = self.versions[0]
+        start = time.perf_counter()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        packet_handler = packethandler.PacketHandler(connection)
+        try:
+            # Connecting with a timeout would fail at once, rather than
+            # wait, while sshed_client's listen backlog is full.
+            connection.connect(self.socket_address)
+            connection.settimeout(self.timeout)
+            packet_handler.send(dict(
+                Version=1,
+                Filename='loadtest-%d.txt' % self.number,
+                Filesize=len(contents),
+                Differential=True,
+                **{'Diff-Formats': ','.join(sshed.DIFF_FORMATS)}), contents)
+            self.open_time = time.perf_counter() - start
+            latest = 0
+            while True:
+                saves = sshed.receive_saves(
+                    packet_handler, tracer, packet_handler.get_headers())
+                for headers, edited in saves:
+                    contents = sshed.saved_contents(headers, edited, contents)
+                now = time.time()
+                try:
+                    latest = self.versions.index(contents, latest + 1)
+                except ValueError:
+                    self.unexpected += 1
+                    continue
+                self.applied[latest] = now
+        except packethandler.SocketClosedError:
+            pass
+        except (OSError, sshed.ChecksumMismatch, sshed.MalformedDiff) as error:
+            self.error = '%s: %s' % (type(error).__name__, error)
+        finally:
+            self.bytes_sent = packet_handler.bytes_sent
+            self.bytes_received = packet_handler.bytes_received
+            connection.close()
+
+
+def start_client(socket_address, environment, client_args=()):
+    """Start an sshed_client and wait until it's listening.
+
+    Positional arguments:
+        socket_address: The path at which the client is to listen.
+        environment: The client's environment variables.
+    Keyword arguments:
+        client_args: Further command line arguments for the client.
+
+    Returns:
+        The subprocess.Popen of the client.
+    """
+    client = subprocess.Popen(
+        [sys.executable, '-m', 'sshed.sshed_client', '--bash',
+         '-a', socket_address] + list(client_args),
+        env=environment, stdout=subprocess.PIPE)
+    # The client prints SSHED_SOCK once its socket is listening.
+    if not client.stdout.readline():
+        client.wait()
+        raise RuntimeError(
+            'sshed_client exited with status %d.' % client.returncode)
+    return client
+
+
+def _own_usage(pid):
+    """Return a process's own CPU time and peak RSS from /proc, if there.
+
+    Returns:
+        A dictionary with cpu_seconds and max_rss_kb, or None if /proc
+        doesn't have them.
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as file:
+            # The command name may contain spaces, so split after it.
+            fields = file.read().rsplit(')', 1)[1].split()
+        with open('/proc/%d/status' % pid) as file:
+            status = dict(
+                line.split(':', 1) for line in file if ':' in line)
+        ticks = os.sysconf('SC_CLK_TCK')
+        return dict(
+            cpu_seconds=(int(fields[11]) + int(fields[12])) / ticks,
+            max_rss_kb=int(status['VmHWM'].split()[0]))
+    except (OSError, KeyError, IndexError, ValueError):
+        return None
+
+
+def stop_client(client):
+    """Interrupt an sshed_client, wait for it and return its resource usage.
+
+    Returns:
+        A dictionary of the client's resource usage. The "own" entry is the
+        client process alone (None if unknown); the rest, from wait4, also
+        include the fake editors it ran.
+    """
+    own = _own_usage(client.pid)
+    client.send_signal(signal.SIGINT)
+    _, status, usage = os.wait4(client.pid, 0)
+    client.returncode = os.waitstatus_to_exitcode(status)
+    client.stdout.close()
+    return dict(
+        own=own,
+        user_seconds=usage.ru_utime,
+        system_seconds=usage.ru_stime,
+        max_rss_kb=usage.ru_maxrss,
+        voluntary_switches=usage.ru_nvcsw,
+        involuntary_switches=usage.ru_nivcsw)
+
+
+def _read_log(path):
+    """Return the times of the fake editors' saves, by (session, save)."""
+    saved = {}
+    try:
+        with open(path, 'rb') as file:
+            for line in file:
+                session, number, when = line.split()
+                saved[(int(session), int(number))] = float(when)
+    except FileNotFoundError:
+        pass
+    return saved
+
+
+def summarise(values):
+    """Return the percentiles and maximum of a list of seconds."""
+    if not values:
+        return {}
+    summary = dict(
+        ('p%d' % percent, percentile(values, percent))
+        for percent in PERCENTILES)
+    summary['max'] = max(values)
+    return summary
+
+
+def report(sessions, saved, duration, usage):
+    """Summarise a load test.
+
+    Positional arguments:
+        sessions: The finished HostSessions.
+        saved: The times of the fake editors' saves, by (session, save).
+        duration: The wall clock time the sessions took, in seconds.
+        usage: The client's resource usage, from stop_client.
+
+    Returns:
+        A dictionary of the results.
+    """
+    latencies = []
+    for session in sessions:
+        for number, applied in session.applied.items():
+            if (session.number, number) in saved:
+                latencies.append(applied - saved[(session.number, number)])
+    applied = sum(len(session.applied) for session in sessions)
+    transferred = sum(
+        session.bytes_sent + session.bytes_received for session in sessions)
+    return dict(
+        sessions=len(sessions),
+        complete=sum(session.complete for session in sessions),
+        errors=sorted(set(
+            session.error for session in sessions if session.error)),
+        saves_made=len(saved),
+        saves_applied=applied,
+        # Saves overtaken by a later one before sshed_client noticed them.
+        saves_coalesced=len(saved) - applied,
+        saves_unexpected=sum(session.unexpected for session in sessions),
+        duration=duration,
+        saves_per_second=applied / duration if duration else 0.0,
+        bytes_per_second=transferred / duration if duration else 0.0,
+        open_latency=summarise([
+            session.open_time for session in sessions
+            if session.open_time is not None]),
+        save_latency=summarise(latencies),
+        client=usage)
+
+
+def format_report(results):
+    """Return a report from the report function as human readable text."""
+    lines = [
+        'Sessions: %d (%d complete)' % (
+            results['sessions'], results['complete']),
+        'Saves: %d made, %d applied, %d coalesced, %d unexpected' % (
+            results['saves_made'], results['saves_applied'],
+            results['saves_coalesced'], results['saves_unexpected']),
+        'Duration: %.3fs' % results['duration'],
+        'Throughput: %.1f saves/s, %.0f bytes/s' % (
+            results['saves_per_second'], results['bytes_per_second']),
+    ]
+    for name in ('open_latency', 'save_latency'):
+        if results[name]:
+            lines.append(format_latency(
+                name.replace('_', ' ').capitalize(), results[name]))
+    lines.extend(format_usage(results['client']))
+    for error in results['errors']:
+        lines.append('Error: %s' % error)
+    return '\n'.join(lines)
+
+
+def format_latency(name, latency):
+    """Return a line of text giving the percentiles from summarise."""
+    return '%s: %s' % (name, ', '.join(
+        '%s %.1fms' % (key, 1000 * latency[key])
+        for key in sorted(latency, key=_percentile_order)))
+
+
+def format_usage(usage):
+    """Return lines of text giving a client's usage, from stop_client."""
+    lines = []
+    if usage['own']:
+        lines.append('Client: %.2fs CPU, %d KB peak RSS' % (
+            usage['own']['cpu_seconds'], usage['own']['max_rss_kb']))
+    lines.append(
+        'Client and editors: %.2fs user, %.2fs system, %d KB peak RSS, '
+        '%d/%d voluntary/involuntary context switches' % (
+            usage['user_seconds'], usage['system_seconds'],
+            usage['max_rss_kb'], usage['voluntary_switches'],
+            usage['involuntary_switches']))
+    return lines
+
+
+def environment(**variables):
+    """Return an environment in which this copy of sshed is importable.
+
+    Keyword arguments:
+        Further environment variables to set.
+    """
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(
+            [package] + os.environ.get('PYTHONPATH', '').split(
+                os.pathsep)).rstrip(os.pathsep),
+        **variables)
+
+
+def _percentile_order(key):
+    """Sort key putting percentiles in order, followed by the maximum."""
+    return int(key[1:]) if key.startswith('p') else 101
+
+
+def run(args):
+    """Run a load test and return the results of report."""
+    directory = tempfile.mkdtemp(prefix='loadtest-')
+    try:
+        log = os.path.join(directory, 'saves.log')
+        socket_address = os.path.join(directory, 'socket')
+        client = start_client(socket_address, environment(
+            EDITOR=write_editor(directory),
+            **{SAVES_VARIABLE: str(args.saves),
+               INTERVAL_VARIABLE: str(args.interval),
+               LOG_VARIABLE: log}), args.client_args)
+        try:
+            sessions = [
+                HostSession(
+                    number, socket_address, args.saves, lines=args.lines,
+                    timeout=args.timeout)
+                for number in range(args.sessions)]
+            threads = [
+                threading.Thread(target=session.run, daemon=True)
+                for session in sessions]
+            start = time.perf_counter()
+            for index, thread in enumerate(threads):
+                if args.ramp and index:
+                    time.sleep(args.ramp / len(threads))
+                thread.start()
+            for thread in threads:
+                thread.join()
+            duration = time.perf_counter() - start
+        finally:
+            usage = stop_client(client)
+        return report(sessions, _read_log(log), duration, usage)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def parse_arguments(args=None):
+    """Parse the command line arguments and return a namespace."""
+    parser = argparse.ArgumentParser(
+        description='Load test sshed_client with simulated hosts and editors.')
+    parser.add_argument(
+        '-n', '--sessions', type=int, default=DEFAULT_SESSIONS,
+        help='Run this many sessions at once. Default: %d' % DEFAULT_SESSIONS)
+    parser.add_argument(
+        '--saves', type=int, default=DEFAULT_SAVES,
+        help='Make this many saves per session. Default: %d' % DEFAULT_SAVES)
+    parser.add_argument(
+        '--interval', type=float, default=DEFAULT_INTERVAL,
+        help=(
+            'Wait this many seconds before each save. Default: %s' %
+            DEFAULT_INTERVAL))
+    parser.add_argument(
+        '--lines', type=int, default=DEFAULT_LINES,
+        help='Edit files of this many lines. Default: %d' % DEFAULT_LINES)
+    parser.add_argument(
+        '--ramp', type=float, default=0,
+        help=(
+            'Spread the start of the sessions over this many seconds. '
+            'Default: start them all at once'))
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT,
+        help=(
+            'Fail a session that waits this many seconds on its socket. '
+            'Default: %d' % DEFAULT_TIMEOUT))
+    parser.add_argument(
+        '--client-arg', action='append', default=[], dest='client_args',
+        metavar='ARG',
+        help=(
+            'Pass this argument to sshed_client, e.g. '
+            '"--client-arg=--diff-workers=2". May be given more than once.'))
+    parser.add_argument(
+        '--json', action='store_true', help='Print the results as JSON.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Entry point for sshed-loadtest."""
+    args = parse_arguments(args)
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_report(results))
+    return 0 if results['complete'] == results['sessions'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+# Block manifests for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Block-hash manifests of working copies and range patches.
+
+A manifest holds the digest of every fixed-size block of a file. Comparing a
+new save against it finds the changed blocks without keeping the contents of
+the previous save around, and only those blocks are then read back and
+compared to produce a range patch.
+
+The blocks are fixed-size rather than content-defined, so this only pays off
+for changes that overwrite bytes in place or append to the file. Inserting
+or deleting even one byte shifts every later block, which then all differ.
+The range patch comes out larger than RANGE_PATCH_RATIO of the file and is
+dropped once that's clear, and the save is sent as a line diff instead, but
+only after the whole new save has been hashed.
+
+A range patch is a series of records, each made of a line containing the
+offset and length of the range in decimal, separated by a space, followed by
+that many bytes of data to write at that offset.
+"""
+
+import hashlib
+import os
+
+BLOCK_SIZE = 2 ** 16
+"""The size in bytes of each block in a manifest."""
+RANGE_PATCH_RATIO = 0.5
+"""Range patches larger than this fraction of the file aren't worth sending."""
+COPY_SIZE = 2 ** 20
+"""The most bytes of a range to hold at once while applying a patch."""
+
+
+def _block_digest(block):
+    """Return the digest of a block."""
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+class BlockManifest(object):
+    """The digests of the fixed-size blocks of a file."""
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.digests = []
+        """The digest of each block, in order."""
+        self.size = 0
+        """The size in bytes of the file the manifest describes."""
+
+    @classmethod
+    def from_file(cls, file, block_size=BLOCK_SIZE):
+        """Create a manifest describing the contents of a file."""
+        manifest = cls(block_size=block_size)
+        manifest.update(*manifest.scan(file))
+        return manifest
+
+    def scan(self, file):
+        """Hash the blocks of a file.
+
+        Positional arguments:
+            file: A binary file-like object. It is read from the start.
+
+        Returns:
+            A tuple of the list of block digests and the size of the file.
+        """
+        file.seek(0)
+        digests = []
+        size = 0
+        block = file.read(self.block_size)
+        while block:
+            digests.append(_block_digest(block))
+            size += len(block)
+            block = file.read(self.block_size)
+        file.seek(0)
+        return digests, size
+
+    def matches(self, digests, size):
+        """Return whether a scan found the file unchanged."""
+        return size == self.size and digests == self.digests
+
+    def changed_blocks(self, digests):
+        """Return the indices of blocks that differ from a scan's digests.
+
+        A block that only exists in the manifest (because the file shrank)
+        isn't included; the change in size covers it.
+        """
+        return [
+            index for index, digest in enumerate(digests)
+            if index >= len(self.digests) or digest != self.digests[index]]
+
+    def update(self, digests, size):
+        """Make the manifest describe a new version of the file."""
+        self.digests = digests
+        self.size = size
+
+
+class BlockHasher(object):
+    """Hashes the blocks of a file as it's written, from the start."""
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        self.digests = []
+        """The digest of each whole block hashed so far."""
+        self.size = 0
+        """The number of bytes hashed so far."""
+        self._block = bytearray()
+
+    def update(self, data):
+        """Hash the next bytes of the file."""
+        self.size += len(data)
+        data = memoryview(data)
+        if self._block:
+            needed = self.block_size - len(self._block)
+            self._block += data[:needed]
+            data = data[needed:]
+            if len(self._block) < self.block_size:
+                return
+            self.digests.append(_block_digest(self._block))
+            self._block = bytearray()
+        while len(data) >= self.block_size:
+            self.digests.append(_block_digest(data[:self.block_size]))
+            data = data[self.block_size:]
+        self._block += data
+
+    def manifest(self):
+        """Return a BlockManifest of the bytes hashed so far."""
+        digests = list(self.digests)
+        if self._block:
+            digests.append(_block_digest(self._block))
+        manifest = BlockManifest(block_size=self.block_size)
+        manifest.update(digests, self.size)
+        return manifest
+
+
+def _common_prefix_length(first, second):
+    """Return the length of the common prefix of two bytes objects."""
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def changed_ranges(original, edited, blocks, block_size=BLOCK_SIZE):
+    """Yield the byte ranges of edited that differ from original.
+
+    Only the given blocks of each file are read, and each is trimmed down to
+    the bytes that actually changed. Adjacent ranges are merged.
+
+    Positional arguments:
+        original: A binary file-like object with the previous contents.
+        edited: A binary file-like object with the new contents.
+        blocks: The indices of the blocks that changed.
+
+    Yields:
+        Tuples of the offset and the new data for each range.
+    """
+    pending = None
+    for index in blocks:
+        offset = index * block_size
+        original.seek(offset)
+        old = original.read(block_size)
+        edited.seek(offset)
+        new = edited.read(block_size)
+        start = _common_prefix_length(old, new)
+        stop = len(new)
+        if len(old) == len(new):
+            stop -= _common_prefix_length(old[::-1], new[::-1])
+        if start >= stop:
+            continue
+        if pending is not None and (
+                pending[0] + len(pending[1]) == offset + start):
+            pending = (pending[0], pending[1] + new[start:stop])
+            continue
+        if pending is not None:
+            yield pending
+        pending = (offset + start, new[start:stop])
+    if pending is not None:
+        yield pending
+
+
+def write_range_patch(ranges, output, limit=None):
+    """Write ranges to output as a range patch.
+
+    Positional arguments:
+        ranges: An iterable of (offset, data) tuples.
+        output: A binary file-like object to which to write the patch.
+    Keyword arguments:
+        limit: Give up once the patch grows beyond this many bytes.
+
+    Returns:
+        The size of the patch in bytes, or None if it exceeded the limit.
+    """
+    written = 0
+    for offset, data in ranges:
+        written += output.write(('%d %d\n' % (offset, len(data))).encode())
+        written += output.write(data)
+        if limit is not None and written > limit:
+            return None
+    return written
+
+
+def apply_range_patch(patch, file, size):
+    """Apply a range patch to a file.
+
+    Positional arguments:
+        patch: A binary file-like object containing the range patch. It's
+            read in pieces, so it may be a packethandler.PacketReader.
+        file: The binary file to patch. It must be open for writing.
+        size: The size of the file after patching.
+    """
+    header = patch.readline()
+    while header:
+        offset, length = [int(number) for number in header.split()]
+        file.seek(offset)
+        while length:
+            data = patch.read(min(length, COPY_SIZE))
+            if not data:
+                raise ValueError('Range patch ends in the middle of a range.')
+            file.write(data)
+            length -= len(data)
+        header = patch.readline()
+    file.truncate(size)
+    file.seek(0, os.SEEK_SET)
@@ -0,0 +1,115 @@
+# Memory budget for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""A limit on the memory that spooled files hold across all sessions.
+
+sshed_client keeps copies of each file it's editing (the file as received
+and each save) in spooled temporary files, which stay in memory until they
+grow past a size limit. Those limits are per file, so the memory they use
+grows with the number of sessions. A SpooledFile instead asks a shared
+MemoryBudget for the memory it needs as it grows, and rolls over to disk as
+soon as the budget says no, however small it is.
+"""
+
+import tempfile
+import threading
+import weakref
+
+BUDGET = 64 * 2 ** 20
+"""The default number of bytes spooled files may hold in memory in all."""
+IDLE_TIME = 30
+"""Seconds after which a session waiting on its editor spills to disk."""
+
+
+class MemoryBudget(object):
+    """The memory that spooled files may use between them."""
+
+    def __init__(self, limit=BUDGET):
+        """Initialise a MemoryBudget.
+
+        Keyword arguments:
+            limit: The number of bytes that files may hold in memory in all.
+        """
+        self.limit = limit
+        self.used = 0
+        """The number of bytes reserved by files in memory."""
+        self.peak = 0
+        """The most bytes ever reserved at once."""
+        self.spills = 0
+        """The number of files rolled over to disk for lack of budget."""
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """Reserve memory, returning whether there was enough to spare."""
+        with self._lock:
+            if self.used + size > self.limit:
+                self.spills += 1
+                return False
+            self.used += size
+            self.peak = max(self.peak, self.used)
+            return True
+
+    def release(self, reservation):
+        """Return a reservation (a one item list) to the budget."""
+        with self._lock:
+            self.used -= reservation[0]
+            reservation[0] = 0
+
+
+class SpooledFile(tempfile.SpooledTemporaryFile):
+    """A spooled temporary file that keeps to a MemoryBudget.
+
+    Memory is reserved before each write that grows the file. If the budget
+    can't spare it, the file rolls over to disk first. The reservation is
+    returned when the file rolls over or is closed (or garbage collected).
+    """
+
+    def __init__(self, budget, max_size=0, **kwargs):
+        """Initialise a SpooledFile.
+
+        Positional arguments:
+            budget: The MemoryBudget from which to reserve memory.
+        Keyword arguments:
+            max_size: The size above which to roll over to disk regardless
+                of the budget, or 0 for no such limit.
+            **kwargs: Keyword arguments for tempfile.SpooledTemporaryFile.
+        """
+        super().__init__(max_size=max_size, **kwargs)
+        self.budget = budget
+        # A list, so that the finalizer sees the reservation as it grows.
+        self._reservation = [0]
+        self._release = weakref.finalize(
+            self, budget.release, self._reservation)
+
+    @property
+    def reserved(self):
+        """The number of bytes of the budget this file holds."""
+        return self._reservation[0]
+
+    def _reserve(self, end):
+        """Reserve memory for the file to grow to end, or roll over."""
+        if self._rolled or end <= self._reservation[0]:
+            return
+        if self.budget.reserve(end - self._reservation[0]):
+            self._reservation[0] = end
+        else:
+            self.rollover()
+
+    def write(self, s):
+        self._reserve(self.tell() + len(s))
+        return super().write(s)
+
+    def writelines(self, iterable):
+        for line in iterable:
+            self.write(line)
+
+    def rollover(self):
+        super().rollover()
+        self._release()
+
+    def close(self):
+        super().close()
+        self._release()
+
+    def __exit__(self, exc, value, traceback):
+        self.close()
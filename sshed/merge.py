@@ -0,0 +1,160 @@
+# Three-way merging for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Merging changes made to a file on both the host and the client.
+
+Both sides start from the same baseline. When the file changes on the host
+while it's being edited, the changes made on each side since the baseline are
+merged, line by line. Where both sides changed the same lines differently,
+both versions are kept between conflict markers, as in git.
+"""
+
+import collections
+import difflib
+
+from . import transfers
+
+LOCAL_MARKER = b'<<<<<<< local\n'
+SEPARATOR = b'=======\n'
+HOST_MARKER = b'>>>>>>> host\n'
+BASELINE_LIMIT = 8
+"""The number of versions of a file kept as possible baselines."""
+
+
+def _changes(base, other):
+    """Return the changes from base to other.
+
+    Returns:
+        A list of (start, end, lines) tuples, meaning that base[start:end]
+        was replaced with lines.
+    """
+    matcher = difflib.SequenceMatcher(None, base, other, autojunk=False)
+    return [
+        (base_start, base_end, other[other_start:other_end])
+        for tag, base_start, base_end, other_start, other_end
+        in matcher.get_opcodes() if tag != 'equal']
+
+
+def _apply(base, changes, start, end):
+    """Return base[start:end] with changes (which are all within it) made."""
+    lines = []
+    position = start
+    for change_start, change_end, new_lines in changes:
+        lines.extend(base[position:change_start])
+        lines.extend(new_lines)
+        position = change_end
+    lines.extend(base[position:end])
+    return lines
+
+
+def _terminated(lines):
+    """Return lines, making sure the last one ends with a newline."""
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
+
+
+def merge3(base, mine, theirs, prefer_mine=False):
+    """Merge two sets of changes to the same baseline.
+
+    Changes are merged in groups of changes that overlap (or are insertions
+    at the same place). A group changed on only one side, or changed the same
+    way on both, is merged cleanly. Otherwise it's a conflict.
+
+    Positional arguments:
+        base: The baseline as a list of lines (as bytes).
+        mine: The local version as a list of lines.
+        theirs: The host's version as a list of lines.
+    Keyword arguments:
+        prefer_mine: Resolve conflicts by taking the local version, rather
+            than keeping both between conflict markers.
+
+    Returns:
+        A tuple of the merged list of lines and the number of conflicts.
+    """
+    sides = [collections.deque(_changes(base, mine)),
+             collections.deque(_changes(base, theirs))]
+    merged = []
+    conflicts = 0
+    position = 0
+    while sides[0] or sides[1]:
+        start = min(side[0][0] for side in sides if side)
+        end = start
+        groups = [[], []]
+        absorbed = True
+        while absorbed:
+            absorbed = False
+            for side, group in zip(sides, groups):
+                while side and (side[0][0] < end or side[0][0] == start):
+                    change = side.popleft()
+                    group.append(change)
+                    end = max(end, change[1])
+                    absorbed = True
+        merged.extend(base[position:start])
+        position = end
+        my_lines = _apply(base, groups[0], start, end)
+        their_lines = _apply(base, groups[1], start, end)
+        if not groups[1] or my_lines == their_lines:
+            merged.extend(my_lines)
+        elif not groups[0]:
+            merged.extend(their_lines)
+        elif prefer_mine:
+            conflicts += 1
+            merged.extend(my_lines)
+        else:
+            conflicts += 1
+            merged.append(LOCAL_MARKER)
+            merged.extend(_terminated(my_lines))
+            merged.append(SEPARATOR)
+            merged.extend(_terminated(their_lines))
+            merged.append(HOST_MARKER)
+    merged.extend(base[position:])
+    return merged, conflicts
+
+
+class Baselines(object):
+    """The versions of a file that the other side may hold as its baseline.
+
+    Versions are looked up by their checksum, which is sent along with each
+    change so that the change can be applied to the right version.
+    """
+
+    def __init__(self, contents, limit=BASELINE_LIMIT):
+        """Initialise Baselines.
+
+        Positional arguments:
+            contents: The current baseline as bytes.
+        Keyword arguments:
+            limit: The number of versions to keep.
+        """
+        self.limit = limit
+        self.versions = collections.OrderedDict()
+        """The versions kept, from oldest to newest, by their checksums."""
+        self.reset(contents)
+
+    @property
+    def current(self):
+        """The newest version."""
+        return next(reversed(self.versions.values()))
+
+    @property
+    def current_checksum(self):
+        """The checksum of the newest version."""
+        return next(reversed(self.versions))
+
+    def add(self, contents):
+        """Add a newer version, forgetting the oldest if over the limit."""
+        checksum = transfers.checksum(contents)
+        self.versions[checksum] = contents
+        self.versions.move_to_end(checksum)
+        while len(self.versions) > self.limit:
+            self.versions.popitem(last=False)
+
+    def reset(self, contents):
+        """Forget every version but a new one."""
+        self.versions.clear()
+        self.add(contents)
+
+    def get(self, checksum):
+        """Return the version with a checksum, or None if it isn't kept."""
+        return self.versions.get(checksum)
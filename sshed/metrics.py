@@ -0,0 +1,367 @@
+# Metrics for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Live metrics and session administration for sshed_client.
+
+sshed_client listens on an admin socket beside its main one (the same path
+with ADMIN_SUFFIX added). Each connection to it sends one command line and
+gets a text reply before the connection is closed:
+
+    metrics     The metrics, in the OpenMetrics text format.
+    sessions    A table of the sessions in progress.
+    cancel ID   Close the connection of the session with that id, ending any
+                transfer in progress.
+
+Running this module sends a command to the sshed_client named by SSHED_SOCK,
+for example "python3 -m sshed.metrics cancel 3".
+"""
+
+import argparse
+import fcntl
+import os
+import socket
+import socketserver
+import struct
+import sys
+import termios
+import threading
+import time
+
+ADMIN_SUFFIX = '.admin'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+"""The upper bounds in seconds of the save latency histogram's buckets."""
+SESSION_KINDS = ('Prefetch', 'Directory', 'View', 'Follow')
+"""Headers that mark a session as other than editing a single file."""
+
+
+def admin_address(socket_address):
+    """Return the path of the admin socket beside a main socket."""
+    return socket_address + ADMIN_SUFFIX
+
+
+def _queued(connection, request):
+    """Return the bytes waiting in a socket's queue, or 0 if unknown.
+
+    Positional arguments:
+        connection: The socket.
+        request: termios.FIONREAD for the receive queue or termios.TIOCOUTQ
+            for the send queue.
+    """
+    try:
+        return struct.unpack(
+            'i', fcntl.ioctl(connection.fileno(), request, b'\0' * 4))[0]
+    except (OSError, ValueError):
+        return 0
+
+
+def _format_value(value):
+    """Format a sample value for OpenMetrics."""
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Histogram(object):
+    """Counts of observations falling below each of a series of bounds."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        """The number of observations at most each bound (not cumulative)."""
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Add an observation."""
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+    def samples(self, name):
+        """Return the OpenMetrics sample lines for the histogram."""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (
+                name, _format_value(float(bound)), cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (name, self.count))
+        lines.append('%s_count %d' % (name, self.count))
+        lines.append('%s_sum %s' % (name, _format_value(self.sum)))
+        return lines
+
+
+class Session(object):  # pylint: disable=too-few-public-methods
+    """A session in progress."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        """The sshed_client.SocketRequestHandler handling the session."""
+        self.started = time.time()
+        self.kind = 'unknown'
+        """What the session is doing: edit, view, follow, etc."""
+        self.name = ''
+        """The name of the file or directory involved, if known."""
+
+
+class Metrics(object):
+    """The counters and sessions of a running sshed_client.
+
+    A Metrics is passed to each session's trace.Tracer as its listener, and
+    counts what the spans record. Byte counts are read live from the
+    sessions in progress, so transfers are counted while they happen.
+    """
+
+    def __init__(self, memory=None):
+        """Initialise a Metrics.
+
+        Named arguments:
+            memory: The memory.MemoryBudget whose usage to report, if any.
+        """
+        self.lock = threading.Lock()
+        self.memory = memory
+        """The memory.MemoryBudget whose usage to report, if any."""
+        self.sessions = {}
+        """The sessions in progress, by id."""
+        self.sessions_started = 0
+        self.received = 0
+        """Bytes received by sessions that have finished."""
+        self.sent = 0
+        """Bytes sent by sessions that have finished."""
+        self.saves = {'diff': 0, 'full': 0}
+        """The number of saves sent as a diff or patch, and as a whole file."""
+        self.save_latency = Histogram()
+        """Seconds from starting to diff a save to finishing sending it."""
+        self.cancelled = set()
+        """The sockets of cancelled sessions, until they're shut down."""
+        self._diffing = {}
+
+    def open_session(self, session_id, handler):
+        """Start counting a session."""
+        with self.lock:
+            self.sessions[session_id] = Session(handler)
+            self.sessions_started += 1
+
+    def describe_session(self, session_id, headers):
+        """Record what a session is doing from the headers that started it."""
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return
+            session.kind = next(
+                (kind.lower() for kind in SESSION_KINDS if headers.get(kind)),
+                'edit')
+            session.name = str(headers.get('Filename', ''))
+
+    def close_session(self, session_id):
+        """Stop counting a session, keeping its byte counts."""
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                self.received += session.handler.bytes_received
+                self.sent += session.handler.bytes_sent
+
+    def record(self, span):
+        """Count a finished trace span."""
+        with self.lock:
+            if span['span'] == 'diff':
+                self._diffing[span['session']] = self._diffing.get(
+                    span['session'], 0) + span['duration']
+            elif span['span'] == 'send':
+                self.saves['diff' if span.get('differential') else 'full'] += 1
+                self.save_latency.observe(
+                    self._diffing.pop(span['session'], 0) + span['duration'])
+
+    def cancel(self, session_id):
+        """Close a session's connection.
+
+        Returns:
+            Whether there was such a session.
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return False
+            self.cancelled.add(session.handler.request)
+        try:
+            session.handler.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return True
+
+    def exposition(self):
+        """Return the metrics in the OpenMetrics text format."""
+        with self.lock:
+            sessions = list(self.sessions.values())
+            received = self.received + sum(
+                session.handler.bytes_received for session in sessions)
+            sent = self.sent + sum(
+                session.handler.bytes_sent for session in sessions)
+            queued_in = sum(
+                _queued(session.handler.request, termios.FIONREAD)
+                for session in sessions)
+            queued_out = sum(
+                _queued(session.handler.request, termios.TIOCOUTQ)
+                for session in sessions)
+            saves = sum(self.saves.values())
+            families = [
+                ('sessions', 'gauge', None, 'Sessions in progress.',
+                 [('', len(sessions))]),
+                ('sessions_started', 'counter', None, 'Sessions started.',
+                 [('_total', self.sessions_started)]),
+                ('received_bytes', 'counter', 'bytes',
+                 'Bytes received from hosts.', [('_total', received)]),
+                ('sent_bytes', 'counter', 'bytes', 'Bytes sent to hosts.',
+                 [('_total', sent)]),
+                ('saves', 'counter', None, 'Saves sent to hosts.', [
+                    ('_total{format="%s"}' % name, count)
+                    for name, count in sorted(self.saves.items())]),
+                ('diff_ratio', 'gauge', 'ratio',
+                 'The fraction of saves sent as a diff or patch.',
+                 [('', self.saves['diff'] / saves if saves else 0.0)]),
+                ('queued_bytes', 'gauge', 'bytes',
+                 'Bytes waiting in session sockets\' queues.',
+                 [('{direction="in"}', queued_in),
+                  ('{direction="out"}', queued_out)]),
+                ('threads', 'gauge', None, 'Threads running.',
+                 [('', threading.active_count())]),
+            ]
+            if self.memory is not None:
+                families.extend([
+                    ('spooled_memory_bytes', 'gauge', 'bytes',
+                     'Bytes of spooled files held in memory.',
+                     [('{value="current"}', self.memory.used),
+                      ('{value="peak"}', self.memory.peak),
+                      ('{value="limit"}', self.memory.limit)]),
+                    ('spooled_spills', 'counter', None,
+                     'Spooled files moved to disk for lack of memory budget.',
+                     [('_total', self.memory.spills)]),
+                ])
+            lines = []
+            for name, metric_type, unit, help_text, samples in families:
+                name = 'sshed_client_' + name
+                lines.append('# TYPE %s %s' % (name, metric_type))
+                if unit:
+                    lines.append('# UNIT %s %s' % (name, unit))
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.extend(
+                    '%s%s %s' % (name, suffix, _format_value(value))
+                    for suffix, value in samples)
+            name = 'sshed_client_save_seconds'
+            lines.extend([
+                '# TYPE %s histogram' % name,
+                '# UNIT %s seconds' % name,
+                '# HELP %s Time taken to diff and send a save.' % name])
+            lines.extend(self.save_latency.samples(name))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def session_table(self):
+        """Return a table of the sessions in progress, one per line."""
+        now = time.time()
+        lines = ['ID\tKIND\tAGE\tRECEIVED\tSENT\tQUEUED\tNAME']
+        with self.lock:
+            for session_id, session in sorted(self.sessions.items()):
+                handler = session.handler
+                lines.append('%d\t%s\t%.0fs\t%d\t%d\t%d\t%s' % (
+                    session_id, session.kind, now - session.started,
+                    handler.bytes_received, handler.bytes_sent,
+                    _queued(handler.request, termios.TIOCOUTQ),
+                    session.name))
+        return '\n'.join(lines) + '\n'
+
+
+class AdminRequestHandler(socketserver.StreamRequestHandler):
+    """Answers one command sent to the admin socket."""
+
+    def handle(self):
+        """Read a command line and write the reply."""
+        metrics = self.server.metrics
+        command = self.rfile.readline().decode('utf-8', 'replace').split()
+        if command == ['metrics']:
+            reply = metrics.exposition()
+        elif command == ['sessions']:
+            reply = metrics.session_table()
+        elif len(command) == 2 and command[0] == 'cancel':
+            try:
+                session_id = int(command[1])
+            except ValueError:
+                session_id = None
+            if session_id is not None and metrics.cancel(session_id):
+                reply = 'Cancelled session %d.\n' % session_id
+            else:
+                reply = 'No session %s.\n' % command[1]
+        else:
+            reply = 'Unknown command. Use metrics, sessions or cancel ID.\n'
+        self.wfile.write(reply.encode('utf-8'))
+
+
+class AdminServer(
+        socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The admin socket's server."""
+    daemon_threads = True
+
+    def __init__(self, address, metrics):
+        """Initialise an AdminServer.
+
+        Positional arguments:
+            address: The path at which to listen.
+            metrics: The Metrics to report and whose sessions to control.
+        """
+        self.metrics = metrics
+        super().__init__(address, AdminRequestHandler)
+
+    def serve_in_background(self):
+        """Serve requests in a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def send_command(command, socket_address):
+    """Send a command to an sshed_client's admin socket and return the reply.
+
+    Positional arguments:
+        command: The command line, without a newline.
+        socket_address: The path of sshed_client's main socket.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(admin_address(socket_address))
+        connection.sendall(command.encode('utf-8') + b'\n')
+        reply = []
+        data = connection.recv(65536)
+        while data:
+            reply.append(data)
+            data = connection.recv(65536)
+    finally:
+        connection.close()
+    return b''.join(reply).decode('utf-8')
+
+
+def main(args=None):
+    """Send a command to the admin socket of the running sshed_client."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        'command', nargs='+', help='metrics, sessions or cancel ID')
+    parser.add_argument(
+        '-a', '--socketaddress', dest='socket_address',
+        default=os.environ.get('SSHED_SOCK'),
+        help='The main socket of sshed_client. Default: $SSHED_SOCK')
+    args = parser.parse_args(args)
+    if not args.socket_address:
+        parser.error('SSHED_SOCK is not set.')
+    try:
+        sys.stdout.write(send_command(
+            ' '.join(args.command), args.socket_address))
+    except OSError as error:
+        print('Could not reach sshed_client: %s' % error, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
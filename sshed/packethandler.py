@@ -5,8 +5,11 @@
 """
 
 import os
+import select
+import tempfile
 
 BUFFER_SIZE = 4096
+FILE_CHUNK_SIZE = 2 ** 20
 
 
 class SocketClosedError(Exception):
@@ -14,14 +17,150 @@ class SocketClosedError(Exception):
     pass
 
 
+class PacketReader(object):
+    """Reads the data of one packet from the socket as it's wanted.
+
+    Only the packet's own bytes are taken from the socket, at most
+    FILE_CHUNK_SIZE at once, so however large the packet, little more than
+    that is held in memory. Whatever of the packet isn't read is skipped when
+    the reader is closed, leaving the socket at the start of the next packet.
+    """
+
+    def __init__(self, handler, headers, spool=None, when=None):
+        """Initialise a PacketReader.
+
+        Positional arguments:
+            handler: The PacketHandler that received the packet's headers.
+            headers: The packet's headers.
+        Keyword arguments:
+            spool: A file into which to copy the data as it's read, for the
+                handler's recorder.
+            when: The time at which the headers were received, for the
+                handler's recorder.
+        """
+        self.handler = handler
+        self.headers = headers
+        self.remaining = headers.get('Size', 0)
+        """The number of bytes of the packet not yet read."""
+        self.closed = False
+        # The bytes received but not yet read, from _offset on. The buffer
+        # may hold the start of the packet (and even what follows it).
+        self._chunk = handler.buffer
+        self._offset = 0
+        handler.buffer = b''
+        self._spool = spool
+        self._when = when
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *_):
+        # Once the socket has closed, the rest of the packet never will
+        # arrive. After any other error, it's skipped so that the next packet
+        # can be read.
+        if kind is None or not issubclass(kind, (SocketClosedError, OSError)):
+            self.close()
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def _fill(self):
+        """Return how many bytes of the packet are at hand, receiving some.
+
+        More are only received if none are at hand. Zero means the packet has
+        all been read.
+
+        Raises:
+            SocketClosedError: If the socket closes before the packet ends.
+        """
+        available = min(len(self._chunk) - self._offset, self.remaining)
+        if available or not self.remaining:
+            return available
+        self._chunk = self.handler.socket.recv(
+            min(self.remaining, FILE_CHUNK_SIZE))
+        self._offset = 0
+        self.handler.bytes_received += len(self._chunk)
+        if not self._chunk:
+            raise SocketClosedError()
+        return len(self._chunk)
+
+    def _take(self, length):
+        """Return the next length bytes at hand."""
+        data = self._chunk[self._offset:self._offset + length]
+        self._offset += length
+        self.remaining -= length
+        if self._spool is not None:
+            self._spool.write(data)
+        return data
+
+    def read(self, size=-1):
+        """Read up to size bytes, or the rest of the packet if size is -1."""
+        if size is None or size < 0:
+            size = self.remaining
+        parts = []
+        while size:
+            available = self._fill()
+            if not available:
+                break
+            parts.append(self._take(min(size, available)))
+            size -= len(parts[-1])
+        return b''.join(parts)
+
+    def readline(self):
+        """Read the next line, or what's left of the packet if it's shorter."""
+        parts = []
+        while True:
+            available = self._fill()
+            if not available:
+                break
+            end = self._chunk.find(
+                b'\n', self._offset, self._offset + available)
+            if end != -1:
+                parts.append(self._take(end + 1 - self._offset))
+                break
+            parts.append(self._take(available))
+        return b''.join(parts)
+
+    def close(self):
+        """Skip the rest of the packet and record it, if it's being recorded.
+
+        Raises:
+            SocketClosedError: If the socket closes before the packet ends.
+        """
+        if self.closed:
+            return
+        while self.remaining:
+            self._take(self._fill())
+        self.closed = True
+        self.handler.buffer = self._chunk[self._offset:] + self.handler.buffer
+        self._chunk = b''
+        recorder = self.handler.recorder
+        if recorder is None:
+            return
+        if self._spool is not None:
+            self._spool.seek(0)
+        recorder.record('received', self.headers, self._spool, when=self._when)
+        if self._spool is not None:
+            self._spool.close()
+
+
 class PacketHandler(object):
     """Handles incoming packets and generates outgoing packets."""
     STRING_TO_BOOL = {'True': True, 'False': False}
 
-    def __init__(self, socket):
+    def __init__(self, socket, recorder=None):
         self.socket = socket
         """The socket on which the handler sends and receives packets."""
         self.buffer = b''
+        self.bytes_sent = 0
+        """The number of bytes sent on the socket, headers included."""
+        self.bytes_received = 0
+        """The number of bytes received from the socket, headers included."""
+        self.header_size = 0
+        """The size in bytes of the headers of the last packet received."""
+        self.recorder = recorder
+        """A capture.Recorder in which to record every packet, if any."""
+        self._received_at = None
 
     def get(self, data_file=None):
         """Get a packet from the socket.
@@ -34,12 +173,63 @@ class PacketHandler(object):
             If data_file is None, a tuple containing the headers dictionary and
             a bytes object containing the data.
         """
-        headers = self._get_headers()
-        data = self._get_bytes(headers.get('Size', 0), data_file=data_file)
+        headers = self.get_headers()
+        data = self.get_data(headers, data_file=data_file)
         if data_file is None:
             return (headers, data)
         return headers
 
+    def get_headers(self):
+        """Wait for a packet and return its headers.
+
+        The packet's data must then be retrieved with get_data.
+        """
+        headers = self._get_headers()
+        if self.recorder is not None:
+            self._received_at = self.recorder.now()
+        return headers
+
+    def get_data(self, headers, data_file=None):
+        """Get the data of a packet whose headers have been retrieved.
+
+        Positional arguments:
+            headers: The headers dictionary returned by get_headers.
+        Named arguments:
+            data_file: A file-like object into which to put the data.
+
+        Returns:
+            A bytes object containing the data if data_file is None.
+        """
+        if self.recorder is None:
+            return self._get_bytes(headers.get('Size', 0), data_file=data_file)
+        if data_file is None:
+            data = self._get_bytes(headers.get('Size', 0))
+            self.recorder.record(
+                'received', headers, data, when=self._received_at)
+            return data
+        start = data_file.tell()
+        self._get_bytes(headers.get('Size', 0), data_file=data_file)
+        end = data_file.tell()
+        data_file.seek(start)
+        self.recorder.record(
+            'received', headers, data_file, when=self._received_at)
+        data_file.seek(end)
+        return None
+
+    def stream(self, headers):
+        """Return a PacketReader for the data of a packet, to read as it comes.
+
+        The packet's headers must have been retrieved with get_headers, and
+        the reader must be closed before the next packet is retrieved.
+
+        Positional arguments:
+            headers: The headers dictionary returned by get_headers.
+        """
+        spool = None
+        if self.recorder is not None and self.recorder.payloads:
+            spool = tempfile.TemporaryFile()
+        return PacketReader(self, headers, spool=spool, when=self._received_at)
+
     def _get_headers(self):
         """Retrieve the headers of a packet.
 
@@ -49,13 +239,26 @@ class PacketHandler(object):
         headers_length = self.buffer.find('\n\n'.encode('utf-8'))
         while headers_length == -1:
             new_data = self.socket.recv(BUFFER_SIZE)
+            self.bytes_received += len(new_data)
             self.buffer += new_data
             headers_length = self.buffer.find('\n\n'.encode('utf-8'))
             if headers_length == -1 and len(new_data) == 0:
                 raise SocketClosedError(
                     'Socket closed whilst retrieving headers. '
                     'Raw packet data: %s', self.buffer)
+        self.header_size = headers_length + 2
         raw_headers, self.buffer = self.buffer.split('\n\n'.encode('utf-8'), 1)
+        return self._parse_headers(raw_headers)
+
+    def _parse_headers(self, raw_headers):
+        """Parse the headers of a packet.
+
+        Positional arguments:
+            raw_headers: The header lines of the packet, as bytes.
+
+        Returns:
+            A dictionary containing the packet headers.
+        """
         raw_headers = raw_headers.decode('utf-8').split('\n')
         headers = {}
         for header in raw_headers:
@@ -106,23 +309,90 @@ class PacketHandler(object):
                 is received.
         """
         written = 0
-        message = b''
+        message = bytearray()
         while written < length:
-            if len(self.buffer) >= (length - written):
-                seg, self.buffer = (self.buffer[:length], self.buffer[length:])
+            remaining = length - written
+            if len(self.buffer) >= remaining:
+                seg, self.buffer = (
+                    self.buffer[:remaining], self.buffer[remaining:])
                 if data_file:
                     data_file.write(seg)
                     data_file.truncate()
                     return
-                return message + seg
+                return bytes(message + seg)
             if data_file:
                 data_file.write(self.buffer)
             else:
                 message += self.buffer
             written += len(self.buffer)
             self.buffer = self.socket.recv(BUFFER_SIZE)
+            self.bytes_received += len(self.buffer)
             if len(self.buffer) == 0:
                 raise SocketClosedError()
+        if data_file:
+            data_file.truncate()
+            return
+        return b''
+
+    def pending(self, timeout=0):
+        """Return whether a packet is waiting to be read.
+
+        A packet already buffered (having arrived along with the last one)
+        counts, even though the socket itself may have nothing to read.
+
+        Keyword arguments:
+            timeout: The longest time in seconds to wait for one.
+        """
+        if self.buffer:
+            return True
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        return bool(readable)
+
+    def ready(self):
+        """Return whether a whole packet has arrived, without waiting.
+
+        Whatever the socket has to read is buffered first, so that a packet
+        that is only partly sent isn't counted.
+        """
+        while select.select([self.socket], [], [], 0)[0]:
+            new_data = self.socket.recv(FILE_CHUNK_SIZE)
+            if not new_data:
+                break
+            self.bytes_received += len(new_data)
+            self.buffer += new_data
+        headers_length = self.buffer.find(b'\n\n')
+        if headers_length == -1:
+            return False
+        headers = self._parse_headers(self.buffer[:headers_length])
+        return len(self.buffer) >= headers_length + 2 + headers.get('Size', 0)
+
+    def request_range(self, offset, length):
+        """Request a byte range of the file at the other end of the socket.
+
+        Positional arguments:
+            offset: The offset of the range in bytes.
+            length: The length of the range in bytes.
+
+        Returns:
+            A bytes object containing the range. It's shorter than length if
+            the range runs past the end of the file.
+        """
+        self.send({'Range-Offset': offset, 'Range-Length': length})
+        headers, data = self.get()
+        if headers.get('Offset') != offset:
+            raise ValueError('Received the wrong range.')
+        return data
+
+    def answer_range(self, headers, file):
+        """Reply to a range request.
+
+        Positional arguments:
+            headers: The headers of the range request packet.
+            file: The file from which to read the range.
+        """
+        offset = headers['Range-Offset']
+        file.seek(offset)
+        self.send({'Offset': offset}, file.read(headers['Range-Length']))
 
     @classmethod
     def _generate_header_bytes(cls, name, contents):
@@ -170,13 +440,20 @@ class PacketHandler(object):
             contents.seek(0, os.SEEK_END)
             headers['Size'] = contents.tell()
             contents.seek(0, os.SEEK_SET)
+        if self.recorder is not None:
+            self.recorder.record('sent', headers, contents)
         for header in headers:
-            self.socket.sendall(
-                self._generate_header_bytes(header, headers[header]))
+            header_bytes = self._generate_header_bytes(header, headers[header])
+            self.socket.sendall(header_bytes)
+            self.bytes_sent += len(header_bytes)
         self.socket.sendall(b'\n')
+        self.bytes_sent += 1 + headers['Size']
         if contents is None:
             return
         if isinstance(contents, bytes):
             self.socket.sendall(contents)
-        else:
-            self.socket.sendall(contents.read())
+            return
+        chunk = contents.read(FILE_CHUNK_SIZE)
+        while chunk:
+            self.socket.sendall(chunk)
+            chunk = contents.read(FILE_CHUNK_SIZE)
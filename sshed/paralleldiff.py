@@ -0,0 +1,338 @@
+# Parallel diffing for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Diffing of very large files across several processes.
+
+The worker processes are started once, by a WorkerPool, and kept for every
+diff. They're forked from a forkserver rather than from sshed_client itself,
+as forking a process that's running other threads can leave the child
+holding a lock that's never released. Each worker memory-maps the files it's
+given by path, so it reads their contents straight from the page cache and
+nothing but paths, byte offsets, line hashes and opcodes is ever pickled
+between processes.
+
+The files are first hashed line by line in parallel. Lines that appear
+exactly once in each file are then used as anchors to split both files into
+pairs of segments, which are diffed independently. The opcodes of each
+segment are stitched back together in order.
+
+Files are passed to the workers as their /proc/PID/fd paths, which works for
+the anonymous temporary files sshed_client keeps, but only on Linux. Line
+hashes are compared only with others from the workers, which share a hash
+seed as they're all forked from the one forkserver.
+"""
+
+import collections
+import contextlib
+import mmap
+import multiprocessing
+import os
+import select
+import sys
+import threading
+import time
+from array import array
+from concurrent import futures
+
+from . import largefile
+
+SEGMENTS_PER_WORKER = 4
+ANCHOR_SEARCH_LINES = 64
+"""How many lines after each split point to search for a unique line."""
+PARENT_POLL_INTERVAL = 1
+"""Seconds between checks that the process using a pool is still running,
+where that can't be waited for directly."""
+SUPPORTED = sys.platform.startswith('linux') and os.path.isdir('/proc/self/fd')
+"""Whether the workers can open files by their /proc/PID/fd paths."""
+
+
+def _map(file):
+    """Memory-map a file for reading, returning bytes if it's empty."""
+    file.flush()
+    if os.fstat(file.fileno()).st_size == 0:
+        return b''
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _path(file):
+    """Return a path at which another process can open an open file."""
+    return '/proc/%d/fd/%d' % (os.getpid(), file.fileno())
+
+
+@contextlib.contextmanager
+def _open_map(path):
+    """Memory-map a file by path for the duration of a with block."""
+    with open(path, 'rb') as file:
+        data = _map(file)
+        try:
+            yield data
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+def _exit_with(pid):
+    """Exit once the process pid has. Runs in a thread of each worker.
+
+    A worker's parent is the forkserver, which lives as long as its workers
+    do, so nothing else stops them if sshed_client is killed.
+    """
+    try:
+        process = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        while True:
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                break
+            time.sleep(PARENT_POLL_INTERVAL)
+    else:
+        select.select([process], [], [])
+    os._exit(0)  # pylint: disable=protected-access
+
+
+def _initialise_worker(pid):
+    """Start watching the process that's using the pool."""
+    threading.Thread(target=_exit_with, args=(pid,), daemon=True).start()
+
+
+class WorkerPool(object):
+    """A pool of worker processes for diff_files, started once and reused."""
+
+    def __init__(self, workers=None):
+        """Initialise a WorkerPool.
+
+        The processes themselves are started as they're first needed.
+
+        Keyword arguments:
+            workers: The number of worker processes. Defaults to the CPU
+                count.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([__name__])
+        self.executor = futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context,
+            initializer=_initialise_worker, initargs=(os.getpid(),))
+
+    def close(self):
+        """Stop the worker processes."""
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _split_points(data, count):
+    """Return count + 1 byte offsets that split data at line boundaries."""
+    size = len(data)
+    points = [0]
+    for part in range(1, count):
+        point = data.find(b'\n', part * size // count) + 1
+        if point <= 0 or point <= points[-1]:
+            continue
+        points.append(point)
+    points.append(size)
+    return points
+
+
+def _hash_lines(path, start, stop):
+    """Hash the lines in a byte range of a file. Runs in a worker.
+
+    Returns:
+        A tuple of an array of line hashes and an array of line offsets.
+    """
+    hashes = array('q')
+    offsets = array('Q')
+    with _open_map(path) as data:
+        position = start
+        while position < stop:
+            end = data.find(b'\n', position, stop) + 1
+            if end <= 0:
+                end = stop
+            hashes.append(hash(data[position:end]))
+            offsets.append(position)
+            position = end
+    return hashes, offsets
+
+
+class _HashList(object):  # pylint: disable=too-few-public-methods
+    """Adapts a list of hashes to the interface of largefile.LineHashRun."""
+
+    def __init__(self, hashes):
+        self._hashes = hashes
+
+    def hashes(self, start, stop):
+        """Return a list of the hashes of lines start to stop."""
+        return self._hashes[start:stop]
+
+
+def _segment_hashes(path, start, stop):
+    """Return a list of the hashes of the lines in a byte range of a file."""
+    with _open_map(path) as data:
+        return [
+            hash(line) for line in largefile.split_lines(data[start:stop])]
+
+
+def _diff_segment(original_range, edited_range, window):
+    """Diff a pair of segments given as (path, start, stop). Runs in a worker.
+
+    Returns:
+        A list of opcodes relative to the start of the segments.
+    """
+    original = _segment_hashes(*original_range)
+    edited = _segment_hashes(*edited_range)
+    return list(largefile._windowed_opcodes(  # pylint: disable=protected-access
+        _HashList(original), _HashList(edited), 0, len(original), 0,
+        len(edited), window))
+
+
+class MappedLines(object):
+    """The lines of a memory-mapped file, indexed by line number."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        """The offset of each line, followed by the size of the file."""
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def offset(self, line):
+        """Return the byte offset at which a line (numbered from 0) starts."""
+        return self.offsets[line]
+
+    def read_bytes(self, offset, size):
+        """Return size bytes of the file, starting at offset."""
+        return self.data[offset:offset + size]
+
+    def lines(self, start, stop):
+        """Return lines start to stop as a list of bytes."""
+        if stop <= start:
+            return []
+        return largefile.split_lines(
+            self.data[self.offsets[start]:self.offsets[stop]])
+
+    def close(self):
+        """Unmap the file."""
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def _hash_file(executor, path, data, parts):
+    """Hash every line of a file using the workers.
+
+    Returns:
+        A tuple of an array of line hashes and an array of line offsets,
+        followed by the size of the file.
+    """
+    points = _split_points(data, parts)
+    hashes = array('q')
+    offsets = array('Q')
+    for part_hashes, part_offsets in executor.map(
+            _hash_lines, [path] * (len(points) - 1), points[:-1],
+            points[1:]):
+        hashes.extend(part_hashes)
+        offsets.extend(part_offsets)
+    offsets.append(len(data))
+    return hashes, offsets
+
+
+def find_anchors(original, edited, count):
+    """Find lines that occur exactly once in each file.
+
+    Positional arguments:
+        original: The line hashes of the original file.
+        edited: The line hashes of the edited file.
+        count: The number of segments into which to split the files.
+
+    Returns:
+        A list of (original line, edited line) tuples in increasing order.
+    """
+    starts = [part * len(original) // count for part in range(1, count)]
+    candidates = set()
+    for start in starts:
+        candidates.update(original[start:start + ANCHOR_SEARCH_LINES])
+    original_counts = collections.Counter(
+        line for line in original if line in candidates)
+    edited_counts = collections.Counter()
+    edited_positions = {}
+    for number, line in enumerate(edited):
+        if line in candidates:
+            edited_counts[line] += 1
+            edited_positions[line] = number
+    anchors = []
+    for start in starts:
+        for number in range(
+                start, min(start + ANCHOR_SEARCH_LINES, len(original))):
+            line = original[number]
+            if original_counts[line] != 1 or edited_counts[line] != 1:
+                continue
+            if anchors and (
+                    number <= anchors[-1][0] or
+                    edited_positions[line] <= anchors[-1][1]):
+                continue
+            anchors.append((number, edited_positions[line]))
+            break
+    return anchors
+
+
+def diff_files(pool, original, edited, window=largefile.DIFF_WINDOW_LINES):
+    """Diff two files across the processes of a WorkerPool.
+
+    Positional arguments:
+        pool: The WorkerPool in which to diff the files.
+        original: A binary file object (with a file descriptor) containing the
+            original file.
+        edited: Like original, but for the edited file.
+    Keyword arguments:
+        window: The number of lines compared at once within a segment.
+
+    Returns:
+        A tuple of the opcodes (as from difflib.SequenceMatcher.get_opcodes)
+        and a MappedLines object for each file, to be passed to
+        largefile.write_unified_diff. The MappedLines should be closed once
+        they are no longer needed.
+    """
+    executor = pool.executor
+    original_data, edited_data = _map(original), _map(edited)
+    original_path, edited_path = _path(original), _path(edited)
+    segments = pool.workers * SEGMENTS_PER_WORKER
+    original_hashes, original_offsets = _hash_file(
+        executor, original_path, original_data, segments)
+    edited_hashes, edited_offsets = _hash_file(
+        executor, edited_path, edited_data, segments)
+    anchors = find_anchors(original_hashes, edited_hashes, segments)
+    # Each segment runs from just after one anchor to the next.
+    bounds = []
+    previous = (0, 0)
+    for anchor in anchors + [(len(original_hashes), len(edited_hashes))]:
+        bounds.append((previous[0], anchor[0], previous[1], anchor[1]))
+        previous = (anchor[0] + 1, anchor[1] + 1)
+    jobs = []
+    for i1, i2, j1, j2 in bounds:
+        if original_hashes[i1:i2] == edited_hashes[j1:j2]:
+            jobs.append(None)
+            continue
+        jobs.append(executor.submit(
+            _diff_segment,
+            (original_path, original_offsets[i1], original_offsets[i2]),
+            (edited_path, edited_offsets[j1], edited_offsets[j2]), window))
+    opcodes = []
+    for index, ((i1, i2, j1, j2), job) in enumerate(zip(bounds, jobs)):
+        if job is None:
+            if i2 > i1:
+                opcodes.append(('equal', i1, i2, j1, j2))
+        else:
+            for tag, a1, a2, b1, b2 in job.result():
+                opcodes.append((tag, a1 + i1, a2 + i1, b1 + j1, b2 + j1))
+        if index < len(anchors):
+            i, j = anchors[index]
+            opcodes.append(('equal', i, i + 1, j, j + 1))
+    return (
+        largefile.merge_equal(opcodes),
+        MappedLines(original_data, original_offsets),
+        MappedLines(edited_data, edited_offsets))
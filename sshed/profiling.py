@@ -0,0 +1,206 @@
+# Profiling for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Per-session profiles of sshed and sshed_client.
+
+While profiling is on, each session runs under cProfile and its profile is
+written to a .pstats file named after the session (as in its trace spans),
+for reading with the pstats module or a viewer such as snakeviz. With memory
+profiling too, the receive, diff and patch phases of the session are traced
+with tracemalloc. The peak memory of each phase is added to its trace span,
+and a snapshot taken at the end of the occurrence of each phase with the
+highest peak is written beside the profile.
+
+tracemalloc traces the whole process and has a single peak, so the peaks are
+the process's, labelled process_peak_memory. The peak is only reset when a
+phase starts while no other traced phase is running, so that it's never
+reset under another phase. A phase that overlapped another (in any session)
+is marked shared_peak, as its peak includes the other's allocations and may
+have been reached before it started. The processes that paralleldiff starts
+aren't profiled.
+
+sshed_client turns profiling on or off when sent SIGUSR1, for sessions that
+start afterwards:
+
+    kill -USR1 $(pgrep -f sshed_client)
+"""
+
+import cProfile
+import logging
+import os
+import signal
+import tempfile
+import threading
+import tracemalloc
+
+MEMORY_PHASES = ('receive', 'diff', 'patch')
+"""The session phases whose memory use is traced."""
+TRACEBACK_FRAMES = 10
+"""The number of frames tracemalloc keeps for each allocation."""
+TOGGLE_SIGNAL = signal.SIGUSR1
+"""The signal that turns sshed_client's profiling on or off."""
+
+
+class SessionProfile(object):
+    """The profile of one session, written out when it stops."""
+
+    def __init__(self, profiler, name):
+        """Initialise and start a SessionProfile.
+
+        Positional arguments:
+            profiler: The Profiler whose settings to use.
+            name: The name of the session, from which the files are named.
+
+        Raises:
+            ValueError: If another profiler is already running, as Python
+                3.12 and later allow only one at a time.
+        """
+        self.profiler = profiler
+        self.path = os.path.join(profiler.directory, name)
+        """The path of the profile's files, without their extensions."""
+        self.peaks = {}
+        """The highest peak of each phase and the snapshot taken after it."""
+        self._phases = {}
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        self.memory = profiler.memory and profiler.start_tracing()
+
+    def start_phase(self, name):
+        """Note the start of a session phase."""
+        if self.memory and name in MEMORY_PHASES:
+            self._phases[name] = self.profiler.open_phase()
+
+    def end_phase(self, name, span):
+        """Note the end of a session phase, adding its peak to its span."""
+        if not self.memory or name not in MEMORY_PHASES:
+            return
+        peak, shared = self.profiler.close_phase(self._phases.pop(name))
+        span['process_peak_memory'] = peak
+        span['shared_peak'] = shared
+        if peak > self.peaks.get(name, (-1, None))[0]:
+            self.peaks[name] = (peak, tracemalloc.take_snapshot())
+
+    def stop(self):
+        """Stop profiling and write the profile and any snapshots."""
+        self._profile.disable()
+        if self.memory:
+            self.profiler.stop_tracing()
+        self._profile.dump_stats(self.path + '.pstats')
+        for name, (_, snapshot) in self.peaks.items():
+            snapshot.dump('%s-%s.tracemalloc' % (self.path, name))
+        logging.info('Profile written to %s.pstats', self.path)
+
+
+class Profiler(object):
+    """Whether to profile sessions, and where to write their profiles."""
+
+    def __init__(self, directory=None, memory=False):
+        """Initialise a Profiler.
+
+        Keyword arguments:
+            directory: The directory in which to write profiles. If given,
+                profiling starts on. Otherwise it starts off, and a new
+                temporary directory is used if it's turned on.
+            memory: Whether to trace memory as well.
+        """
+        self.directory = directory
+        self.memory = memory
+        self.enabled = directory is not None
+        """Whether sessions starting now are profiled."""
+        self._lock = threading.Lock()
+        self._tracing = 0
+        self._started_tracemalloc = False
+        self._open_phases = 0
+        self._phases_started = 0
+
+    def toggle(self):
+        """Turn profiling on or off, returning whether it's now on."""
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='sshed-profiles-')
+        self.enabled = not self.enabled
+        return self.enabled
+
+    def start(self, name):
+        """Start profiling a session, if profiling is on.
+
+        Positional arguments:
+            name: The name of the session.
+
+        Returns:
+            The SessionProfile, to be stopped when the session ends, or None
+            if the session isn't profiled.
+        """
+        if not self.enabled:
+            return None
+        try:
+            return SessionProfile(self, name)
+        except ValueError as error:
+            logging.warning('Not profiling session %s: %s', name, error)
+            return None
+
+    def start_tracing(self):
+        """Start tracemalloc for a session, returning whether it's tracing.
+
+        tracemalloc is stopped again once the last session using it stops,
+        unless something else started it.
+        """
+        with self._lock:
+            if not self._tracing and not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEBACK_FRAMES)
+                self._started_tracemalloc = True
+            self._tracing += 1
+        return True
+
+    def stop_tracing(self):
+        """Note that a session has finished with tracemalloc."""
+        with self._lock:
+            self._tracing -= 1
+            if not self._tracing and self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    def open_phase(self):
+        """Note the start of a traced phase, resetting the peak if it's alone.
+
+        Returns:
+            A token to pass to close_phase when the phase ends.
+        """
+        with self._lock:
+            alone = not self._open_phases
+            if alone:
+                tracemalloc.reset_peak()
+            self._open_phases += 1
+            self._phases_started += 1
+            return alone, self._phases_started
+
+    def close_phase(self, token):
+        """Note the end of a traced phase.
+
+        Positional arguments:
+            token: The token open_phase returned for the phase.
+
+        Returns:
+            A tuple of the process's peak traced memory since the peak was
+            last reset and whether another traced phase overlapped this one.
+        """
+        alone, started = token
+        with self._lock:
+            _, peak = tracemalloc.get_traced_memory()
+            self._open_phases -= 1
+            return peak, not alone or self._phases_started != started
+
+
+def install_toggle(profiler, signum=TOGGLE_SIGNAL):
+    """Make a signal turn a Profiler on or off.
+
+    This must be called from the main thread.
+    """
+    def toggle(*_):
+        """Turn profiling on or off."""
+        if profiler.toggle():
+            logging.warning(
+                'Profiling new sessions. Profiles are written to %s.',
+                profiler.directory)
+        else:
+            logging.warning('Profiling stopped.')
+    signal.signal(signum, toggle)
@@ -0,0 +1,500 @@
+# Session replay for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Replay a captured sshed session, to profile and benchmark it offline.
+
+A session recorded with --capture and --capture-payloads (on either sshed or
+sshed_client) holds the file as it was sent and every save made to it.
+sshed-replay plays one side of that session back against a real instance of
+the other:
+
+- "host" mode runs sshed on a copy of the original file and plays the client,
+  sending it the captured saves. The file sshed is left with is checked
+  against the last save.
+- "client" mode starts an sshed_client and plays the host, sending it the
+  file. The client's EDITOR is a fake editor that writes each captured save
+  in turn, and the host side checks each save it receives, as sshed-loadtest
+  does.
+
+Saves are replayed at the pace they were made (scaled by --speed), or as fast
+as possible with --speed 0. Changes made to the file on the host during the
+captured session aren't replayed. For example, to profile sshed applying a
+user's saves:
+
+    sshed-replay host user.capture --speed 0 --host-arg=--stats
+"""
+
+import argparse
+import io
+import json
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from . import capture, loadtest, metrics, packethandler, sshed, trace
+
+DEFAULT_SPEED = 1.0
+DEFAULT_TIMEOUT = 60
+EDITOR_NAME = 'replay-editor'
+DIRECTORY_VARIABLE = 'REPLAY_DIRECTORY'
+SPEED_VARIABLE = 'REPLAY_SPEED'
+"""The environment variables through which the fake editor is scripted."""
+_EDITOR_SCRIPT = """\
+#!%s
+import sys
+from sshed import replay
+sys.exit(replay.replay_editor())
+"""
+
+
+class CapturedSession(object):  # pylint: disable=too-few-public-methods
+    """An editing session, reconstructed from a capture with payloads."""
+
+    def __init__(self, info, packets):
+        """Initialise a CapturedSession.
+
+        Positional arguments:
+            info: The description of the capture, from capture.read_capture.
+            packets: The captured packets, from capture.read_capture.
+
+        Raises:
+            ValueError: If the capture can't be replayed.
+        """
+        if not info.get('payloads'):
+            raise ValueError(
+                'The capture has no payloads. Record it with '
+                '--capture-payloads to replay it.')
+        to_client = 'sent' if info['side'] == 'host' else 'received'
+        from_host = [
+            packet for packet in packets if packet.direction == to_client]
+        if not from_host:
+            raise ValueError('The capture has no file in it.')
+        self.headers = dict(from_host[0].headers)
+        """The headers with which the file was sent."""
+        if any(self.headers.get(kind) for kind in metrics.SESSION_KINDS):
+            raise ValueError(
+                'Only sessions editing a single file can be replayed.')
+        self.headers.pop('Size', None)
+        contents, sent_at = self._sent_file(from_host)
+        self.saves = [
+            packet for packet in packets
+            if packet.direction != to_client and packet.time >= sent_at and
+            'Resume-Offset' not in packet.headers and
+            'Accepted-Version' not in packet.headers]
+        """The captured save packets, in order."""
+        self.delays = [packet.time - sent_at for packet in self.saves]
+        """The time of each save, in seconds after the file was sent."""
+        self.versions = [contents]
+        """The file as sent, followed by its contents after each save."""
+        for packet in self.saves:
+            self.versions.append(sshed.saved_contents(
+                packet.headers, packet.payload, self.versions[-1]))
+
+    def _sent_file(self, from_host):
+        """Return the file as sent, and the time its sending finished."""
+        if not self.headers.get('Resumable'):
+            return from_host[0].payload, from_host[0].time
+        chunks = []
+        size = 0
+        for packet in from_host[1:]:
+            if packet.headers.get('Offset') != size:
+                raise ValueError(
+                    'The capture has only part of a resumed transfer.')
+            chunks.append(packet.payload)
+            size += packet.size
+            if size >= self.headers['Filesize']:
+                return b''.join(chunks), packet.time
+        raise ValueError('The capture ends before the file was sent.')
+
+
+def load(path):
+    """Read a capture file and return its CapturedSession."""
+    return CapturedSession(*capture.read_capture(path))
+
+
+def _pace(start, delay, speed):
+    """Sleep until delay (scaled by speed) seconds after start, if speed."""
+    if speed:
+        time.sleep(max(0, start + delay / speed - time.perf_counter()))
+
+
+def _wait(process, timeout):
+    """Wait for a process to exit, killing it after timeout seconds.
+
+    Returns:
+        The resource usage of the process, from os.wait4.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            process.returncode = os.waitstatus_to_exitcode(status)
+            return usage
+        if time.monotonic() >= deadline:
+            process.kill()
+            deadline = float('inf')
+        time.sleep(0.01)
+
+
+def _accept(listener, process, timeout):
+    """Accept a connection from a process, unless it exits first.
+
+    Raises:
+        RuntimeError: If the process exits without connecting.
+        TimeoutError: If it doesn't connect within timeout seconds.
+    """
+    deadline = time.monotonic() + timeout
+    listener.settimeout(0.1)
+    while time.monotonic() < deadline:
+        try:
+            connection, _ = listener.accept()
+        except socket.timeout:
+            if process.poll() is not None:
+                raise RuntimeError(
+                    'sshed exited with status %d without connecting.' %
+                    process.returncode)
+            continue
+        connection.setblocking(True)
+        return connection
+    raise TimeoutError('sshed did not connect.')
+
+
+def _usage(usage):
+    """Return a dictionary of the interesting fields of a resource usage."""
+    return dict(
+        user_seconds=usage.ru_utime,
+        system_seconds=usage.ru_stime,
+        max_rss_kb=usage.ru_maxrss)
+
+
+def replay_host(session, speed=DEFAULT_SPEED, host_args=(),
+                timeout=DEFAULT_TIMEOUT):
+    """Replay a session's saves to sshed, playing the client.
+
+    Positional arguments:
+        session: The CapturedSession to replay.
+    Keyword arguments:
+        speed: How many times faster than captured to replay the saves, or
+            0 to send them as fast as possible.
+        host_args: Further command line arguments for sshed.
+        timeout: The longest time in seconds to wait on sshed.
+
+    Returns:
+        A dictionary of the results.
+    """
+    with tempfile.TemporaryDirectory(prefix='replay-') as directory:
+        path = os.path.join(directory, 'file')
+        with open(path, 'wb') as file:
+            file.write(session.versions[0])
+        socket_address = os.path.join(directory, 'socket')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_address)
+        # sshed refuses a socket others could use.
+        os.chmod(socket_address, stat.S_IRUSR | stat.S_IWUSR)
+        listener.listen(1)
+        start = time.perf_counter()
+        host = subprocess.Popen(
+            [sys.executable, '-m', 'sshed.sshed', '-a', socket_address] +
+            list(host_args) + [path],
+            env=loadtest.environment(), stdin=subprocess.DEVNULL)
+        try:
+            connection = _accept(listener, host, timeout)
+            connection.settimeout(timeout)
+            packet_handler = packethandler.PacketHandler(connection)
+            headers = packet_handler.get_headers()
+            if headers.get('Version', 1) >= sshed.PROTOCOL_VERSION:
+                packet_handler.send({'Accepted-Version': headers['Version']})
+            packet_handler.get_data(headers)
+            if headers.get('Resumable'):
+                packet_handler.send({'Resume-Offset': 0})
+                received = 0
+                while received < headers['Filesize']:
+                    _, chunk = packet_handler.get()
+                    received += len(chunk)
+            opened = time.perf_counter()
+            for delay, packet in zip(session.delays, session.saves):
+                _pace(opened, delay, speed)
+                packet_handler.send(dict(packet.headers), packet.payload)
+            sent = time.perf_counter()
+            connection.close()
+        finally:
+            listener.close()
+            usage = _wait(host, timeout)
+        finished = time.perf_counter()
+        with open(path, 'rb') as file:
+            matches = file.read() == session.versions[-1]
+    return dict(
+        mode='host',
+        saves=len(session.saves),
+        open_time=opened - start,
+        save_time=sent - opened,
+        drain_time=finished - sent,
+        duration=finished - start,
+        exit_status=host.returncode,
+        matches=matches,
+        host=_usage(usage))
+
+
+def replay_editor(args=None):
+    """Make a replayed session's saves to a file, then exit like an editor.
+
+    The saves are read from the directory named by DIRECTORY_VARIABLE, and
+    each is written to a temporary file renamed over the original. The time
+    of each save is appended to the log there.
+
+    Keyword arguments:
+        args: The command line arguments, the last being the file to edit.
+            Default: sys.argv[1:]
+    """
+    if args is None:
+        args = sys.argv[1:]
+    path = args[-1]
+    directory = os.environ[DIRECTORY_VARIABLE]
+    speed = float(os.environ.get(SPEED_VARIABLE, DEFAULT_SPEED))
+    with open(os.path.join(directory, 'delays')) as file:
+        delays = [float(delay) for delay in file.read().split()]
+    start = time.perf_counter()
+    with open(os.path.join(directory, 'saves.log'), 'a') as log:
+        for number, delay in enumerate(delays, 1):
+            _pace(start, delay, speed)
+            with open(os.path.join(directory, 'save-%d' % number), 'rb') as (
+                    save):
+                contents = save.read()
+            with open(path + '.new', 'wb') as file:
+                file.write(contents)
+            os.replace(path + '.new', path)
+            log.write('%d %.6f\n' % (number, time.time()))
+            log.flush()
+    return 0
+
+
+class ReplayHost(object):  # pylint: disable=too-few-public-methods
+    """Plays the host side of a captured session against sshed_client."""
+
+    def __init__(self, session, socket_address, timeout=DEFAULT_TIMEOUT):
+        self.session = session
+        self.socket_address = socket_address
+        self.timeout = timeout
+        self.applied = {}
+        """The time each save was applied, by save number."""
+        self.open_time = None
+        """Seconds taken to connect and send the file."""
+        self.unexpected = 0
+        """The number of saves whose contents matched no captured save."""
+        self.error = None
+
+    def run(self):
+        """Send the file and apply saves until sshed_client hangs up."""
+        tracer = trace.Tracer()
+        contents = self.session.versions[0]
+        headers = dict(self.session.headers)
+        if 'Transfer-Id' in headers:
+            # The client may still hold an earlier replay's transfer.
+            headers['Transfer-Id'] = uuid.uuid4().hex
+        start = time.perf_counter()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        packet_handler = packethandler.PacketHandler(connection)
+        try:
+            connection.connect(self.socket_address)
+            connection.settimeout(self.timeout)
+            sshed.send_file(packet_handler, headers, io.BytesIO(contents))
+            self.open_time = time.perf_counter() - start
+            latest = 0
+            while True:
+                saves = sshed.receive_saves(
+                    packet_handler, tracer, packet_handler.get_headers())
+                for save_headers, edited in saves:
+                    contents = sshed.saved_contents(
+                        save_headers, edited, contents)
+                now = time.time()
+                try:
+                    latest = self.session.versions.index(
+                        contents, latest + 1)
+                except ValueError:
+                    self.unexpected += 1
+                    continue
+                self.applied[latest] = now
+        except packethandler.SocketClosedError:
+            pass
+        except (OSError, sshed.ChecksumMismatch, sshed.MalformedDiff) as error:
+            self.error = '%s: %s' % (type(error).__name__, error)
+        finally:
+            connection.close()
+
+
+def _read_log(path):
+    """Return the times of the fake editor's saves, by save number."""
+    saved = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                number, when = line.split()
+                saved[int(number)] = float(when)
+    except FileNotFoundError:
+        pass
+    return saved
+
+
+def replay_client(session, speed=DEFAULT_SPEED, client_args=(),
+                  timeout=DEFAULT_TIMEOUT):
+    """Replay a session to sshed_client, playing the host and the editor.
+
+    Positional arguments:
+        session: The CapturedSession to replay.
+    Keyword arguments:
+        speed: How many times faster than captured to make the saves, or 0
+            to make them as fast as possible.
+        client_args: Further command line arguments for sshed_client.
+        timeout: The longest time in seconds to wait on sshed_client.
+
+    Returns:
+        A dictionary of the results.
+    """
+    directory = tempfile.mkdtemp(prefix='replay-')
+    try:
+        for number, contents in enumerate(session.versions[1:], 1):
+            with open(os.path.join(directory, 'save-%d' % number), 'wb') as (
+                    file):
+                file.write(contents)
+        with open(os.path.join(directory, 'delays'), 'w') as file:
+            file.write(''.join('%f\n' % delay for delay in session.delays))
+        environment = loadtest.environment(
+            EDITOR=loadtest.write_editor(
+                directory, name=EDITOR_NAME, script=_EDITOR_SCRIPT),
+            **{DIRECTORY_VARIABLE: directory, SPEED_VARIABLE: str(speed)})
+        socket_address = os.path.join(directory, 'socket')
+        client = loadtest.start_client(
+            socket_address, environment, client_args)
+        try:
+            host = ReplayHost(session, socket_address, timeout=timeout)
+            thread = threading.Thread(target=host.run, daemon=True)
+            start = time.perf_counter()
+            thread.start()
+            thread.join()
+            duration = time.perf_counter() - start
+        finally:
+            usage = loadtest.stop_client(client)
+        saved = _read_log(os.path.join(directory, 'saves.log'))
+        latencies = [
+            applied - saved[number]
+            for number, applied in host.applied.items() if number in saved]
+        return dict(
+            mode='client',
+            saves=len(session.saves),
+            saves_applied=len(host.applied),
+            saves_coalesced=len(saved) - len(host.applied),
+            saves_unexpected=host.unexpected,
+            open_time=host.open_time,
+            save_latency=loadtest.summarise(latencies),
+            duration=duration,
+            matches=(
+                host.error is None and
+                len(session.versions) - 1 in host.applied),
+            errors=[host.error] if host.error else [],
+            client=usage)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def format_results(results):
+    """Return the results of a replay as human readable text."""
+    lines = ['Replayed %d saves to %s in %.3fs' % (
+        results['saves'], 'sshed' if results['mode'] == 'host'
+        else 'sshed_client', results['duration'])]
+    if results['open_time'] is not None:
+        lines.append('Open: %.1fms' % (1000 * results['open_time']))
+    if results['mode'] == 'host':
+        lines.append(
+            'Saves sent in %.1fms, applied %.1fms after the last' % (
+                1000 * results['save_time'], 1000 * results['drain_time']))
+        lines.append(
+            'sshed: %.2fs user, %.2fs system, %d KB peak RSS, exit status %s'
+            % (results['host']['user_seconds'],
+               results['host']['system_seconds'],
+               results['host']['max_rss_kb'], results['exit_status']))
+    else:
+        lines.append('Saves: %d applied, %d coalesced, %d unexpected' % (
+            results['saves_applied'], results['saves_coalesced'],
+            results['saves_unexpected']))
+        lines.append(loadtest.format_latency(
+            'Save latency', results['save_latency']))
+        lines.extend(loadtest.format_usage(results['client']))
+        for error in results['errors']:
+            lines.append('Error: %s' % error)
+    lines.append('Final file matches the capture: %s' % (
+        'yes' if results['matches'] else 'NO'))
+    return '\n'.join(lines)
+
+
+def parse_arguments(args=None):
+    """Parse the command line arguments and return a namespace."""
+    parser = argparse.ArgumentParser(
+        description='Replay a captured sshed session against sshed or '
+        'sshed_client.')
+    parser.add_argument(
+        'mode', choices=('host', 'client'),
+        help=(
+            '"host" plays the client to sshed; "client" plays the host (and '
+            'the editor) to sshed_client.'))
+    parser.add_argument(
+        'capture', help='A capture recorded with --capture-payloads.')
+    parser.add_argument(
+        '--speed', type=float, default=DEFAULT_SPEED,
+        help=(
+            'Replay this many times faster than captured, or 0 for as fast '
+            'as possible. Default: %s' % DEFAULT_SPEED))
+    parser.add_argument(
+        '--timeout', type=float, default=DEFAULT_TIMEOUT,
+        help=(
+            'Give up on a replay that waits this many seconds. Default: %d' %
+            DEFAULT_TIMEOUT))
+    parser.add_argument(
+        '--host-arg', action='append', default=[], dest='host_args',
+        metavar='ARG',
+        help=(
+            'Pass this argument to sshed in host mode. May be given more '
+            'than once.'))
+    parser.add_argument(
+        '--client-arg', action='append', default=[], dest='client_args',
+        metavar='ARG',
+        help=(
+            'Pass this argument to sshed_client in client mode, e.g. '
+            '"--client-arg=--diff-workers=2". May be given more than once.'))
+    parser.add_argument(
+        '--json', action='store_true', help='Print the results as JSON.')
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    """Entry point for sshed-replay."""
+    args = parse_arguments(args)
+    try:
+        session = load(args.capture)
+    except ValueError as error:
+        print('Cannot replay %s: %s' % (args.capture, error), file=sys.stderr)
+        return 2
+    if args.mode == 'host':
+        results = replay_host(
+            session, speed=args.speed, host_args=args.host_args,
+            timeout=args.timeout)
+    else:
+        results = replay_client(
+            session, speed=args.speed, client_args=args.client_args,
+            timeout=args.timeout)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print(format_results(results))
+    return 0 if results['matches'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
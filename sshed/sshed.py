@@ -5,28 +5,65 @@ Designed to be run as "sshed" on the host side in place of a text editor.
 """
 
 import argparse
+import difflib
+import errno
+import glob
+import io
+import itertools
 import logging
+import mmap
 import os
 import shutil
 import socket
 import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
+import time
 
-from . import packethandler
+from . import (
+    capture, manifest, merge, packethandler, profiling, trace, transfers,
+    tree, view, watch, workdir)
 
 # TODO: Move these into a common library.
 # TODO: Use modes from the stat library.
 USER_ONLY_UMASK = 0o177
 USER_ONLY_DIRECTORY_UMASK = 0o077
 LOGGING_FORMAT = '%(levelname)s: %(message)s'
+DIFF_FORMATS = ('unified', 'ranges')
+"""The formats of differential saves that the host can apply."""
+PROTOCOL_VERSION = 2
+"""The protocol version of sessions that a version 1 sshed_client doesn't
+understand: resumable transfers, prefetching, directories, views, following
+and watching for changes on the host. Other edits are sent as version 1."""
+RETRY_DELAY = 2
+"""The number of seconds to wait before reconnecting to resume a transfer."""
+PREFETCH_NICENESS = 10
+EXTERNAL_SIZE_LIMIT = 16 * 2 ** 20
+"""Files up to this size are watched for changes made on the host."""
+# The most buffers that one call to os.writev can write. Linux's limit is
+# used where the system doesn't say.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+SKIP_BLOCK_SIZE = 2 ** 16
+"""The size of the blocks in which MappedPatcher counts unchanged lines."""
 
 
 def parse_arguments(args=None):
     """Parse the arguments in the script and return an argument namespace."""
     parser = argparse.ArgumentParser()
-    parser.add_argument('file')
+    parser.add_argument('file', nargs='?')
+    parser.add_argument(
+        '--prefetch', nargs='+', metavar='PATH',
+        help=(
+            'Send these files (or directories or glob patterns) to '
+            'sshed_client in the background without editing them, so that '
+            'they open instantly later.'))
     parser.add_argument(
         '-d', '--debug', action='store_const',
         dest='logging_level', const=logging.DEBUG, default=logging.WARNING,
@@ -35,7 +72,77 @@ def parse_arguments(args=None):
         '-a', '--socketaddress',
         dest='socket_address',
         help='Use a specific socket file.')
+    parser.add_argument(
+        '--trace', dest='trace_file',
+        help='Append timed spans for each session phase to this file.')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='Print a summary of the transfers on exit.')
+    parser.add_argument(
+        '--profile', metavar='DIRECTORY',
+        help=(
+            'Run under cProfile, writing the profile to a .pstats file in '
+            'this directory.'))
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help=(
+            'With --profile, also trace memory with tracemalloc, writing a '
+            'snapshot from the peak of each receive and patch phase.'))
+    parser.add_argument(
+        '--capture', metavar='FILE',
+        help=(
+            'Record the headers, sizes and times of the packets sent and '
+            'received in this capture file, for sshed-replay.'))
+    parser.add_argument(
+        '--capture-payloads', action='store_true',
+        help=(
+            'Record the data of each packet in the capture file too, which '
+            'replaying needs. The capture then holds the file being edited.'))
+    parser.add_argument(
+        '--view', action='store_true',
+        help=(
+            "Show the file read-only, without copying all of it to the "
+            "client. For huge files such as logs."))
+    parser.add_argument(
+        '--view-at', type=int, metavar='OFFSET',
+        help=(
+            'With --view, show the part of the file around this byte offset '
+            'rather than its start and end. A negative offset counts from '
+            'the end of the file.'))
+    parser.add_argument(
+        '--follow', action='store_true',
+        help=(
+            'Keep sending data appended to the file to the client until the '
+            'editor exits, like "tail -F".'))
+    directory = parser.add_argument_group(
+        'Directory mode',
+        'Options for editing a whole directory tree.')
+    directory.add_argument(
+        '-r', '--recursive', action='store_true',
+        help='Edit every file in the directory passed instead of one file.')
+    directory.add_argument(
+        '--include', action='append', default=[], metavar='PATTERN',
+        help=(
+            'Only send files whose path (or a component of it) matches this '
+            'glob pattern. May be given more than once.'))
+    directory.add_argument(
+        '--exclude', action='append', default=[], metavar='PATTERN',
+        help=(
+            "Don't send files whose path (or a component of it) matches this "
+            'glob pattern. May be given more than once.'))
+    directory.add_argument(
+        '--max-size', type=int, default=tree.SIZE_LIMIT,
+        help=(
+            'Refuse to send a directory whose files total more than this many '
+            'bytes. Default: %d' % tree.SIZE_LIMIT))
+    parser.add_argument(
+        '--retries', type=int, default=0,
+        help=(
+            'Reconnect this many times to resume a transfer if the connection '
+            'drops while sending a large file. Default: 0'))
     args = parser.parse_args(args=args)
+    if (args.file is None) == (args.prefetch is None):
+        parser.error('Either a file or --prefetch is required, but not both.')
     logging.basicConfig(format=LOGGING_FORMAT, level=args.logging_level)
     return args
 
@@ -123,6 +230,16 @@ class MalformedDiff(Exception):
     pass
 
 
+class ClientTooOld(Exception):
+    """sshed_client didn't accept the protocol version of a session."""
+    pass
+
+
+class ChecksumMismatch(Exception):
+    """A save doesn't produce the file whose checksum was sent with it."""
+    pass
+
+
 # TODO: Refactor this. (Perhaps into a function or group of them?)
 # TODO: This should be in a generic library. It's not tied to sshed at all.
 class Patcher(object):  # pylint: disable=too-few-public-methods
@@ -234,6 +351,189 @@ class Patcher(object):  # pylint: disable=too-few-public-methods
             return output.read()
 
 
+class MappedPatcher(Patcher):  # pylint: disable=too-few-public-methods
+    """A Patcher that copies unchanged parts of the original without lines.
+
+    The original file is memory-mapped and the patch is turned into a list
+    of segments: (offset, length) ranges of the original, and the bytes the
+    diff adds. The output is then written with os.writev, taking the ranges
+    straight from the map, so that no Python object is made for each line
+    the diff leaves alone.
+
+    The whole of the original is patched, wherever its position. Originals
+    that aren't files on disk, or are empty, are patched line by line.
+    """
+
+    def patch(self, output=None):
+        """Patch the original file to the output.
+
+        Named arguments:
+            output: A file to write the output to (which must have a file
+                descriptor) or None.
+
+        Returns:
+            The post-diff file as a single string if output is None
+        """
+        try:
+            descriptor = self.original.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            return self._patch_lines(output)
+        self.original.flush()
+        if not os.fstat(descriptor).st_size:
+            return self._patch_lines(output)
+        if output is None:
+            with tempfile.TemporaryFile() as output:
+                self.patch(output=output)
+                return output.read()
+        with mmap.mmap(descriptor, 0, access=mmap.ACCESS_READ) as mapped:
+            output.seek(0)
+            output_descriptor = output.fileno()
+            with memoryview(mapped) as view:
+                buffers = []
+                for segment in self.segments(mapped):
+                    if isinstance(segment, tuple):
+                        offset, length = segment
+                        segment = view[offset:offset + length]
+                    buffers.append(segment)
+                    if len(buffers) == IOV_MAX:
+                        _write_buffers(output_descriptor, buffers)
+                        buffers = []
+                _write_buffers(output_descriptor, buffers)
+                buffers = segment = None
+        os.ftruncate(
+            output_descriptor, os.lseek(output_descriptor, 0, os.SEEK_CUR))
+        output.seek(0)
+
+    def _patch_lines(self, output):
+        """Patch the original line by line, as Patcher does."""
+        return super().patch(output=output)
+
+    def lines(self):
+        """Return an iterator over the lines of the hunks, headers included."""
+        return itertools.chain.from_iterable(self.hunks)
+
+    def segments(self, mapped):
+        """Yield the segments of the patched file, in order.
+
+        Positional arguments:
+            mapped: The original file, as an mmap.mmap.
+
+        Yields:
+            An (offset, length) tuple for each range of the original that's
+            kept, and a bytes object for each line the diff adds.
+        """
+        # The start of the range of the original being kept.
+        kept = 0
+        position = 0
+        line_number = 1
+        for line in self.lines():
+            if line.startswith(b'@@'):
+                start_line = line.split()[1][1:]
+                if b',' in start_line:
+                    start_line = start_line.split(b',')[0]
+                start_line = int(start_line)
+                if line_number < start_line:
+                    position = _skip_lines(
+                        mapped, position, start_line - line_number)
+                    line_number = start_line
+                continue
+            if line.startswith(b'+'):
+                if position > kept:
+                    yield (kept, position - kept)
+                kept = position
+                yield line[1:]
+                continue
+            if not line.startswith((b'-', b' ')):
+                continue
+            end = mapped.find(b'\n', position) + 1 or len(mapped)
+            original_line = mapped[position:end]
+            line_number += 1
+            if original_line != line[1:]:
+                raise MalformedDiff(
+                    'Line %d of the original does not match the diff.\n'
+                    'Original line: %s'
+                    'Diff line: %s' % (
+                        line_number - 1, original_line, line))
+            if line.startswith(b'-') and position > kept:
+                yield (kept, position - kept)
+            position = end
+            if line.startswith(b'-'):
+                kept = position
+        if len(mapped) > kept:
+            yield (kept, len(mapped) - kept)
+
+
+class StreamingPatcher(MappedPatcher):
+    """A MappedPatcher that reads the diff as it patches.
+
+    The diff may be any iterable of lines, such as a
+    packethandler.PacketReader, and is read a line at a time as the output is
+    written. Only the added lines waiting to be written (at most IOV_MAX of
+    them) are held, however large the diff. It can only be patched once.
+
+    Originals that are patched line by line read the whole diff first.
+    """
+
+    def __init__(self, original, diff):
+        """Initialise a StreamingPatcher.
+
+        Positional arguments:
+            original: The original file, open for reading.
+            diff: An iterable of the lines of a unidiff.
+        """
+        super().__init__(original, [])
+        self.diff = diff
+        """The diff, as an iterable of lines."""
+
+    def _patch_lines(self, output):
+        self.hunks = self._get_hunks(list(self.diff))
+        return super()._patch_lines(output)
+
+    def lines(self):
+        return (
+            line for line in self.diff
+            if not line.startswith((b'---', b'+++')))
+
+
+def _skip_lines(mapped, position, count):
+    """Return the offset of the line count lines on from an offset.
+
+    Lines are counted a block at a time, and only the lines of the last
+    block are found one by one.
+    """
+    while count:
+        block = mapped[position:position + SKIP_BLOCK_SIZE]
+        if not block:
+            break
+        newlines = block.count(b'\n')
+        if newlines < count:
+            count -= newlines
+            position += len(block)
+            continue
+        end = -1
+        for _ in range(count):
+            end = block.find(b'\n', end + 1)
+        return position + end + 1
+    return position
+
+
+def _write_buffers(descriptor, buffers):
+    """Write every buffer to a file descriptor, carrying on after short writes.
+
+    Positional arguments:
+        descriptor: The file descriptor to which to write.
+        buffers: A list of bytes-like objects, at most IOV_MAX long.
+    """
+    first = 0
+    while first < len(buffers):
+        written = os.writev(descriptor, buffers[first:])
+        while first < len(buffers) and written >= len(buffers[first]):
+            written -= len(buffers[first])
+            first += 1
+        if written:
+            buffers[first] = buffers[first][written:]
+
+
 def generate_headers(args):
     """Generate the headers for the file packet to send.
 
@@ -242,12 +542,511 @@ def generate_headers(args):
     Returns:
         A dictionary of the headers.
     """
-    return dict(
+    headers = dict(
         Version=1,
         Filename=os.path.basename(args.file),
         Filesize=os.path.getsize(args.file),
         # TODO: Allow the user to disable differential editing.
-        Differential=True)
+        Differential=True,
+        **{'Diff-Formats': ','.join(DIFF_FORMATS)})
+    if headers['Filesize'] > transfers.RESUMABLE_SIZE:
+        headers['Version'] = PROTOCOL_VERSION
+        headers['Resumable'] = True
+        headers['Transfer-Id'] = transfers.transfer_id(args.file)
+        headers['Chunk-Size'] = transfers.CHUNK_SIZE
+    return headers
+
+
+def version_1_headers(headers):
+    """Return the headers of a file to edit, without version 2 features."""
+    headers = dict(
+        (name, value) for name, value in headers.items()
+        if name not in ('Resumable', 'Transfer-Id', 'Chunk-Size', 'External'))
+    headers['Version'] = 1
+    return headers
+
+
+def await_acceptance(packet_handler, headers):
+    """Wait for sshed_client to accept a session the host has opened.
+
+    sshed_client answers the first packet of a session of PROTOCOL_VERSION
+    or later with an Accepted-Version header, before reading its data. A
+    version 1 sshed_client drops the connection instead. Version 1 sessions
+    aren't answered.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler connected to the
+            client.
+        headers: The headers of the session's first packet, already sent.
+
+    Raises:
+        ClientTooOld: If the client didn't accept the session.
+    """
+    if headers.get('Version', 1) < PROTOCOL_VERSION:
+        return
+    try:
+        reply, _ = packet_handler.get()
+    except packethandler.SocketClosedError:
+        reply = {}
+    if reply.get('Accepted-Version') != headers['Version']:
+        raise ClientTooOld(
+            'sshed_client did not accept protocol version %d. It may need '
+            'updating.' % headers['Version'])
+
+
+def send_file(packet_handler, headers, file):
+    """Send the file to edit to the client.
+
+    Resumable transfers are sent in chunks, starting from wherever the client
+    says an earlier attempt at the same transfer stopped.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler on which to send.
+        headers: The headers from generate_headers.
+        file: The file to edit.
+
+    Raises:
+        ClientTooOld: If the client didn't accept the session.
+    """
+    if not headers.get('Resumable'):
+        packet_handler.send(headers, file)
+        await_acceptance(packet_handler, headers)
+        return
+    packet_handler.send(headers)
+    await_acceptance(packet_handler, headers)
+    reply, _ = packet_handler.get()
+    offset = reply.get('Resume-Offset', 0)
+    if offset:
+        logging.info('Resuming the transfer from byte %d.', offset)
+    transfers.send_chunks(
+        packet_handler, file, offset, headers['Filesize'],
+        chunk_size=headers['Chunk-Size'])
+
+
+def saved_contents(headers, edited, contents):
+    """Return the contents of a file with a save from the client applied.
+
+    The save is applied in memory, leaving the file itself alone.
+
+    Positional arguments:
+        headers: The headers of the save packet.
+        edited: The data of the save packet.
+        contents: The contents of the file before the save, as bytes. Unused
+            (and may be None) if the save sends the whole file.
+
+    Returns:
+        The contents of the file after the save, as bytes.
+
+    Raises:
+        ChecksumMismatch: If the save has a Checksum header that the result
+            doesn't match.
+    """
+    if headers.get('Diff-Format') == 'ranges':
+        saved = io.BytesIO(contents)
+        manifest.apply_range_patch(
+            io.BytesIO(edited), saved, headers['Filesize'])
+        result = saved.getvalue()
+    elif headers.get('Differential') is True:
+        saved = io.BytesIO()
+        Patcher(io.BytesIO(contents), edited.splitlines(keepends=True)).patch(
+            output=saved)
+        result = saved.getvalue()
+    else:
+        result = edited
+    checksum = headers.get('Checksum')
+    if checksum is not None and transfers.checksum(result) != checksum:
+        raise ChecksumMismatch(
+            'The save should have a checksum of %s, but it is %s.' % (
+                checksum, transfers.checksum(result)))
+    return result
+
+
+def copy_extended_attributes(source, destination):
+    """Give a file exactly the extended attributes of another.
+
+    Access control lists and security labels (such as SELinux's) are kept
+    in extended attributes, so this keeps them too.
+
+    Positional arguments:
+        source: The file descriptor of the file to copy from.
+        destination: The file descriptor of the file to copy to.
+
+    Returns:
+        Whether the attributes were copied. They can't be where the system
+        has no extended attribute support in Python, or where setting one
+        isn't allowed.
+    """
+    if not hasattr(os, 'listxattr'):
+        return False
+    try:
+        names = os.listxattr(source)
+    except OSError as error:
+        # A filesystem without extended attributes has none to lose.
+        return error.errno == errno.ENOTSUP
+    try:
+        existing = os.listxattr(destination)
+        for name in existing:
+            if name not in names:
+                os.removexattr(destination, name)
+        for name in names:
+            value = os.getxattr(source, name)
+            if name not in existing or os.getxattr(destination, name) != value:
+                os.setxattr(destination, name, value)
+    except OSError:
+        return False
+    return True
+
+
+class StagedFile(object):
+    """A new version of a file, written beside it and then put in its place.
+
+    The new version is renamed over the file, so it needn't be copied once
+    written. Where renaming would change more than the contents (the file
+    has other hard links, or its owner, group or extended attributes can't
+    be kept), or the file's directory can't be written to, the new version
+    is copied over the file instead.
+    """
+
+    def __init__(self, path):
+        """Initialise a StagedFile, creating the file for the new version.
+
+        Positional arguments:
+            path: The path of the file. Symbolic links are followed, so that
+                it's the file they point to that's replaced.
+        """
+        self.path = os.path.realpath(path)
+        directory, name = os.path.split(self.path)
+        try:
+            self.file = tempfile.NamedTemporaryFile(
+                prefix='.%s.' % name, suffix='.sshed', dir=directory,
+                delete=False)
+            self.renamable = True
+            """Whether the new version is beside the file."""
+        except OSError:
+            self.file = tempfile.NamedTemporaryFile(delete=False)
+            self.renamable = False
+
+    def _rename(self, file_descriptor):
+        """Rename the new version over the file, returning whether it was.
+
+        Positional arguments:
+            file_descriptor: The file descriptor of the file.
+        """
+        try:
+            file_stats = os.fstat(file_descriptor)
+            path_stats = os.stat(self.path)
+            if (path_stats.st_dev, path_stats.st_ino) != (
+                    file_stats.st_dev, file_stats.st_ino):
+                return False
+            if file_stats.st_nlink != 1:
+                return False
+            descriptor = self.file.fileno()
+            os.fchmod(descriptor, stat.S_IMODE(file_stats.st_mode))
+            staged_stats = os.fstat(descriptor)
+            if (staged_stats.st_uid, staged_stats.st_gid) != (
+                    file_stats.st_uid, file_stats.st_gid):
+                os.fchown(descriptor, file_stats.st_uid, file_stats.st_gid)
+            if not copy_extended_attributes(file_descriptor, descriptor):
+                return False
+            self.file.close()
+            os.replace(self.file.name, self.path)
+        except OSError:
+            return False
+        return True
+
+    def reflink(self, file):
+        """Make the new version share the file's data, to change in place.
+
+        Returns:
+            Whether it does. It doesn't if the filesystem doesn't support
+            reflinks, in which case the new version is still empty.
+        """
+        file.flush()
+        return workdir.reflink(file, self.file)
+
+    def copy(self, file):
+        """Make the new version a copy of the file, to change in place.
+
+        The copy is made inside the kernel where the filesystem allows.
+        """
+        file.flush()
+        if not workdir.clone(file, self.file):
+            file.seek(0)
+            shutil.copyfileobj(file, self.file, packethandler.FILE_CHUNK_SIZE)
+        self.file.seek(0)
+
+    def install(self, file):
+        """Put the new version in place of the file.
+
+        Positional arguments:
+            file: The file, open for reading and writing. It's closed if the
+                new version is renamed over it.
+
+        Returns:
+            The file, open for reading and writing, with the new version.
+        """
+        self.file.flush()
+        if self.renamable and self._rename(file.fileno()):
+            file.close()
+            return open(self.path, mode='r+b')
+        logging.debug('Copying the new version over %s.', self.path)
+        self.file.seek(0)
+        file.seek(0)
+        shutil.copyfileobj(self.file, file, packethandler.FILE_CHUNK_SIZE)
+        file.truncate()
+        self.discard()
+        return file
+
+    def discard(self):
+        """Remove the new version, unless it's been put in place."""
+        self.file.close()
+        try:
+            os.remove(self.file.name)
+        except FileNotFoundError:
+            pass
+
+
+def receive_saves(packet_handler, tracer, headers):
+    """Receive a save, along with any others queued up behind it.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler connected to the
+            client.
+        tracer: A trace.Tracer in which to record receiving each save.
+        headers: The headers of the first save, already received.
+
+    Returns:
+        A list of (headers, data) tuples, in the order received.
+    """
+    saves = []
+    while True:
+        differential = headers.get('Differential') is True
+        with tracer.span(
+                'receive', differential=differential,
+                diff_size=headers.get('Size', 0)) as span:
+            edited = packet_handler.get_data(headers)
+            span['received'] = packet_handler.header_size + len(edited)
+            span['raw_size'] = (
+                headers.get('Filesize', len(edited)) if differential
+                else len(edited))
+        saves.append((headers, edited))
+        if not packet_handler.ready():
+            return saves
+        headers = packet_handler.get_headers()
+
+
+def _receive_range_patch(packet_handler, headers, file):
+    """Receive a whole range patch, then apply it to a file in place.
+
+    The patch is spooled first, so a patch that's cut short never reaches
+    the file.
+    """
+    with tempfile.TemporaryFile() as patch:
+        with packet_handler.stream(headers) as reader:
+            shutil.copyfileobj(reader, patch, packethandler.FILE_CHUNK_SIZE)
+        patch.seek(0)
+        manifest.apply_range_patch(patch, file, headers['Filesize'])
+
+
+def receive_save(
+        packet_handler, tracer, headers, original, output, spool=False):
+    """Receive a save, applying it as it arrives.
+
+    A range patch is applied to original in place. A save that sends the
+    whole file is copied into output as it's received, as is the result of
+    a unified diff, which is applied a line at a time.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler connected to the
+            client.
+        tracer: A trace.Tracer in which to record receiving the save.
+        headers: The headers of the save, already received.
+        original: The file as it was before the save, open for reading and
+            writing.
+        output: The file (open for reading and writing) into which to write
+            the result of any other save.
+    Keyword arguments:
+        spool: Whether to receive a whole range patch before applying it,
+            so that one that's cut short never reaches original.
+
+    Returns:
+        Whichever of original and output holds the result.
+
+    Raises:
+        ChecksumMismatch: If the save has a Checksum header that the result
+            doesn't match.
+        MalformedDiff: If the save can't be applied.
+    """
+    differential = headers.get('Differential') is True
+    ranges = headers.get('Diff-Format') == 'ranges'
+    size = headers.get('Size', 0)
+    result = original if ranges else output
+    with tracer.span(
+            'receive', differential=differential, diff_size=size) as span:
+        try:
+            if ranges and spool:
+                logging.debug('Applying a range patch in place.')
+                _receive_range_patch(packet_handler, headers, original)
+            else:
+                with packet_handler.stream(headers) as reader:
+                    if ranges:
+                        logging.debug('Applying a range patch.')
+                        manifest.apply_range_patch(
+                            reader, original, headers['Filesize'])
+                    elif differential:
+                        StreamingPatcher(original, reader).patch(
+                            output=output)
+                    else:
+                        logging.debug('Differential editing disabled.')
+                        output.seek(0)
+                        shutil.copyfileobj(
+                            reader, output, packethandler.FILE_CHUNK_SIZE)
+                        output.truncate()
+        except (ValueError, IndexError) as error:
+            raise MalformedDiff(
+                'The save could not be applied: %s' % error) from error
+        span['received'] = packet_handler.header_size + size
+        span['raw_size'] = (
+            headers.get('Filesize', size) if differential else size)
+    checksum = headers.get('Checksum')
+    if checksum is not None:
+        actual = transfers.file_checksum(result)
+        if actual != checksum:
+            raise ChecksumMismatch(
+                'The save should have a checksum of %s, but it is %s.' % (
+                    checksum, actual))
+    return result
+
+
+def apply_saves(packet_handler, tracer, headers, file):
+    """Apply saves from the client to a file as they're received.
+
+    Saves are cumulative, so any already arriving once one has been applied
+    are applied to its result in turn, and the file is only replaced once.
+    The first result is written to a StagedFile beside the file. Should
+    more saves follow, their results go to two scratch files in the
+    temporary directory, used in turn, and only the last is copied into the
+    StagedFile, so the file's own disk is written at most twice however many
+    saves queue up. A range patch is applied to a reflink of the file where
+    the filesystem supports them, and otherwise to the file in place once
+    it's fully received. Nothing is kept in memory beyond what's
+    being written, whatever the size of the saves.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler connected to the
+            client.
+        tracer: A trace.Tracer in which to record the saves.
+        headers: The headers of the first save, already received.
+        file: The file (open for reading and writing) to update.
+
+    Returns:
+        The file, open for reading and writing, with the saves applied. It's
+        a new file object if the file was replaced.
+
+    Raises:
+        ChecksumMismatch: If any save doesn't match its checksum, in which
+            case that save and those queued behind it are skipped, leaving
+            the file as it was (apart from a range patch applied to it in
+            place before them).
+        MalformedDiff: If any save can't be applied, in which case the same
+            goes.
+    """
+    staged = None
+    scratches = []
+    current = file
+    saves = 0
+    try:
+        while True:
+            if headers.get('Diff-Format') == 'ranges':
+                if current is file and headers.get('Checksum') is not None:
+                    # A checksum can only be checked before installing.
+                    staged = StagedFile(file.name)
+                    staged.copy(file)
+                    current = staged.file
+                elif current is file:
+                    staged = StagedFile(file.name)
+                    if staged.reflink(file):
+                        current = staged.file
+                    else:
+                        staged.discard()
+                        staged = None
+                output = None
+            elif staged is None:
+                staged = StagedFile(file.name)
+                output = staged.file
+            else:
+                if len(scratches) < 2:
+                    scratches.append(tempfile.TemporaryFile())
+                output = next(
+                    scratch for scratch in scratches
+                    if scratch is not current)
+            current = receive_save(
+                packet_handler, tracer, headers, current, output,
+                spool=current is file)
+            saves += 1
+            if not packet_handler.ready():
+                break
+            headers = packet_handler.get_headers()
+        if saves > 1:
+            logging.info('Applied %d queued saves.', saves)
+        if staged is not None:
+            with tracer.span('patch', saves=saves):
+                if current is not staged.file:
+                    current.seek(0)
+                    staged.file.seek(0)
+                    shutil.copyfileobj(
+                        current, staged.file, packethandler.FILE_CHUNK_SIZE)
+                    staged.file.truncate()
+                file = staged.install(file)
+    except (ChecksumMismatch, MalformedDiff):
+        # The saves queued behind build on the one that failed.
+        while packet_handler.ready():
+            with packet_handler.stream(packet_handler.get_headers()):
+                pass
+        raise
+    finally:
+        if staged is not None:
+            staged.discard()
+        for scratch in scratches:
+            scratch.close()
+    return file
+
+
+def send_external_change(packet_handler, baseline, contents):
+    """Send a change made to the file on the host to the client.
+
+    The change is sent as a diff against the baseline, unless the whole file
+    would be shorter (or a diff can't represent the change).
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler on which to send.
+        baseline: The contents the client holds as its baseline, as bytes.
+        contents: The new contents of the file, as bytes.
+    """
+    headers = {
+        'External': True,
+        'Base-Checksum': transfers.checksum(baseline),
+        'Filesize': len(contents),
+        'Differential': False,
+    }
+    data = contents
+    # Patcher can't represent a missing newline at the end of the file.
+    if all(not text or text.endswith(b'\n') for text in (baseline, contents)):
+        diff = b''.join(difflib.diff_bytes(
+            difflib.unified_diff, baseline.splitlines(keepends=True),
+            contents.splitlines(keepends=True)))
+        if len(diff) < len(contents):
+            headers['Differential'] = True
+            data = diff
+    packet_handler.send(headers, data)
+
+
+def _file_state(path):
+    """Return what changes about a file when it's modified or replaced."""
+    file_stats = os.stat(path)
+    return (
+        file_stats.st_dev, file_stats.st_ino, file_stats.st_mtime_ns,
+        file_stats.st_size)
 
 
 def write_differential(edited: bytes, file):
@@ -255,54 +1054,656 @@ def write_differential(edited: bytes, file):
     logging.debug('Differential editing enabled.')
     diff = edited.splitlines(keepends=True)
     logging.debug('Diff:\n%s', diff)
-    patcher = Patcher(file, diff)
+    patcher = MappedPatcher(file, diff)
     logging.debug('Hunks:\n%s', patcher.hunks)
     # TOOD: Handle the original and updated file better.
     with tempfile.NamedTemporaryFile() as output:
         patcher.patch(output=output)
-        output.seek(0)
-        logging.debug('Updated file: %s', output.read())
         file.seek(0)
-        output.seek(0)
-        file.write(output.read())
+        shutil.copyfileobj(output, file, packethandler.FILE_CHUNK_SIZE)
     file.truncate()
 
 
 def main():
     """Entry point for sshed command."""
     args = parse_arguments()
+    tracer = trace.Tracer(
+        args.trace_file, session='host-%d' % os.getpid())
+    args.recorder = None
+    if args.capture:
+        args.recorder = capture.Recorder(
+            args.capture, 'host', payloads=args.capture_payloads)
+    profile = None
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+        profile = profiling.Profiler(
+            args.profile, memory=args.profile_memory).start(tracer.session)
+        tracer.profile = profile
+    try:
+        if args.prefetch:
+            return prefetch(args, tracer)
+        if args.recursive:
+            return edit_directory(args, tracer)
+        if args.view:
+            return view_file(args, tracer)
+        if args.follow:
+            return follow_file(args, tracer)
+        return edit(args, tracer)
+    except ClientTooOld as error:
+        logging.error('%s', error)
+        return 1
+    finally:
+        if profile is not None:
+            profile.stop()
+        if args.recorder is not None:
+            args.recorder.close()
+        if args.stats:
+            print(tracer.format_summary(), file=sys.stderr)
+
+
+def expand_paths(patterns):
+    """Expand glob patterns and directories into a list of files.
+
+    Positional arguments:
+        patterns: An iterable of paths, which may be glob patterns or
+            directories. Directories are searched recursively.
+
+    Returns:
+        A list of the paths of regular files, without duplicates.
+    """
+    paths = []
+    for pattern in patterns:
+        for match in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(match):
+                for directory, subdirectories, files in os.walk(match):
+                    subdirectories.sort()
+                    paths.extend(
+                        os.path.join(directory, name)
+                        for name in sorted(files))
+            else:
+                paths.append(match)
+    seen = set()
+    return [
+        path for path in paths
+        if os.path.isfile(path) and not (path in seen or seen.add(path))]
+
+
+def detach():
+    """Fork a child to carry on in the background.
+
+    The child starts a new session, so that it's out of reach of the
+    terminal's signals, and its standard streams are redirected to
+    /dev/null. It must leave with os._exit rather than returning, so that
+    the parent's cleanup isn't run twice.
+
+    Returns:
+        True in the parent, and False in the child.
+    """
+    if os.fork():
+        return True
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+        os.dup2(devnull, stream.fileno())
+    os.close(devnull)
+    return False
+
+
+def prefetch(args, tracer):
+    """Send the files passed to --prefetch to the client for later.
+
+    Only files big enough to be sent as resumable transfers are sent, as the
+    client can only use a prefetched file to resume a transfer. Once the
+    client has accepted the request, the files are sent by a child process
+    in the background, at a low priority, over a single connection.
+
+    Positional arguments:
+        args: The parsed command line arguments.
+        tracer: A trace.Tracer in which to record the session phases.
+    """
+    socket_file = find_socket(args.socket_address)
+    if not socket_file:
+        return 1
+    paths = []
+    for path in expand_paths(args.prefetch):
+        if os.path.getsize(path) > transfers.RESUMABLE_SIZE:
+            paths.append(path)
+        else:
+            logging.warning(
+                'Not prefetching %s, as files of %d bytes or less are quick '
+                'to send anyway.', path, transfers.RESUMABLE_SIZE)
+    if not paths:
+        logging.warning('No files large enough to prefetch.')
+        return 0
+    with tracer.span('connect'):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_file)
+    packet_handler = packethandler.PacketHandler(
+        client, recorder=args.recorder)
+    transfer_ids = [transfers.transfer_id(path) for path in paths]
+    headers = {'Version': PROTOCOL_VERSION, 'Prefetch': True}
+    packet_handler.send(
+        headers,
+        ''.join('%s\n' % transfer_id for transfer_id in transfer_ids).encode())
+    await_acceptance(packet_handler, headers)
+    _, data = packet_handler.get()
+    held = dict(line.split() for line in data.decode().splitlines())
+    if detach():
+        client.close()
+        logging.info('Prefetching %d files in the background.', len(paths))
+        return 0
+    status = 1
+    try:
+        os.nice(PREFETCH_NICENESS)
+        with tracer.span('prefetch', files=len(paths)) as span:
+            for path, transfer_id in zip(paths, transfer_ids):
+                offset = int(held.get(transfer_id, 0))
+                size = os.path.getsize(path)
+                logging.debug('Prefetching %s from byte %d.', path, offset)
+                packet_handler.send({
+                    'Transfer-Id': transfer_id,
+                    'Filename': os.path.basename(path),
+                    'Filesize': size,
+                    'Resume-Offset': offset,
+                })
+                with open(path, 'rb') as file:
+                    transfers.send_chunks(
+                        packet_handler, file, offset, size)
+            span['sent'] = packet_handler.bytes_sent
+        client.close()
+        status = 0
+    finally:
+        if args.recorder is not None:
+            args.recorder.close()
+        os._exit(status)  # pylint: disable=protected-access
+
 
+def apply_tree_change(root, headers, data, include=(), exclude=()):
+    """Apply a change the client sent to one file of a directory tree.
+
+    Positional arguments:
+        root: The root directory of the tree.
+        headers: The headers of the packet. The 'Path' header gives the path
+            of the file, relative to root.
+        data: The data of the packet.
+    Keyword arguments:
+        include: The include patterns the tree was sent with.
+        exclude: The exclude patterns the tree was sent with.
+
+    Raises:
+        ValueError: If the path is missing or would leave the tree.
+        MalformedDiff: If a diff can't be applied to the file.
+        OSError: If the file can't be read or written.
+    """
+    path = headers.get('Path')
+    if not isinstance(path, str) or not path:
+        raise ValueError('The change has no path.')
+    if not tree.included(path, include, exclude):
+        logging.warning('Ignoring a change to filtered out file %s.', path)
+        return
+    full_path = tree.safe_path(root, path)
+    if headers.get('Deleted'):
+        logging.debug('Removing %s.', path)
+        if os.path.isfile(full_path):
+            os.remove(full_path)
+    elif headers.get('Differential') is True:
+        logging.debug('Patching %s.', path)
+        with open(full_path, mode='r+b') as file:
+            try:
+                write_differential(data, file)
+            except (ValueError, IndexError) as error:
+                raise MalformedDiff(
+                    'The diff could not be applied: %s' % error) from error
+    else:
+        logging.debug('Writing %s.', path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, mode='wb') as file:
+            file.write(data)
+
+
+def edit_directory(args, tracer):
+    """Edit the directory tree passed on the command line.
+
+    The files in the tree that pass the filters are streamed to the client
+    as a tar archive. Changes then come back one file at a time.
+
+    Positional arguments:
+        args: The parsed command line arguments.
+        tracer: A trace.Tracer in which to record the session phases.
+    """
     os.umask(USER_ONLY_UMASK)
+    root = args.file
+    if not os.path.isdir(root):
+        logging.error('%s is not a directory.', root)
+        return 1
+    paths = tree.walk_files(root, args.include, args.exclude)
+    total_size = sum(
+        os.path.getsize(os.path.join(root, path)) for path in paths)
+    if total_size > args.max_size:
+        logging.error(
+            'The files in %s total %d bytes, more than the limit of %d. Use '
+            '--include, --exclude or --max-size.', root, total_size,
+            args.max_size)
+        return 1
     socket_file = find_socket(args.socket_address)
     if not socket_file:
         logging.warning('Using a host side text editor instead.')
-        return subprocess.call(choose_editor() + [args.file])
-    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    client.connect(socket_file)
-    packet_handler = packethandler.PacketHandler(client)
+        return subprocess.call(choose_editor() + [root])
+    with tracer.span('connect'):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_file)
+    packet_handler = packethandler.PacketHandler(
+        client, recorder=args.recorder)
+    headers = {
+        'Version': PROTOCOL_VERSION,
+        'Filename': os.path.basename(os.path.abspath(root)),
+        'Directory': True,
+        'Differential': True,
+    }
+    packet_handler.send(headers)
+    await_acceptance(packet_handler, headers)
+    with tracer.span('send', raw_size=total_size, files=len(paths)) as span:
+        writer = transfers.ChunkWriter(packet_handler)
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            for path in paths:
+                archive.add(
+                    os.path.join(root, path), arcname=path, recursive=False)
+        writer.close()
+        span['sent'] = packet_handler.bytes_sent
+    while True:
+        try:
+            with tracer.span('wait'):
+                headers = packet_handler.get_headers()
+            differential = headers.get('Differential') is True
+            with tracer.span(
+                    'receive', differential=differential,
+                    diff_size=headers.get('Size', 0)) as span:
+                data = packet_handler.get_data(headers)
+                span['received'] = packet_handler.header_size + len(data)
+                span['raw_size'] = (
+                    headers.get('Filesize', len(data)) if differential
+                    else len(data))
+            try:
+                with tracer.span('patch', differential=differential):
+                    apply_tree_change(
+                        root, headers, data, args.include, args.exclude)
+            except (MalformedDiff, OSError) as error:
+                logging.error(
+                    'Ignoring the change to %s: %s', headers.get('Path'),
+                    error)
+        except ValueError as error:
+            logging.error('Ignoring a change: %s', error)
+        except packethandler.SocketClosedError:
+            logging.debug('Socket closed. Exiting.')
+            return 0
 
-    headers = generate_headers(args)
 
-    with open(args.file, mode='r+b') as file:
-        packet_handler.send(headers, file)
+def view_file(args, tracer):
+    """Show the file passed on the command line read-only.
+
+    Only the size of the file and its sparse index are sent up front. The
+    client then requests the ranges it wants.
+
+    Positional arguments:
+        args: The parsed command line arguments.
+        tracer: A trace.Tracer in which to record the session phases.
+    """
+    socket_file = find_socket(args.socket_address)
+    if not socket_file:
+        logging.warning('Using a host side text editor instead.')
+        return subprocess.call(choose_editor() + [args.file])
+    with tracer.span('connect'):
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(socket_file)
+    packet_handler = packethandler.PacketHandler(
+        client, recorder=args.recorder)
+    with open(args.file, mode='rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        with tracer.span('send', raw_size=size) as span:
+            index = view.sparse_index(file, size)
+            headers = {
+                'Version': PROTOCOL_VERSION,
+                'Filename': os.path.basename(args.file),
+                'Filesize': size,
+                'View': True,
+            }
+            if args.view_at is not None:
+                headers['View-Offset'] = (
+                    args.view_at if args.view_at >= 0 else size + args.view_at)
+            packet_handler.send(
+                headers,
+                ''.join('%d\n' % offset for offset in index).encode())
+            await_acceptance(packet_handler, headers)
+            span['sent'] = packet_handler.bytes_sent
         while True:
-            file.seek(0)
             try:
-                logging.debug('Waiting for response from client')
-                headers, edited = packet_handler.get()
-                logging.debug('Headers: %s', headers)
-                if headers.get('Differential') is True:
-                    write_differential(edited, file)
-                else:
-                    logging.debug('Differential editing disabled.')
-                    file.write(edited)
-                    file.truncate()
-                logging.debug('File updated.')
+                headers, _ = packet_handler.get()
             except packethandler.SocketClosedError:
-                # TODO: The socket should be closed nicely.
-                # TODO: Return the editor's exit code (if available).
                 logging.debug('Socket closed. Exiting.')
                 return 0
+            if 'Range-Offset' not in headers:
+                logging.warning(
+                    'Ignoring a packet that is not a range request.')
+                continue
+            with tracer.span(
+                    'range', offset=headers['Range-Offset'],
+                    length=headers['Range-Length']) as span:
+                sent = packet_handler.bytes_sent
+                packet_handler.answer_range(headers, file)
+                span['sent'] = packet_handler.bytes_sent - sent
+
+
+def follow_file(args, tracer):
+    """Send the file passed on the command line, then anything appended.
+
+    After the file is sent, appends are sent as they happen. Appends that
+    arrive close together are sent in one packet. If the file is truncated
+    or replaced (for example by log rotation), the client is told and the
+    new file is followed from its start. This continues until the client
+    closes the socket.
+
+    Positional arguments:
+        args: The parsed command line arguments.
+        tracer: A trace.Tracer in which to record the session phases.
+    """
+    socket_file = find_socket(args.socket_address)
+    if not socket_file:
+        logging.warning('Using a host side text editor instead.')
+        return subprocess.call(choose_editor() + [args.file])
+    watcher = watch.Watcher(args.file)
+    follower = watch.Follower(args.file, open(args.file, mode='rb'), 0)
+    try:
+        headers = generate_headers(args)
+        headers['Version'] = PROTOCOL_VERSION
+        headers['Follow'] = True
+        with tracer.span('connect'):
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(socket_file)
+        packet_handler = packethandler.PacketHandler(
+            client, recorder=args.recorder)
+        with tracer.span('send', raw_size=headers['Filesize']) as span:
+            if headers.get('Resumable'):
+                send_file(packet_handler, headers, follower.file)
+            else:
+                # The file may grow while it's sent, so send exactly
+                # Filesize bytes of it.
+                packet_handler.send(
+                    headers, follower.file.read(headers['Filesize']))
+                await_acceptance(packet_handler, headers)
+            span['sent'] = packet_handler.bytes_sent
+        follower.offset = headers['Filesize']
+        while True:
+            with tracer.span('wait'):
+                readable = watcher.wait(watch.POLL_INTERVAL, [client])
+            if readable:
+                try:
+                    packet_handler.get()
+                except packethandler.SocketClosedError:
+                    logging.debug('Socket closed. Exiting.')
+                    return 0
+                logging.warning('Ignoring a packet from the client.')
+                continue
+            time.sleep(watch.BATCH_DELAY)
+            change = follower.poll(transfers.CHUNK_SIZE)
+            while change is not None:
+                with tracer.span(
+                        'send', change=change.kind,
+                        raw_size=len(change.data)) as span:
+                    sent = packet_handler.bytes_sent
+                    if change.kind == watch.APPENDED:
+                        packet_handler.send(
+                            {'Offset': change.offset}, change.data)
+                    else:
+                        logging.info('%s was %s.', args.file, change.kind)
+                        packet_handler.send({change.kind.title(): True})
+                    span['sent'] = packet_handler.bytes_sent - sent
+                change = follower.poll(transfers.CHUNK_SIZE)
+    except (BrokenPipeError, ConnectionResetError):
+        logging.debug('Socket closed. Exiting.')
+        return 0
+    finally:
+        watcher.close()
+        follower.close()
+
+
+def edit(args, tracer):
+    """Edit the file passed on the command line.
+
+    Positional arguments:
+        args: The parsed command line arguments.
+        tracer: A trace.Tracer in which to record the session phases.
+    """
+    os.umask(USER_ONLY_UMASK)
+    socket_file = find_socket(args.socket_address)
+    if not socket_file:
+        logging.warning('Using a host side text editor instead.')
+        return subprocess.call(choose_editor() + [args.file])
+    headers = generate_headers(args)
+    if headers['Filesize'] <= EXTERNAL_SIZE_LIMIT:
+        headers['Version'] = PROTOCOL_VERSION
+        headers['External'] = True
+
+    with open(args.file, mode='r+b') as file:
+        retries = args.retries
+        while True:
+            try:
+                with tracer.span('connect'):
+                    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    client.connect(socket_file)
+                packet_handler = packethandler.PacketHandler(
+                    client, recorder=args.recorder)
+                with tracer.span(
+                        'send', raw_size=headers['Filesize']) as span:
+                    send_file(packet_handler, headers, file)
+                    span['sent'] = packet_handler.bytes_sent
+                break
+            except ClientTooOld:
+                if headers['Version'] == 1:
+                    raise
+                logging.warning(
+                    'sshed_client only understands protocol version 1. '
+                    'Editing without resumable transfers or watching for '
+                    'changes on the host.')
+                client.close()
+                headers = version_1_headers(headers)
+            except (packethandler.SocketClosedError, OSError):
+                if not headers.get('Resumable') or retries <= 0:
+                    raise
+                retries -= 1
+                logging.warning(
+                    'Connection lost while sending the file. Resuming in %d '
+                    'seconds.', RETRY_DELAY)
+                client.close()
+                time.sleep(RETRY_DELAY)
+        if headers.get('External'):
+            file.seek(0)
+            contents = file.read()
+            file.close()
+            return edit_synced(args, tracer, packet_handler, contents)
+        # Saves may replace the file, leaving this one closed, and open the
+        # new one in its place.
+        try:
+            while True:
+                try:
+                    logging.debug('Waiting for response from client')
+                    with tracer.span('wait'):
+                        headers = packet_handler.get_headers()
+                    logging.debug('Headers: %s', headers)
+                    file = apply_saves(packet_handler, tracer, headers, file)
+                    logging.debug('File updated.')
+                except (ChecksumMismatch, MalformedDiff) as error:
+                    logging.error('%s The file was not updated.', error)
+                except packethandler.SocketClosedError:
+                    # TODO: The socket should be closed nicely.
+                    # TODO: Return the editor's exit code (if available).
+                    logging.debug('Socket closed. Exiting.')
+                    return 0
+        finally:
+            file.close()
+
+
+def _unchanged(path, state):
+    """Return whether a file's state is still as given by _file_state."""
+    try:
+        return _file_state(path) == state
+    except OSError:
+        return False
+
+
+def apply_saves_to_path(packet_handler, tracer, headers, path):
+    """Apply saves with apply_saves and return the file's new contents.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler connected to the
+            client.
+        tracer: A trace.Tracer in which to record the saves.
+        headers: The headers of the first save, already received.
+        path: The path of the file to update.
+
+    Returns:
+        The contents of the file after the saves, as bytes, or None if they
+        weren't applied.
+    """
+    file = open(path, mode='r+b')
+    try:
+        file = apply_saves(packet_handler, tracer, headers, file)
+        logging.debug('File updated.')
+        file.seek(0)
+        return file.read()
+    except (ChecksumMismatch, MalformedDiff) as error:
+        logging.error('%s The file was not updated.', error)
+        return None
+    finally:
+        file.close()
+
+
+def merge_saves(saves, baselines, current):
+    """Merge saves that queued up from the client with the file on the host.
+
+    Each save is applied to the baseline it names, and the result merged
+    with the host's version, which starts as the current file and becomes
+    the result of each merge in turn. A save that doesn't match its checksum
+    is skipped. Each save that is applied becomes the only baseline.
+
+    Positional arguments:
+        saves: A list of (headers, data) tuples, in the order received.
+        baselines: The merge.Baselines the client may have saved against.
+        current: The current contents of the file on the host, as bytes.
+
+    Returns:
+        A tuple of the merged contents to write and the contents of the last
+        save applied, both as bytes.
+    """
+    result = saved = current
+    for headers, edited in saves:
+        base = baselines.get(headers.get('Base-Checksum'))
+        if base is None:
+            logging.warning(
+                'The save was made against an unknown version of the file. '
+                'Applying it to the current one.')
+            base = result
+        try:
+            saved = saved_contents(headers, edited, base)
+        except ChecksumMismatch as error:
+            logging.error('%s The save was skipped.', error)
+            continue
+        if result != base:
+            lines, conflicts = merge.merge3(
+                base.splitlines(keepends=True),
+                saved.splitlines(keepends=True),
+                result.splitlines(keepends=True),
+                prefer_mine=True)
+            if conflicts:
+                logging.warning(
+                    '%d changes made on the host conflicted with the save '
+                    'and were overwritten.', conflicts)
+            result = b''.join(lines)
+        else:
+            result = saved
+        baselines.reset(saved)
+    return result, saved
+
+
+def edit_synced(args, tracer, packet_handler, contents):
+    """Apply saves from the client while watching for changes on the host.
+
+    Changes made to the file on the host are sent to the client as they
+    happen. Each save names (by checksum) the baseline it was made against.
+    While the file hasn't changed on the host since that baseline, saves are
+    applied by apply_saves, as they are without watching. Otherwise the
+    save is merged with those changes in memory rather than overwriting
+    them. Conflicting changes are resolved in favour of the save, and the
+    merged file is then sent back to the client as a change made on the
+    host.
+
+    Positional arguments:
+        args: The parsed command line arguments.
+        tracer: A trace.Tracer in which to record the session phases.
+        packet_handler: The packethandler.PacketHandler connected to the
+            client, after the file has been sent.
+        contents: The contents of the file as sent.
+    """
+    baselines = merge.Baselines(contents)
+    watcher = watch.Watcher(args.file)
+    state = _file_state(args.file)
+    try:
+        while True:
+            with tracer.span('wait'):
+                while not packet_handler.pending():
+                    watcher.wait(watch.POLL_INTERVAL, [packet_handler.socket])
+                    try:
+                        new_state = _file_state(args.file)
+                    except FileNotFoundError:
+                        continue
+                    if new_state == state:
+                        continue
+                    state = new_state
+                    with open(args.file, mode='rb') as file:
+                        contents = file.read()
+                    if contents == baselines.current:
+                        continue
+                    logging.info('%s was changed on the host.', args.file)
+                    with tracer.span(
+                            'external', raw_size=len(contents)) as span:
+                        sent = packet_handler.bytes_sent
+                        send_external_change(
+                            packet_handler, baselines.current, contents)
+                        span['sent'] = packet_handler.bytes_sent - sent
+                    baselines.add(contents)
+            headers = packet_handler.get_headers()
+            if (
+                    _unchanged(args.file, state) and
+                    headers.get('Base-Checksum') in (
+                        None, baselines.current_checksum)):
+                # There's nothing on the host to merge the saves with.
+                saved = apply_saves_to_path(
+                    packet_handler, tracer, headers, args.file)
+                if saved is not None:
+                    baselines.reset(saved)
+                    state = _file_state(args.file)
+                continue
+            saves = receive_saves(packet_handler, tracer, headers)
+            with tracer.span(
+                    'patch', saves=len(saves),
+                    differential=any(
+                        headers.get('Differential') is True
+                        for headers, _ in saves)):
+                with open(args.file, mode='r+b') as file:
+                    current = file.read()
+                    result, saved = merge_saves(saves, baselines, current)
+                    if result != current:
+                        file.seek(0)
+                        file.write(result)
+                        file.truncate()
+            # A merged result differs from the client's copy, so it's sent
+            # back as a change made on the host.
+            state = None if result != saved else _file_state(args.file)
+            logging.debug('File updated.')
+    except packethandler.SocketClosedError:
+        logging.debug('Socket closed. Exiting.')
+        return 0
+    finally:
+        watcher.close()
 
 
 if __name__ == '__main__':
@@ -6,19 +6,29 @@ to be properly set up to allow sshed to function properly.
 """
 
 import argparse
-import difflib
+import contextlib
+import io
+import itertools
 import logging
 import os
 import shutil
 import socketserver
+import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
 import time
 
-from sshed import packethandler, sshed
+from sshed import (
+    capture, diffstate, largefile, linehash, manifest, memory, merge,
+    metrics, packethandler, paralleldiff, profiling, sshed, trace,
+    transfers, tree, view, workdir)
 
 FOUR_MEGS = 4 * 2 ** 20
+LARGE_FILE_THRESHOLD = 64 * 2 ** 20
+TREE_POLL_INTERVAL = 0.5
+FOLLOW_POLL_INTERVAL = 0.1
 
 
 class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
@@ -26,7 +36,44 @@ class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
     By making the server multithreaded, we should be able to simultaneously
     edit multiple files from one or more SSH sessions.
     """
-    pass
+    trace_file = None
+    """The file to which sessions append their trace spans, if any."""
+    large_file_threshold = LARGE_FILE_THRESHOLD
+    """Files at least this many bytes long are edited in large file mode."""
+    diff_pool = None
+    """A paralleldiff.WorkerPool in which to diff large files, or None."""
+    session_ids = itertools.count(1)
+    transfer_store = transfers.TransferStore()
+    """Interrupted and prefetched transfers, kept so they can be resumed."""
+    prefetch_timeout = transfers.PREFETCH_TIMEOUT
+    """The number of seconds to keep a prefetched file."""
+    view_cache_limit = view.CACHE_LIMIT
+    """The most bytes of a viewed file to show."""
+    memory_budget = memory.MemoryBudget()
+    """The memory that sessions' spooled files may use between them."""
+    metrics = metrics.Metrics(memory=memory_budget)
+    """Counters and the sessions in progress, for the admin socket."""
+    working_directories = workdir.WorkingDirectories(size_limit=0)
+    """Where to put the working copies that editors open."""
+    capture_directory = None
+    """The directory in which to write a capture of each session, if any."""
+    capture_payloads = False
+    """Whether captures include the data of each packet."""
+    profiler = profiling.Profiler()
+    """Whether and where to profile sessions."""
+
+    def service_actions(self):
+        self.transfer_store.expire()
+
+    def handle_error(self, request, client_address):
+        if request in self.metrics.cancelled:
+            logging.info('Session cancelled.')
+            return
+        super().handle_error(request, client_address)
+
+    def shutdown_request(self, request):
+        self.metrics.cancelled.discard(request)
+        super().shutdown_request(request)
 
 
 def duplicate_file(original, filetype=tempfile.NamedTemporaryFile, **kwargs):
@@ -50,7 +97,9 @@ def duplicate_file(original, filetype=tempfile.NamedTemporaryFile, **kwargs):
     return copy
 
 
-def wait_until_edit_or_exit(filename, modified_time, process, sleep_time=0.1):
+def wait_until_edit_or_exit(
+        filename, modified_time, process, sleep_time=0.1,
+        packet_handler=None, on_idle=None, idle_time=memory.IDLE_TIME):
     """Wait until a file is edited or a process exits.
 
     Positional arguments:
@@ -59,14 +108,46 @@ def wait_until_edit_or_exit(filename, modified_time, process, sleep_time=0.1):
         process: The process whose termination we're awaiting.
     Keyword arguments:
         sleep_time: Amount of time in seconds to sleep between checks.
+        packet_handler: A packethandler.PacketHandler. If passed, also stop
+            waiting when a packet arrives on it.
+        on_idle: A function to call (once) if still waiting after idle_time.
+        idle_time: The number of seconds after which to call on_idle.
     Returns:
         True if the file is edited; False if the process exits.
     """
+    idle_at = time.monotonic() + idle_time
     while True:
+        if on_idle is not None and time.monotonic() >= idle_at:
+            on_idle()
+            on_idle = None
         if process.poll() is not None:
             return
         if os.path.getmtime(filename) > modified_time:
             return
+        if packet_handler is None:
+            time.sleep(sleep_time)
+        elif packet_handler.pending(sleep_time):
+            return
+
+
+def wait_until_tree_edit_or_exit(
+        root, files, process, sleep_time=TREE_POLL_INTERVAL):
+    """Wait until a file in a directory tree changes or a process exits.
+
+    Positional arguments:
+        root: The root directory of the tree.
+        files: A tree.snapshot of the tree against which to check.
+        process: The process whose termination we're awaiting.
+    Keyword arguments:
+        sleep_time: Amount of time in seconds to sleep between checks.
+    Returns:
+        True if a file changes; False if the process exits.
+    """
+    while True:
+        if process.poll() is not None:
+            return False
+        if tree.snapshot(root) != files:
+            return True
         time.sleep(sleep_time)
 
 
@@ -75,7 +156,7 @@ class SocketRequestHandler(
     """
     A socket request handler. Handles a single file edit request.
     """
-    PROTOCOL_VERSIONS = (1, )
+    PROTOCOL_VERSIONS = (1, 2)
     """Accepted (known) protocol versions.
 
     A more detailed description of protocol versions is found in the PROTOCOL.md
@@ -84,6 +165,55 @@ class SocketRequestHandler(
 
     def setup(self):
         packethandler.PacketHandler.__init__(self, self.request)
+        # pylint: disable=attribute-defined-outside-init
+        self.session_id = next(self.server.session_ids)
+        self.tracer = trace.Tracer(
+            self.server.trace_file,
+            session='client-%d-%d' % (os.getpid(), self.session_id),
+            listener=self.server.metrics)
+        if self.server.capture_directory is not None:
+            self.recorder = capture.Recorder(
+                capture.capture_path(
+                    self.server.capture_directory, self.tracer.session),
+                'client', payloads=self.server.capture_payloads)
+        self.server.metrics.open_session(self.session_id, self)
+        self.tracer.profile = self.server.profiler.start(self.tracer.session)
+
+    def finish(self):
+        self.server.metrics.close_session(self.session_id)
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.tracer.profile is not None:
+            self.tracer.profile.stop()
+
+    def spooled_file(self):
+        """Return a new spooled file that keeps to the server's budget."""
+        return memory.SpooledFile(
+            self.server.memory_budget, max_size=FOUR_MEGS)
+
+    def working_copy(self, headers):
+        """Return a new workdir.WorkingCopy for the file a request edits."""
+        return workdir.WorkingCopy(
+            headers['Filename'],
+            directory=self.server.working_directories.directory_for(
+                headers.get('Filesize', 0)))
+
+    def snapshot(self, file):
+        """Return a copy of a file against which to compare later saves.
+
+        The copy is made by the kernel if it can be (see workdir.snapshot),
+        and is otherwise a spooled file that keeps to the server's budget.
+        Files in RAM are always copied into a spooled file, as a copy made
+        by the kernel would take the same amount of RAM again, unbudgeted.
+        """
+        copy = None
+        if not self.server.working_directories.holds(file.name):
+            copy = workdir.snapshot(file)
+        if copy is None:
+            copy = duplicate_file(
+                file, filetype=memory.SpooledFile,
+                budget=self.server.memory_budget, max_size=FOUR_MEGS)
+        return copy
 
     def simple_respond(self, original_name, editing_name):
         """Generate a response replying with the entire file.
@@ -103,82 +233,625 @@ class SocketRequestHandler(
 
     def handle(self):
         """Handle the socket request."""
-        original = tempfile.SpooledTemporaryFile(max_size=FOUR_MEGS)
-        headers = self.get(data_file=original)
+        with self.tracer.span('receive') as span:
+            try:
+                headers = self.get_headers()
+                self.server.metrics.describe_session(self.session_id, headers)
+                if (
+                        headers.get('Version') in self.PROTOCOL_VERSIONS and
+                        headers['Version'] >= sshed.PROTOCOL_VERSION):
+                    self.send({'Accepted-Version': headers['Version']})
+                # A file to edit goes straight into the editor's working copy.
+                if (
+                        headers.get('Version') in self.PROTOCOL_VERSIONS and
+                        not any(
+                            headers.get(kind)
+                            for kind in metrics.SESSION_KINDS)):
+                    original = self.working_copy(headers)
+                else:
+                    original = self.spooled_file()
+                self.get_data(headers, data_file=original)
+            except packethandler.SocketClosedError:
+                # edssh connects without sending anything to check that
+                # sshed_client is still running.
+                logging.debug('Connection closed without a request.')
+                return
+            span['raw_size'] = headers.get('Filesize', 0)
+            if (
+                    headers.get('Resumable') and
+                    headers.get('Version') in self.PROTOCOL_VERSIONS):
+                original = self.receive_chunks(headers, original)
+            span['received'] = self.bytes_received
         if headers.get('Version') not in self.PROTOCOL_VERSIONS:
             logging.error('Unknown protocol version. Dropping connection.')
             logging.error('Protocol version requested: %s', headers['Version'])
             return
+        if original is None:
+            return
+        if headers.get('Prefetch'):
+            original.seek(0)
+            transfer_ids = original.read().decode('utf-8').split()
+            original.close()
+            with self.tracer.span('prefetch') as span:
+                self.receive_prefetch(transfer_ids)
+                span['received'] = self.bytes_received
+            return
         # pylint: disable=attribute-defined-outside-init
         self.version = headers.get('Version')
         self.differential = headers.get('Differential')
         # pylint: enable=attribute-defined-outside-init
-        editing = duplicate_file(
-            original, prefix=headers['Filename'], delete=False)
-        editing.close()
+        if headers.get('Directory'):
+            original.close()
+            self.edit_directory(headers)
+            return
+        if headers.get('View'):
+            self.view(headers, original)
+            return
+        if headers.get('Follow'):
+            self.follow(headers, original)
+            return
+        working = original
         logging.debug('File to edit: %s', headers['Filename'])
-        logging.debug('Text editor will open: %s', editing.name)
+        logging.debug('Text editor will open: %s', working.name)
+        large = headers.get('Filesize', 0) >= self.server.large_file_threshold
+        if large:
+            logging.debug('Editing in large file mode.')
+            original_run = None
+        diff_state = None
+        ranges = 'ranges' in str(headers.get('Diff-Formats', '')).split(',')
+        external = headers.get('External') and not large
+        block_manifest = working.manifest()
+        original = self.snapshot(working.file)
+        working.release()
         editor = sshed.choose_editor()
         logging.debug('Text editor: %s', editor)
-        last_modified = os.path.getmtime(editing.name)
-        editor = subprocess.Popen(editor + [editing.name])
+        last_modified = os.path.getmtime(working.name)
+        with self.tracer.span('editor_launch'):
+            editor = subprocess.Popen(editor + [working.name])
+
+        def spill():
+            """Free the memory the session holds while it's idle."""
+            nonlocal diff_state
+            logging.debug('Session idle. Moving its copy of the file to disk.')
+            if hasattr(original, 'rollover'):
+                original.rollover()
+            diff_state = None
 
         repeat = True
         while repeat:
-            wait_until_edit_or_exit(editing.name, last_modified, editor)
-            if last_modified >= os.path.getmtime(editing.name):
-                break
-            last_modified = os.path.getmtime(editing.name)
-            with open(editing.name, 'rb') as editing:
-                temporary_file = duplicate_file(
-                    editing, filetype=tempfile.SpooledTemporaryFile,
-                    max_size=FOUR_MEGS)
-            original.seek(0)
-            original_lines = original.readlines()
-            edited_lines = temporary_file.readlines()
-            if original_lines == edited_lines:
+            with self.tracer.span('edit'):
+                wait_until_edit_or_exit(
+                    working.name, last_modified, editor,
+                    packet_handler=self if external else None,
+                    on_idle=spill)
+            if last_modified >= os.path.getmtime(working.name):
+                if not (external and self.pending()):
+                    break
+                try:
+                    original, unsent = self.receive_external(
+                        original, working.name)
+                except packethandler.SocketClosedError:
+                    logging.warning('The host closed the connection.')
+                    external = False
+                    continue
+                block_manifest = manifest.BlockManifest.from_file(original)
+                diff_state = None
+                if not unsent:
+                    last_modified = os.path.getmtime(working.name)
                 continue
-            logging.debug('File has changed.')
-            logging.debug('New file: %s', edited_lines)
-            # TODO: differential editing
+            last_modified = os.path.getmtime(working.name)
+            save_headers = {}
+            if external:
+                original.seek(0)
+                save_headers['Base-Checksum'] = transfers.checksum(
+                    original.read())
+            with open(working.name, 'rb') as editing:
+                digests, size = block_manifest.scan(editing)
+                if block_manifest.matches(digests, size):
+                    continue
+                logging.debug('File has changed.')
+                if self.differential and ranges and self.send_ranges(
+                        original, editing,
+                        block_manifest.changed_blocks(digests), size,
+                        headers=save_headers):
+                    block_manifest.update(digests, size)
+                    if large:
+                        original_run = None
+                    diff_state = None
+                    continue
+                # Copy the same open file that was scanned, so the copy
+                # matches the digests even if the editor saves again.
+                temporary_file = self.snapshot(editing)
+            block_manifest.update(digests, size)
+            if large:
+                original_run = self.send_large(
+                    original, original_run, temporary_file)
+                original = temporary_file
+                continue
+            edited_lines = linehash.Lines(temporary_file.read())
+            if self.differential and diff_state is None:
+                original.seek(0)
+                diff_state = diffstate.DiffState(
+                    linehash.Lines(original.read()))
             if (
                     not self.differential or
-                    not self.send_diff(original_lines, edited_lines)):
-                self.send({'Differential': 'False'}, temporary_file)
+                    not self.send_diff(
+                        diff_state, edited_lines, headers=save_headers)):
+                with self.tracer.span('send', differential=False) as span:
+                    sent = self.bytes_sent
+                    self.send(
+                        dict(save_headers, Differential='False'),
+                        temporary_file)
+                    span['raw_size'] = span['diff_size'] = size
+                    span['sent'] = self.bytes_sent - sent
+            if diff_state is not None:
+                # Index the new baseline now, not while the next save waits.
+                diff_state.update(edited_lines)
             original = temporary_file
-        os.remove(editing.name)
+        working.close()
+
+    def receive_external(self, original, editing_name):
+        """Receive a change made to the file on the host and merge it in.
+
+        The change becomes the new baseline. It's merged into the working
+        copy with a three-way merge, so that any local changes not yet sent
+        are kept. Conflicting changes are marked as in git.
+
+        A change made against a baseline other than ours is dropped: it
+        crossed a save in flight, and the host will send the change again
+        against that save once it's merged it.
+
+        Positional arguments:
+            original: A file-like object containing the baseline.
+            editing_name: The path of the working copy.
+
+        Returns:
+            A tuple of a file-like object containing the new baseline and
+            whether the working copy now holds local changes that merged
+            cleanly but haven't been sent yet.
+        """
+        with self.tracer.span('external') as span:
+            received = self.bytes_received
+            headers, data = self.get()
+            span['received'] = self.bytes_received - received
+            span['raw_size'] = headers.get('Filesize', len(data))
+        if not headers.get('External'):
+            logging.warning('Ignoring an unexpected packet from the host.')
+            return original, False
+        original.seek(0)
+        base = original.read()
+        if headers.get('Base-Checksum') != transfers.checksum(base):
+            logging.debug('Dropping a change made against an older save.')
+            return original, False
+        if headers.get('Differential') is True:
+            theirs = sshed.Patcher(
+                io.BytesIO(base), data.splitlines(keepends=True)).patch()
+        else:
+            theirs = data
+        with open(editing_name, 'rb') as editing:
+            mine = editing.read()
+        lines, conflicts = merge.merge3(
+            base.splitlines(keepends=True), mine.splitlines(keepends=True),
+            theirs.splitlines(keepends=True))
+        merged = b''.join(lines)
+        if conflicts:
+            logging.warning(
+                '%d changes made on the host conflict with local changes.',
+                conflicts)
+        if merged != mine:
+            logging.debug('Merging changes from the host into the file.')
+            with open(editing_name, 'wb') as editing:
+                editing.write(merged)
+        original.close()
+        original = self.spooled_file()
+        original.write(theirs)
+        original.seek(0)
+        return original, merged != theirs and not conflicts
+
+    def view(self, headers, index_file):
+        """Show a file read-only, fetching only as much of it as the limit.
+
+        The editor opens once everything it will show has been fetched. Of a
+        file larger than the limit, only the part around the offset the host
+        names is shown, or else its start and end. Each part left out is
+        marked by a line saying so.
+
+        Positional arguments:
+            headers: The headers of the packet that started the session.
+            index_file: A file containing the sparse index sent by the host.
+        """
+        index_file.seek(0)
+        index = [int(offset) for offset in index_file.read().split()]
+        index_file.close()
+        descriptor, path = tempfile.mkstemp(prefix=headers['Filename'] + '-')
+        with os.fdopen(descriptor, 'wb') as local:
+            with self.tracer.span(
+                    'receive', raw_size=headers['Filesize']) as span:
+                omitted = view.write_excerpt(
+                    local, headers['Filesize'], index, self.request_range,
+                    limit=self.server.view_cache_limit,
+                    offset=headers.get('View-Offset'))
+                span['received'] = self.bytes_received
+        if omitted:
+            logging.info(
+                'Leaving %d bytes of %s out.', omitted, headers['Filename'])
+        os.chmod(path, stat.S_IRUSR)
+        editor = sshed.choose_editor()
+        logging.debug('Text editor will open: %s', path)
+        with self.tracer.span('editor_launch'):
+            editor = subprocess.Popen(editor + [path])
+        with self.tracer.span('edit'):
+            editor.wait()
+        os.remove(path)
+
+    def follow(self, headers, original):
+        """Show a file read-only, appending data as the host sends it.
+
+        When the host says the file was truncated or rotated, what's already
+        been received is kept and the new file is appended after it, as
+        "tail -F" does.
+
+        Positional arguments:
+            headers: The headers of the packet that started the session.
+            original: A file containing the file as it was when sent.
+        """
+        following = duplicate_file(
+            original, prefix=headers['Filename'], delete=False)
+        following.close()
+        original.close()
+        path = following.name
+        with open(path, 'ab') as local:
+            os.chmod(path, stat.S_IRUSR)
+            editor = sshed.choose_editor()
+            logging.debug('Text editor will open: %s', path)
+            with self.tracer.span('editor_launch'):
+                editor = subprocess.Popen(editor + [path])
+            offset = headers['Filesize']
+            with self.tracer.span('edit'):
+                while editor.poll() is None:
+                    if not self.pending(FOLLOW_POLL_INTERVAL):
+                        continue
+                    try:
+                        headers, data = self.get()
+                    except packethandler.SocketClosedError:
+                        logging.warning('The host stopped following the file.')
+                        break
+                    if headers.get('Truncated') or headers.get('Rotated'):
+                        logging.debug('The file was truncated or rotated.')
+                        offset = 0
+                        continue
+                    if headers.get('Offset') != offset:
+                        logging.warning(
+                            'Expected data at offset %d but received it at '
+                            '%s.', offset, headers.get('Offset'))
+                    local.write(data)
+                    local.flush()
+                    offset = headers.get('Offset', offset) + len(data)
+                editor.wait()
+        os.remove(path)
+
+    def edit_directory(self, headers):
+        """Edit a directory tree streamed from the host as a tar archive.
+
+        The whole tree is watched for changes, and each file that changes is
+        sent back on its own, as a diff where possible.
+
+        Positional arguments:
+            headers: The headers of the packet that started the session.
+        """
+        root = tempfile.mkdtemp(prefix=headers['Filename'] + '-')
+        reader = transfers.ChunkReader(self)
+        with self.tracer.span('receive') as span:
+            try:
+                with tarfile.open(fileobj=reader, mode='r|') as archive:
+                    tree.extract(archive, root)
+                reader.read()
+            except (ValueError, tarfile.TarError) as error:
+                logging.error('Unable to receive the directory: %s', error)
+                shutil.rmtree(root)
+                return
+            span['received'] = self.bytes_received
+        originals = {}
+        for path in tree.walk_files(root):
+            with open(os.path.join(root, path), 'rb') as file:
+                originals[path] = file.read()
+        files = tree.snapshot(root)
+        editor = sshed.choose_editor()
+        logging.debug('Text editor will open: %s', root)
+        with self.tracer.span('editor_launch'):
+            editor = subprocess.Popen(editor + [root])
+        edited = True
+        while edited:
+            with self.tracer.span('edit'):
+                edited = wait_until_tree_edit_or_exit(root, files, editor)
+            new_files = tree.snapshot(root)
+            for path in tree.changed_paths(files, new_files):
+                self.send_tree_change(root, path, originals)
+            files = new_files
+        shutil.rmtree(root)
+
+    def send_tree_change(self, root, path, originals):
+        """Send a changed file of a directory tree to the host.
+
+        Positional arguments:
+            root: The root directory of the tree.
+            path: The path of the file that changed, relative to root.
+            originals: A dictionary mapping each path to the contents last
+                sent for it. It's updated with the new contents.
+        """
+        full_path = os.path.join(root, *path.split('/'))
+        if not os.path.isfile(full_path):
+            logging.debug('%s was removed.', path)
+            originals.pop(path, None)
+            self.send({'Path': path, 'Deleted': True})
+            return
+        with open(full_path, 'rb') as file:
+            edited = file.read()
+        original = originals.get(path)
+        originals[path] = edited
+        logging.debug('%s has changed.', path)
+        if self.differential and original is not None and self.send_diff(
+                diffstate.DiffState(linehash.Lines(original)),
+                linehash.Lines(edited), headers={'Path': path}):
+            return
+        with self.tracer.span(
+                'send', differential=False, raw_size=len(edited),
+                diff_size=len(edited)) as span:
+            sent = self.bytes_sent
+            self.send({'Differential': 'False', 'Path': path}, edited)
+            span['sent'] = self.bytes_sent - sent
 
-    def send_diff(self, original, edited):
+    def receive_chunks(self, headers, original):
+        """Receive a file sent in chunks, resuming an interrupted transfer.
+
+        Positional arguments:
+            headers: The headers of the packet that started the transfer.
+            original: The (empty) file into which the packet was received.
+                If it's a workdir.WorkingCopy, the transfer is received
+                straight into it.
+
+        Returns:
+            A file-like object containing the file, or None if the transfer
+            was interrupted. An interrupted transfer is kept in the server's
+            transfer store so that it can be resumed.
+        """
+        transfer_id = headers['Transfer-Id']
+        if isinstance(original, workdir.WorkingCopy):
+            partial = self.server.transfer_store.claim(
+                transfer_id, file=original)
+            if isinstance(partial.file, workdir.WorkingCopy):
+                if partial.file is not original:
+                    original.close()
+            else:
+                # Prefetched transfers are held in spooled files.
+                partial.file.seek(0)
+                shutil.copyfileobj(partial.file, original)
+                partial.file.close()
+                partial.file = original
+        else:
+            original.close()
+            partial = self.server.transfer_store.claim(transfer_id)
+        if partial.size:
+            logging.debug(
+                'Resuming transfer %s from byte %d.', transfer_id,
+                partial.size)
+        try:
+            self.send({'Resume-Offset': partial.size})
+            if self.receive_into(partial, headers['Filesize']):
+                partial.file.seek(0)
+                return partial.file
+        except (packethandler.SocketClosedError, ConnectionError):
+            logging.warning(
+                'Connection lost after %d of %d bytes. Keeping them to resume '
+                'the transfer.', partial.size, headers['Filesize'])
+        self.server.transfer_store.suspend(transfer_id, partial)
+        return None
+
+    def receive_into(self, partial, size):
+        """Receive chunk packets until a transfer is complete.
+
+        Positional arguments:
+            partial: The transfers.PartialTransfer to which to add chunks.
+            size: The size of the complete file.
+
+        Returns:
+            True if the transfer is complete, or False if a chunk was corrupt.
+        """
+        while partial.size < size:
+            headers, chunk = self.get()
+            if (
+                    headers.get('Offset') != partial.size or
+                    headers.get('Checksum') != transfers.checksum(chunk)):
+                logging.error('Received a corrupt chunk. Dropping it.')
+                return False
+            partial.write(chunk)
+        return True
+
+    def receive_prefetch(self, transfer_ids):
+        """Receive prefetched files into the transfer store.
+
+        The host is told how much of each file is already held, and then
+        streams the rest of each file in turn until it closes the socket.
+
+        Positional arguments:
+            transfer_ids: The IDs of the transfers the host will send.
+        """
+        store = self.server.transfer_store
+        held = [
+            '%s %d\n' % (transfer_id, store.held(transfer_id))
+            for transfer_id in transfer_ids if store.held(transfer_id)]
+        self.send({}, ''.join(held).encode('utf-8'))
+        while True:
+            try:
+                headers, _ = self.get()
+            except packethandler.SocketClosedError:
+                return
+            transfer_id = headers['Transfer-Id']
+            logging.debug('Prefetching %s.', headers.get('Filename'))
+            partial = store.claim(transfer_id)
+            try:
+                complete = self.receive_into(partial, headers['Filesize'])
+            except (packethandler.SocketClosedError, ConnectionError):
+                complete = False
+            store.suspend(
+                transfer_id, partial, timeout=self.server.prefetch_timeout)
+            if not complete:
+                return
+
+    def send_ranges(self, original, edited, blocks, size, headers=None):
+        """Send the changed byte ranges of a save as a range patch.
+
+        Only the changed blocks of each file are read. If the patch is sent,
+        it is also applied to original so that it matches edited.
+
+        Positional arguments:
+            original: A file-like object containing the previous save.
+            edited: A file-like object containing the new save.
+            blocks: The indices of the blocks that changed.
+            size: The size of edited.
+        Keyword arguments:
+            headers: Any extra headers to send with the patch.
+
+        Returns:
+            Whether the patch was sent. It isn't sent if it would be too big a
+            fraction of the file to be worthwhile.
+        """
+        with self.tracer.span('diff', raw_size=size) as span:
+            patch = self.spooled_file()
+            patch_size = manifest.write_range_patch(
+                manifest.changed_ranges(original, edited, blocks), patch,
+                limit=size * manifest.RANGE_PATCH_RATIO)
+            span['diff_size'] = patch_size
+        if patch_size is None:
+            logging.debug('Range patch is too large. Not sending it.')
+            patch.close()
+            return False
+        headers = dict(
+            headers or {},
+            Differential=True,
+            Filesize=size,
+            **{'Diff-Format': 'ranges'})
+        with self.tracer.span(
+                'send', differential=True, raw_size=size,
+                diff_size=patch_size) as span:
+            sent = self.bytes_sent
+            self.send(headers, patch)
+            span['sent'] = self.bytes_sent - sent
+        patch.seek(0)
+        manifest.apply_range_patch(patch, original, size)
+        patch.close()
+        return True
+
+    def send_large(self, original, original_run, edited):
+        """Send a save of a large file, as a diff if possible.
+
+        Neither file is ever held in memory. The diff is generated from line
+        hashes spilled to disk and is itself spooled to disk if large. If the
+        server has a pool of diff workers, the diff is generated by
+        paralleldiff instead, which memory-maps both files.
+
+        Positional arguments:
+            original: A file-like object containing the previous save.
+            original_run: The largefile.LineHashRun of original, or None if
+                it hasn't been built yet.
+            edited: A file-like object containing the new save.
+
+        Returns:
+            The LineHashRun of edited (or None if it wasn't built), to be
+            passed as original_run with the next save.
+        """
+        edited_run = None
+        edited_size = largefile.file_size(edited)
+        if self.differential:
+            with self.tracer.span('diff', raw_size=edited_size) as span:
+                if self.server.diff_pool is not None:
+                    opcodes, original_lines, edited_lines = (
+                        paralleldiff.diff_files(
+                            self.server.diff_pool, original, edited))
+                else:
+                    if original_run is None:
+                        original_run = largefile.LineHashRun(original)
+                    edited_run = largefile.LineHashRun(edited)
+                    opcodes = largefile.diff_opcodes(original_run, edited_run)
+                    original_lines, edited_lines = original_run, edited_run
+                diff = diff_size = None
+                groups = list(largefile.group_opcodes(opcodes))
+                if not largefile.equal_lines_match(
+                        opcodes, original_lines, edited_lines):
+                    logging.debug(
+                        'Different lines have the same hash. Sending file.')
+                elif not largefile.expressible(
+                        groups, original_lines, edited_lines):
+                    logging.debug(
+                        'Diff cannot express the change. Sending file.')
+                else:
+                    diff = self.spooled_file()
+                    diff_size = largefile.write_unified_diff(
+                        groups, original_lines, edited_lines, diff)
+                span['diff_size'] = diff_size
+            original_lines.close()
+            if edited_run is None:
+                edited_lines.close()
+            if diff is not None and diff_size <= edited_size:
+                headers = dict(Differential=True, Filesize=edited_size)
+                with self.tracer.span(
+                        'send', differential=True, raw_size=edited_size,
+                        diff_size=diff_size) as span:
+                    sent = self.bytes_sent
+                    self.send(headers, diff)
+                    span['sent'] = self.bytes_sent - sent
+                diff.close()
+                return edited_run
+            if diff is not None:
+                diff.close()
+        with self.tracer.span(
+                'send', differential=False, raw_size=edited_size,
+                diff_size=edited_size) as span:
+            sent = self.bytes_sent
+            self.send({'Differential': 'False'}, edited)
+            span['sent'] = self.bytes_sent - sent
+        return edited_run
+
+    def send_diff(self, original, edited, headers=None):
         """Differential-aware file sender.
 
         NOTE: send_diff will always generate a diff, but may send the file
         without a diff if that ends up being shorter.
 
         Positional arguments:
-            original: An array of bytes objects, each containing a line.
-            edited: Like original, but for the edited file.
+            original: A diffstate.DiffState holding the original lines. It
+                isn't updated.
+            edited: The edited file, as a linehash.Lines.
+        Keyword arguments:
+            headers: Any extra headers to send with the diff.
         """
-        original_strings = [line.decode() for line in original]
-        edited_strings = [line.decode() for line in edited]
-        edited_length = sum([len(line) for line in edited])
-        diff = difflib.unified_diff(original_strings, edited_strings)
-        logging.debug('Diff object: %s', diff)
-        diff_list = list(diff)
-        logging.debug('Diff list: %s', diff_list)
-        diff_bytes = ''.join(diff_list).encode('utf-8')
+        with self.tracer.span('diff') as span:
+            edited_length = len(edited.data)
+            diff = io.BytesIO()
+            diff_size = original.write_diff(edited, diff)
+            diff_bytes = diff.getvalue()
+            span['raw_size'] = edited_length
+            span['diff_size'] = len(diff_bytes)
         logging.debug('Diff bytes: %s', diff_bytes)
-        logging.debug('Generated diff:\n%s', diff_bytes.decode())
+        if diff_size is None:
+            logging.debug('Diff cannot express the change. Sending file.')
+            return False
         if len(diff_bytes) > edited_length:
             logging.debug(
                 'Diff is longer than edited file. Sending file instead.')
             return False
         else:
             headers = dict(
+                headers or {},
                 Differential=True,
-                Filesize=edited_length
-                # TODO: Add checksum of edited here.
-            )
-            self.send(headers, diff_bytes)
+                Filesize=edited_length,
+                Checksum=transfers.checksum(edited.data))
+            with self.tracer.span(
+                    'send', differential=True, raw_size=edited_length,
+                    diff_size=len(diff_bytes)) as span:
+                sent = self.bytes_sent
+                self.send(headers, diff_bytes)
+                span['sent'] = self.bytes_sent - sent
         return True
 
 
@@ -266,6 +939,73 @@ def parse_arguments(args=None):
         '-a', '--socketaddress',
         dest='socket_address',
         help='Give the socket a specific filename.')
+    parser.add_argument(
+        '--trace', dest='trace_file',
+        help='Append timed spans for each session phase to this file.')
+    parser.add_argument(
+        '--profile', metavar='DIRECTORY',
+        help=(
+            'Run each session under cProfile, writing a .pstats file per '
+            'session to this directory. SIGUSR1 turns this on and off; if '
+            'it is turned on without this option, a new temporary directory '
+            'is used.'))
+    parser.add_argument(
+        '--profile-memory', action='store_true',
+        help=(
+            'When profiling, also trace memory with tracemalloc, writing a '
+            'snapshot from the peak of each receive and diff phase.'))
+    parser.add_argument(
+        '--capture', dest='capture_directory', metavar='DIRECTORY',
+        help=(
+            "Record the headers, sizes and times of each session's packets "
+            'in a capture file in this directory, for sshed-replay.'))
+    parser.add_argument(
+        '--capture-payloads', action='store_true',
+        help=(
+            'Record the data of each packet in the capture files too, which '
+            'replaying needs. The captures then hold the files being edited.'))
+    parser.add_argument(
+        '--large-file-threshold', type=int, default=LARGE_FILE_THRESHOLD,
+        help=(
+            'Edit files of at least this many bytes in large file mode, which '
+            'uses a fixed amount of memory. Default: %d' %
+            LARGE_FILE_THRESHOLD))
+    parser.add_argument(
+        '--diff-workers', type=int, default=0,
+        help=(
+            'Diff files in large file mode across this many processes. Uses '
+            'more memory than diffing in one process. Linux only, as the '
+            'processes open the files through /proc. Default: one process'))
+    parser.add_argument(
+        '--resume-timeout', type=int, default=transfers.RESUME_TIMEOUT,
+        help=(
+            'Keep the data of an interrupted transfer for this many seconds '
+            'so that it can be resumed. Default: %d' %
+            transfers.RESUME_TIMEOUT))
+    parser.add_argument(
+        '--prefetch-timeout', type=int, default=transfers.PREFETCH_TIMEOUT,
+        help=(
+            'Keep files prefetched with "sshed --prefetch" for this many '
+            'seconds. Default: %d' % transfers.PREFETCH_TIMEOUT))
+    parser.add_argument(
+        '--memory-budget', type=int, default=memory.BUDGET,
+        help=(
+            'Keep at most this many bytes of the files being edited in '
+            'memory across all sessions, spilling the rest to disk. '
+            'Default: %d' % memory.BUDGET))
+    parser.add_argument(
+        '--ram-file-limit', type=int, default=workdir.SIZE_LIMIT,
+        help=(
+            'Put working copies of files up to this many bytes on a '
+            'RAM-backed filesystem ($XDG_RUNTIME_DIR or /dev/shm) if there is '
+            'one. 0 keeps them all in the default temporary directory. '
+            'Default: %d' % workdir.SIZE_LIMIT))
+    parser.add_argument(
+        '--view-cache-limit', type=int, default=view.CACHE_LIMIT,
+        help=(
+            'Show at most this many bytes of a file opened with "sshed '
+            '--view", leaving out the rest of larger files. Default: %d' %
+            view.CACHE_LIMIT))
     args = parser.parse_args(args=args)
     if not args.shell:
         args.shell = os.path.basename(os.environ.get('SHELL', '')) or 'bash'
@@ -281,14 +1021,49 @@ def main(args=None):
     sshed_dir = tempfile.TemporaryDirectory(prefix='sshed-')
     os.umask(sshed.USER_ONLY_UMASK)
     socket_address = args.socket_address or (sshed_dir.name + '/socket')
-    socket_var = EnvironmentVarible('SSHED_SOCK', socket_address)
-    print(socket_var.generate(args.shell))
     server = SocketServer(socket_address, SocketRequestHandler)
+    # Having bound the main socket, any admin socket beside it is stale.
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(metrics.admin_address(socket_address))
+    admin_server = metrics.AdminServer(
+        metrics.admin_address(socket_address), server.metrics)
+    admin_server.serve_in_background()
+    # The socket is listening now, so whatever reads this can connect.
+    socket_var = EnvironmentVarible('SSHED_SOCK', socket_address)
+    print(socket_var.generate(args.shell), flush=True)
+    server.trace_file = args.trace_file
+    server.capture_directory = args.capture_directory
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    server.profiler = profiling.Profiler(
+        args.profile, memory=args.profile_memory)
+    profiling.install_toggle(server.profiler)
+    server.capture_payloads = args.capture_payloads
+    server.memory_budget = memory.MemoryBudget(args.memory_budget)
+    server.metrics.memory = server.memory_budget
+    server.working_directories = workdir.WorkingDirectories(
+        size_limit=args.ram_file_limit)
+    server.large_file_threshold = args.large_file_threshold
+    if args.diff_workers > 1 and not paralleldiff.SUPPORTED:
+        logging.warning(
+            '--diff-workers needs Linux\'s /proc. Diffing in one process.')
+    elif args.diff_workers > 1:
+        server.diff_pool = paralleldiff.WorkerPool(args.diff_workers)
+    server.transfer_store = transfers.TransferStore(
+        timeout=args.resume_timeout, spool_size=FOUR_MEGS,
+        budget=server.memory_budget)
+    server.prefetch_timeout = args.prefetch_timeout
+    server.view_cache_limit = args.view_cache_limit
     logging.debug('Socket opened at %s. Serving requests.', socket_address)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         os.remove(socket_address)
+        os.remove(metrics.admin_address(socket_address))
+        server.working_directories.cleanup()
+    finally:
+        if server.diff_pool is not None:
+            server.diff_pool.close()
 
 
 if __name__ == '__main__':
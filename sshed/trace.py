@@ -0,0 +1,118 @@
+# Session tracing for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Timed spans for the phases of an sshed session.
+
+Each span records how long a phase (e.g. the initial transfer, launching the
+editor or patching a save) took, along with any byte counts attached to it.
+Spans are kept in memory for a summary and optionally appended to a file as
+JSON lines, one span per line.
+"""
+
+import contextlib
+import json
+import threading
+import time
+
+_WRITE_LOCK = threading.Lock()
+
+
+class Tracer(object):
+    """Records timed spans for one session."""
+
+    def __init__(self, path=None, session=None, listener=None):
+        """Initialise a Tracer.
+
+        Named arguments:
+            path: The file to which to append spans as JSON lines, or None to
+                only keep them in memory.
+            session: An identifier for the session, included in every span.
+            listener: An object (such as a metrics.Metrics) whose record
+                method is called with each finished span.
+        """
+        self.path = path
+        self.session = session
+        self.listener = listener
+        self.spans = []
+        """Every span recorded so far, as a list of dictionaries."""
+        self.profile = None
+        """The session's profiling.SessionProfile, if it's being profiled."""
+
+    @contextlib.contextmanager
+    def span(self, name, **counts):
+        """Time the body of a with statement as a span.
+
+        Yields a dictionary to which byte counts may be added while the span
+        is running.
+
+        Positional arguments:
+            name: The name of the session phase.
+        Keyword arguments:
+            Any extra fields (usually byte counts) to include in the span.
+        """
+        span = dict(session=self.session, span=name, start=time.time())
+        span.update(counts)
+        if self.profile is not None:
+            self.profile.start_phase(name)
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            span['duration'] = time.perf_counter() - start
+            if self.profile is not None:
+                self.profile.end_phase(name, span)
+            self.record(span)
+
+    def record(self, span):
+        """Keep a finished span and write it to the trace file, if any."""
+        self.spans.append(span)
+        if self.listener is not None:
+            self.listener.record(span)
+        if self.path is None:
+            return
+        line = json.dumps(span, sort_keys=True) + '\n'
+        with _WRITE_LOCK:
+            with open(self.path, 'a') as file:
+                file.write(line)
+
+    def summary(self):
+        """Summarise the saves recorded in this session.
+
+        Returns:
+            A dictionary of totals. 'raw' is the total size of the saved files,
+            'transferred' is the number of bytes that actually crossed the
+            socket for those saves and 'saved' is the difference.
+        """
+        saves = [span for span in self.spans if span['span'] == 'receive']
+        raw = sum(span.get('raw_size', 0) for span in saves)
+        transferred = sum(span.get('received', 0) for span in saves)
+        differential = len([span for span in saves if span.get('differential')])
+        return dict(
+            saves=len(saves),
+            differential=differential,
+            raw=raw,
+            transferred=transferred,
+            saved=raw - transferred,
+            time=dict(
+                (name, sum(
+                    span['duration'] for span in self.spans
+                    if span['span'] == name))
+                for name in sorted(set(span['span'] for span in self.spans))))
+
+    def format_summary(self):
+        """Return the summary as human readable text."""
+        summary = self.summary()
+        lines = [
+            'Saves: %d (%d differential)' % (
+                summary['saves'], summary['differential']),
+            'Saved file size: %d bytes' % summary['raw'],
+            'Bytes transferred: %d bytes' % summary['transferred'],
+        ]
+        if summary['raw']:
+            lines.append('Saved by differential mode: %d bytes (%.1f%%)' % (
+                summary['saved'], 100 * summary['saved'] / summary['raw']))
+        else:
+            lines.append('Saved by differential mode: 0 bytes')
+        for name, duration in summary['time'].items():
+            lines.append('Time in %s: %.3fs' % (name, duration))
+        return '\n'.join(lines)
@@ -0,0 +1,269 @@
+# Resumable transfers for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Checksummed, resumable transfers of the file being edited.
+
+Large files are sent from the host as a series of chunks, each carrying its
+offset and a checksum. The client keeps the chunks it has verified, so that if
+the connection drops, the host can reconnect and carry on from where the
+transfer stopped rather than from the beginning. Prefetched files are kept the
+same way, as transfers that only need resuming from their end.
+"""
+
+import hashlib
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from . import memory
+
+RESUMABLE_SIZE = 2 ** 16
+"""Files larger than this (64 KiB) are sent as resumable transfers.
+
+This is well below CHUNK_SIZE. A file of up to one chunk is sent in a single
+chunk, so an interrupted transfer of it starts again from the beginning, but
+it's still checksummed and can be prefetched (which only files above this
+size are).
+"""
+CHUNK_SIZE = 4 * 2 ** 20
+"""The largest number of bytes sent in each chunk of a transfer."""
+RESUME_TIMEOUT = 600
+"""The number of seconds a client keeps an interrupted transfer."""
+PREFETCH_TIMEOUT = 3600
+"""The number of seconds a client keeps a prefetched file."""
+
+
+def transfer_id(path):
+    """Return an ID for transferring the current version of a file.
+
+    The ID changes if the file is modified, so a transfer is never resumed
+    with data from an older version of the file.
+    """
+    file_stats = os.stat(path)
+    key = '%s\0%s\0%d\0%d' % (
+        socket.gethostname(), os.path.realpath(path), file_stats.st_size,
+        file_stats.st_mtime_ns)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def checksum(data):
+    """Return the checksum of data, as used in Checksum headers."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_checksum(file):
+    """Return the checksum of a file's contents, read from its start."""
+    file.seek(0)
+    digest = hashlib.sha256()
+    chunk = file.read(CHUNK_SIZE)
+    while chunk:
+        digest.update(chunk)
+        chunk = file.read(CHUNK_SIZE)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def send_chunks(packet_handler, file, offset, size, chunk_size=CHUNK_SIZE):
+    """Send a file from an offset as a series of chunk packets.
+
+    Positional arguments:
+        packet_handler: The packethandler.PacketHandler on which to send.
+        file: The binary file to send.
+        offset: The offset at which to start.
+        size: The size of the file.
+    Keyword arguments:
+        chunk_size: The number of bytes to send in each chunk.
+    """
+    file.seek(offset)
+    while offset < size:
+        chunk = file.read(min(chunk_size, size - offset))
+        if not chunk:
+            raise EOFError('File shrank while it was being sent.')
+        packet_handler.send(
+            {'Offset': offset, 'Checksum': checksum(chunk)}, chunk)
+        offset += len(chunk)
+
+
+class ChunkWriter(object):
+    """A writable file-like object that sends its data as chunk packets.
+
+    This is for streams whose size isn't known in advance. Once closed, a
+    final packet with a 'Final' header marks the end of the stream.
+    """
+
+    def __init__(self, packet_handler, chunk_size=CHUNK_SIZE):
+        self.packet_handler = packet_handler
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.offset = 0
+        """The number of bytes sent so far."""
+
+    def write(self, data):
+        """Buffer data, sending a chunk whenever enough is buffered."""
+        self.buffer += data
+        while len(self.buffer) >= self.chunk_size:
+            self._send(self.chunk_size)
+        return len(data)
+
+    def _send(self, size):
+        """Send the first size bytes of the buffer as a chunk."""
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.packet_handler.send(
+            {'Offset': self.offset, 'Checksum': checksum(chunk)}, chunk)
+        self.offset += len(chunk)
+
+    def close(self):
+        """Send any buffered data, followed by the final packet."""
+        if self.buffer:
+            self._send(len(self.buffer))
+        self.packet_handler.send({'Offset': self.offset, 'Final': True})
+
+
+class ChunkReader(object):  # pylint: disable=too-few-public-methods
+    """A readable file-like object reading the stream sent by a ChunkWriter.
+
+    Raises:
+        ValueError: From read, if a chunk is out of order or corrupt.
+    """
+
+    def __init__(self, packet_handler):
+        self.packet_handler = packet_handler
+        self.buffer = b''
+        self.position = 0
+        self.offset = 0
+        """The number of bytes received so far."""
+        self.finished = False
+        """Whether the final packet has been received."""
+
+    def read(self, size=-1):
+        """Read up to size bytes, or until the end of the stream."""
+        while not self.finished and (
+                size < 0 or len(self.buffer) - self.position < size):
+            headers, chunk = self.packet_handler.get()
+            if headers.get('Offset') != self.offset:
+                raise ValueError('Received a chunk out of order.')
+            if headers.get('Final'):
+                self.finished = True
+                break
+            if headers.get('Checksum') != checksum(chunk):
+                raise ValueError('Received a corrupt chunk.')
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+            self.offset += len(chunk)
+        if size < 0:
+            size = len(self.buffer) - self.position
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+class PartialTransfer(object):  # pylint: disable=too-few-public-methods
+    """The data received so far for a transfer."""
+
+    def __init__(self, spool_size, budget=None, file=None):
+        """Initialise a PartialTransfer.
+
+        Positional arguments:
+            spool_size: The size above which the data is spooled to disk.
+        Named arguments:
+            budget: A memory.MemoryBudget to which the data in memory must
+                also keep, if any.
+            file: The (empty) file into which to receive the data, if not a
+                new spooled file.
+        """
+        if file is not None:
+            self.file = file
+        elif budget is None:
+            self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        else:
+            self.file = memory.SpooledFile(budget, max_size=spool_size)
+        """The received data."""
+        self.size = 0
+        """The number of bytes received and verified."""
+        self.expires = None
+        """When (by time.monotonic) to discard an interrupted transfer."""
+
+    def write(self, data):
+        """Append verified data to the transfer."""
+        self.file.seek(self.size)
+        self.file.write(data)
+        self.size += len(data)
+
+
+class TransferStore(object):
+    """Keeps interrupted transfers until they are resumed or expire."""
+
+    def __init__(
+            self, timeout=RESUME_TIMEOUT, spool_size=CHUNK_SIZE, budget=None):
+        """Initialise a TransferStore.
+
+        Named arguments:
+            timeout: The number of seconds to keep an interrupted transfer.
+            spool_size: The size above which transfers are spooled to disk.
+            budget: A memory.MemoryBudget to which transfers held in memory
+                must also keep, if any.
+        """
+        self.timeout = timeout
+        self.spool_size = spool_size
+        self.budget = budget
+        self._transfers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._transfers)
+
+    def claim(self, transfer_id, file=None):
+        """Take an interrupted transfer to resume, or start a new one.
+
+        A claimed transfer is removed from the store, so it can't be resumed
+        by two connections at once.
+
+        Named arguments:
+            file: The (empty) file into which to receive a new transfer, if
+                not a new spooled file. A resumed transfer keeps its own.
+        """
+        self.expire()
+        with self._lock:
+            partial = self._transfers.pop(transfer_id, None)
+        if partial is None:
+            return PartialTransfer(
+                self.spool_size, budget=self.budget, file=file)
+        partial.expires = None
+        return partial
+
+    def held(self, transfer_id):
+        """Return the number of bytes held for a transfer (0 if none)."""
+        with self._lock:
+            partial = self._transfers.get(transfer_id)
+        return partial.size if partial is not None else 0
+
+    def suspend(self, transfer_id, partial, timeout=None):
+        """Keep a transfer until it is resumed or expires.
+
+        A suspended transfer is idle until it's claimed, so it's moved to disk
+        to free the memory it held (unless it's already in a file).
+
+        Named arguments:
+            timeout: The number of seconds to keep the transfer, if not the
+                store's timeout.
+        """
+        if hasattr(partial.file, 'rollover'):
+            partial.file.rollover()
+        if timeout is None:
+            timeout = self.timeout
+        partial.expires = time.monotonic() + timeout
+        with self._lock:
+            self._transfers[transfer_id] = partial
+
+    def expire(self):
+        """Discard the interrupted transfers that have expired."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                transfer_id for transfer_id, partial in self._transfers.items()
+                if partial.expires <= now]
+            for transfer_id in expired:
+                self._transfers.pop(transfer_id).file.close()
@@ -0,0 +1,128 @@
+# Directory trees for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Helpers for editing a whole directory tree.
+
+Paths within a tree are always relative to its root and use '/' as the
+separator, both on the wire and in snapshots.
+"""
+
+import fnmatch
+import os
+import posixpath
+import tarfile
+
+SIZE_LIMIT = 64 * 2 ** 20
+"""The default limit on the total size of the files in a tree."""
+EDITOR_FILES = ('*.swp', '*.swo', '*.swx', '*~', '.#*', '#*#', '4913')
+"""Patterns for the swap, backup and lock files editors keep beside the files
+they edit (4913 is the file Vim creates to test that it may write to a
+directory). They're never sent in either direction."""
+
+
+def _matches(path, pattern):
+    """Return whether a path, or any of its components, matches a pattern."""
+    return fnmatch.fnmatchcase(path, pattern) or any(
+        fnmatch.fnmatchcase(part, pattern) for part in path.split('/'))
+
+
+def included(path, include=(), exclude=()):
+    """Return whether a path passes include and exclude filters.
+
+    A path is included if it matches any of the include patterns (or there
+    are none) and none of the exclude patterns. A pattern matches if it
+    matches the whole path or any one of its components, so "--exclude .git"
+    excludes everything in a .git directory. Editor files (EDITOR_FILES) are
+    always excluded.
+
+    Positional arguments:
+        path: The path relative to the root of the tree.
+    Keyword arguments:
+        include: A list of glob patterns.
+        exclude: A list of glob patterns.
+    """
+    if include and not any(_matches(path, pattern) for pattern in include):
+        return False
+    return not any(
+        _matches(path, pattern) for pattern in EDITOR_FILES + tuple(exclude))
+
+
+def walk_files(root, include=(), exclude=()):
+    """Return the paths of the regular files in a tree that pass filters.
+
+    Symbolic links aren't followed or included.
+
+    Returns:
+        A sorted list of paths relative to root.
+    """
+    paths = []
+    for directory, _, files in os.walk(root):
+        for name in files:
+            full_path = os.path.join(directory, name)
+            if os.path.islink(full_path) or not os.path.isfile(full_path):
+                continue
+            path = os.path.relpath(full_path, root).replace(os.sep, '/')
+            if included(path, include, exclude):
+                paths.append(path)
+    return sorted(paths)
+
+
+def snapshot(root):
+    """Return the modification time and size of every file in a tree.
+
+    Returns:
+        A dictionary mapping paths relative to root to (mtime_ns, size).
+    """
+    files = {}
+    for path in walk_files(root):
+        file_stats = os.stat(os.path.join(root, path))
+        files[path] = (file_stats.st_mtime_ns, file_stats.st_size)
+    return files
+
+
+def changed_paths(before, after):
+    """Return the paths that differ between two snapshots, sorted."""
+    return sorted(
+        path for path in set(before) | set(after)
+        if before.get(path) != after.get(path))
+
+
+def safe_path(root, path):
+    """Return the full path of a file in a tree, refusing to leave the tree.
+
+    Raises:
+        ValueError: If path is absolute, contains '..' or resolves (through
+            symbolic links) to somewhere outside root.
+    """
+    if (
+            not path or posixpath.isabs(path) or
+            '..' in path.split('/') or '\0' in path):
+        raise ValueError('Unsafe path in tree: %r' % path)
+    full_path = os.path.join(root, *path.split('/'))
+    real_root = os.path.realpath(root)
+    if not os.path.realpath(full_path).startswith(real_root + os.sep):
+        raise ValueError('Path leaves the tree: %r' % path)
+    return full_path
+
+
+def extract(archive, root):
+    """Extract the regular files and directories of a streamed tar archive.
+
+    Any other kind of member (links, devices and so on) is skipped, as is
+    any member whose name would put it outside root.
+
+    Positional arguments:
+        archive: A tarfile.TarFile opened in streaming mode.
+        root: The directory into which to extract it.
+    """
+    options = {}
+    if hasattr(tarfile, 'data_filter'):
+        options['filter'] = 'data'
+    for member in archive:
+        if not (member.isfile() or member.isdir()):
+            continue
+        try:
+            safe_path(root, member.name)
+        except ValueError:
+            continue
+        archive.extract(member, root, set_attrs=False, **options)
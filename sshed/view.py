@@ -0,0 +1,155 @@
+# Read-only view mode for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Viewing huge files without copying all of them.
+
+The host sends only the size of the file and a sparse index: the offset of
+the first line starting in each block of the file. The client then fetches
+whole blocks (which always start and end on line boundaries) into a local
+excerpt of the file, and only opens the editor once it's all arrived, so
+everything the editor shows is really in the file. A file within the limit
+is fetched whole. By default a larger one is shown as the blocks at its
+start and its end, each up to about half the limit. Given an offset, the
+blocks around it are shown instead, so any part of the file can be viewed.
+A line stands in for each part left out, saying how much it was.
+"""
+
+import bisect
+import logging
+
+BLOCK_SIZE = 2 ** 20
+"""The approximate size of a block in the sparse index."""
+FETCH_BLOCKS = 4
+"""The number of blocks fetched with each range request."""
+CACHE_LIMIT = 16 * 2 ** 20
+"""The default limit on the number of bytes of a file shown.
+
+It's kept small so that the editor opens quickly. Other parts of a larger
+file are viewed by passing an offset (sshed's --view-at).
+"""
+OMITTED = (
+    b'[sshed: %d bytes of the file are not shown here. Use "sshed --view-at '
+    b'OFFSET" to see them.]\n')
+"""The line put in place of each part of a file too large to show whole."""
+
+
+def sparse_index(file, size, block_size=BLOCK_SIZE):
+    """Return the offset of the first line starting in each block of a file.
+
+    Only the start of each block is read, so this takes the same time
+    whatever the size of the file. A block without a line starting in it is
+    merged into the one before.
+
+    Positional arguments:
+        file: A seekable binary file.
+        size: The size of the file.
+    Keyword arguments:
+        block_size: The size of each block.
+
+    Returns:
+        A list of offsets, starting with 0.
+    """
+    offsets = [0]
+    for start in range(block_size, size, block_size):
+        if start < offsets[-1]:
+            continue
+        file.seek(start - 1)
+        line = file.readline(block_size + 1)
+        if not line.endswith(b'\n'):
+            continue
+        offset = start - 1 + len(line)
+        if offsets[-1] < offset < size:
+            offsets.append(offset)
+    return offsets
+
+
+def excerpt_blocks(bounds, limit, offset=None):
+    """Choose the blocks of a file to show, keeping within a limit.
+
+    At least one block is shown, whatever its size: the one holding the
+    offset, or else the first and last blocks.
+
+    Positional arguments:
+        bounds: The offsets at which each block starts, followed by the size
+            of the file.
+        limit: The most bytes to show.
+    Keyword arguments:
+        offset: The offset in the file to show the blocks around, or None to
+            show its start and end.
+
+    Returns:
+        A list of (first, stop) tuples, each a run of blocks to show from
+        block first up to (but not including) block stop, in order.
+    """
+    blocks = len(bounds) - 1
+    if bounds[-1] <= limit or blocks == 1:
+        return [(0, blocks)]
+    if offset is not None:
+        block = bisect.bisect_right(bounds, offset) - 1
+        first = min(max(block, 0), blocks - 1)
+        stop = first + 1
+        grown = True
+        while grown:
+            grown = False
+            if stop < blocks and bounds[stop + 1] - bounds[first] <= limit:
+                stop += 1
+                grown = True
+            if first > 0 and bounds[stop] - bounds[first - 1] <= limit:
+                first -= 1
+                grown = True
+        return [(first, stop)]
+    head = 1
+    while head < blocks - 1 and bounds[head + 1] <= limit // 2:
+        head += 1
+    tail = blocks - 1
+    room = limit - bounds[head]
+    while tail > head and bounds[-1] - bounds[tail - 1] <= room:
+        tail -= 1
+    return [(0, head), (tail, blocks)]
+
+
+def _copy_blocks(file, bounds, first, stop, fetch):
+    """Fetch blocks first up to (but not including) stop and write them."""
+    for start in range(first, stop, FETCH_BLOCKS):
+        offset = bounds[start]
+        length = bounds[min(start + FETCH_BLOCKS, stop)] - offset
+        if not length:
+            continue
+        logging.debug('Fetching %d bytes at offset %d.', length, offset)
+        data = fetch(offset, length)
+        if len(data) != length:
+            raise ValueError('Received %d bytes of a range of %d.' % (
+                len(data), length))
+        file.write(data)
+
+
+def write_excerpt(file, size, index, fetch, limit=CACHE_LIMIT, offset=None):
+    """Fetch as much of a remote file as the limit allows, and write it.
+
+    Positional arguments:
+        file: The binary file (open for writing) to which to write.
+        size: The size of the remote file.
+        index: The sparse index of the remote file.
+        fetch: A function taking an offset and a length and returning that
+            range of the remote file as bytes.
+    Keyword arguments:
+        limit: The most bytes of the remote file to write.
+        offset: The offset in the remote file to show the part around, or
+            None to show its start and end.
+
+    Returns:
+        The number of bytes of the file left out.
+    """
+    bounds = list(index) + [size]
+    omitted = 0
+    shown = 0
+    for first, stop in excerpt_blocks(bounds, limit, offset=offset):
+        if bounds[first] > shown:
+            file.write(OMITTED % (bounds[first] - shown))
+            omitted += bounds[first] - shown
+        _copy_blocks(file, bounds, first, stop, fetch)
+        shown = bounds[stop]
+    if shown < size:
+        file.write(OMITTED % (size - shown))
+        omitted += size - shown
+    return omitted
@@ -0,0 +1,190 @@
+# File watching for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""Following a growing file, like "tail -F".
+
+A Watcher waits for something to change in the directory containing a file,
+using inotify where it's available and falling back to polling elsewhere. A
+Follower then works out what happened to the file: data was appended, it was
+truncated, or it was replaced by a new file (as happens when logs rotate).
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+
+POLL_INTERVAL = 1
+"""The number of seconds between checks when inotify isn't available."""
+BATCH_DELAY = 0.1
+"""The number of seconds to wait after a change for more to arrive."""
+
+APPENDED = 'appended'
+TRUNCATED = 'truncated'
+ROTATED = 'rotated'
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_IN_MODIFY = 0x002
+_IN_ATTRIB = 0x004
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = (
+    _IN_MODIFY | _IN_ATTRIB | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+    _IN_DELETE)
+
+Change = collections.namedtuple('Change', ['kind', 'offset', 'data'])
+"""A change to a followed file.
+
+kind is APPENDED, TRUNCATED or ROTATED. For APPENDED, data was appended at
+offset. After TRUNCATED or ROTATED, offsets start again from 0.
+"""
+
+
+def _inotify_functions():
+    """Return libc's inotify_init1 and inotify_add_watch, or None."""
+    library = ctypes.util.find_library('c')
+    if library is None:
+        return None
+    libc = ctypes.CDLL(library, use_errno=True)
+    init = getattr(libc, 'inotify_init1', None)
+    add_watch = getattr(libc, 'inotify_add_watch', None)
+    if init is None or add_watch is None:
+        return None
+    init.argtypes = [ctypes.c_int]
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return init, add_watch
+
+
+_INOTIFY = _inotify_functions()
+
+
+class Watcher(object):
+    """Waits for changes to the directory containing a file.
+
+    The directory is watched rather than the file itself so that a new file
+    created in place of a rotated one is noticed too.
+    """
+
+    def __init__(self, path, poll_interval=POLL_INTERVAL):
+        """Initialise a Watcher.
+
+        Positional arguments:
+            path: The path of the file to watch.
+        Keyword arguments:
+            poll_interval: The number of seconds between checks if inotify
+                isn't available.
+        """
+        self.poll_interval = poll_interval
+        self.descriptor = None
+        """The inotify file descriptor, or None if polling."""
+        if _INOTIFY is None:
+            logging.debug('inotify is unavailable. Polling instead.')
+            return
+        init, add_watch = _INOTIFY
+        descriptor = init(_IN_NONBLOCK | _IN_CLOEXEC)
+        if descriptor < 0:
+            logging.debug('Unable to initialise inotify. Polling instead.')
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        if add_watch(descriptor, os.fsencode(directory), _WATCH_MASK) < 0:
+            logging.debug('Unable to watch %s. Polling instead.', directory)
+            os.close(descriptor)
+            return
+        self.descriptor = descriptor
+
+    def wait(self, timeout, files=()):
+        """Wait until something changes, a file is readable or a timeout.
+
+        Positional arguments:
+            timeout: The longest time to wait in seconds.
+        Keyword arguments:
+            files: Other files (such as sockets) to wait on.
+
+        Returns:
+            A list of those of files that are readable.
+        """
+        if self.descriptor is None:
+            readable, _, _ = select.select(
+                files, [], [], min(timeout, self.poll_interval))
+            return readable
+        readable, _, _ = select.select(
+            [self.descriptor] + list(files), [], [], timeout)
+        if self.descriptor in readable:
+            readable.remove(self.descriptor)
+            self._drain()
+        return readable
+
+    def _drain(self):
+        """Discard the pending inotify events."""
+        try:
+            while os.read(self.descriptor, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        """Stop watching."""
+        if self.descriptor is not None:
+            os.close(self.descriptor)
+            self.descriptor = None
+
+
+class Follower(object):
+    """Follows a file by name, across truncation and rotation."""
+
+    def __init__(self, path, file, offset):
+        """Initialise a Follower.
+
+        Positional arguments:
+            path: The path of the file.
+            file: The file currently at path, open for reading in binary mode.
+            offset: The offset in file up to which data has been read.
+        """
+        self.path = path
+        self.file = file
+        self.offset = offset
+
+    @staticmethod
+    def _identity(file_stats):
+        """Return what identifies a file, whatever its name."""
+        return (file_stats.st_dev, file_stats.st_ino)
+
+    def poll(self, limit):
+        """Return the next change to the file, or None if there isn't one.
+
+        Data left at the end of a rotated file is returned before the
+        rotation is.
+
+        Positional arguments:
+            limit: The most data to return in one change.
+        """
+        if os.fstat(self.file.fileno()).st_size < self.offset:
+            self.offset = 0
+            return Change(TRUNCATED, 0, b'')
+        self.file.seek(self.offset)
+        data = self.file.read(limit)
+        if data:
+            offset = self.offset
+            self.offset += len(data)
+            return Change(APPENDED, offset, data)
+        try:
+            if (
+                    self._identity(os.stat(self.path)) ==
+                    self._identity(os.fstat(self.file.fileno()))):
+                return None
+            new_file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        self.file.close()
+        self.file = new_file
+        self.offset = 0
+        return Change(ROTATED, 0, b'')
+
+    def close(self):
+        """Close the file being followed."""
+        self.file.close()
@@ -0,0 +1,327 @@
+# Working copies for SSHed
+# Copyright © 2015  Alex M. Lowe <lengau@gmail.com>
+#
+"""The working copies that sshed_client's editors open, and where they go.
+
+Editors save often, and sshed_client reads each save straight back, so a
+working copy kept on disk costs a write and a read per save for nothing: it's
+deleted when the editor exits. Where a RAM-backed filesystem (tmpfs) is
+available, working copies that fit within a size limit go there instead, in
+a directory only the user can enter that's removed when sshed_client exits.
+
+$XDG_RUNTIME_DIR is preferred, as it's private to the user. /dev/shm is
+shared like /tmp, so only the private directory made in it protects the
+files. Anonymous memory (memfd) isn't used: an editor can only reach one
+through /proc/PID/fd, where editors that save by renaming a new file over
+the old one would fail.
+
+A file being edited is received straight into its WorkingCopy, which hashes
+it for a manifest.BlockManifest on the way. The versions that saves are
+diffed against are then snapshots, copied by the kernel rather than through
+sshed_client: shared with a reflink where the filesystem supports them (as
+btrfs and XFS do), or with os.copy_file_range. tmpfs has no reflinks, so a
+snapshot beside a working copy in RAM would be a full copy in memory outside
+the memory.MemoryBudget. Those are made as spooled files within the budget
+instead.
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import re
+import stat
+import tempfile
+import weakref
+
+from . import manifest
+
+SIZE_LIMIT = 16 * 2 ** 20
+"""The largest working copy to keep in RAM by default."""
+RAM_FILESYSTEMS = ('tmpfs', 'ramfs')
+HEADROOM = 2
+"""How many times a file's size must be free to put it in RAM, leaving room
+for the editor's backup or swap file."""
+FICLONE = 0x40049409
+"""The ioctl that makes one file share another's data (a reflink)."""
+_CANNOT_COPY = (
+    errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF,
+    errno.ETXTBSY)
+"""Errors meaning that the kernel can't copy between two files."""
+
+
+def ram_candidates():
+    """Return the directories that may be RAM-backed, most preferred first."""
+    candidates = []
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        candidates.append(runtime)
+    candidates.append('/dev/shm')
+    return candidates
+
+
+def filesystem_type(path, mounts='/proc/self/mounts'):
+    """Return the type of the filesystem holding a path, or None if unknown.
+
+    Positional arguments:
+        path: The path to look up.
+    Keyword arguments:
+        mounts: The file listing the mounted filesystems.
+    """
+    path = os.path.realpath(path)
+    best, best_type = '', None
+    try:
+        with open(mounts) as file:
+            for line in file:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces and the like in mount points are octal escaped.
+                point = re.sub(
+                    r'\\([0-7]{3})',
+                    lambda match: chr(int(match.group(1), 8)), fields[1])
+                if (
+                        (path == point or
+                         path.startswith(point.rstrip('/') + '/')) and
+                        len(point) >= len(best)):
+                    best, best_type = point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+
+def usable(directory):
+    """Return whether a directory is RAM-backed and safe to use."""
+    try:
+        stats = os.stat(directory)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(stats.st_mode):
+        return False
+    if not os.access(directory, os.W_OK | os.X_OK):
+        return False
+    # A directory others can write to must be sticky, or they could remove
+    # or replace the private directory made in it.
+    if (
+            stats.st_uid != os.getuid() and
+            stats.st_mode & stat.S_IWOTH and
+            not stats.st_mode & stat.S_ISVTX):
+        return False
+    return filesystem_type(directory) in RAM_FILESYSTEMS
+
+
+class WorkingDirectories(object):
+    """Places working copies in RAM when they fit, and on disk otherwise."""
+
+    def __init__(self, size_limit=SIZE_LIMIT, candidates=None):
+        """Initialise WorkingDirectories, making the private RAM directory.
+
+        Keyword arguments:
+            size_limit: The largest working copy to keep in RAM, or 0 to keep
+                none there.
+            candidates: The directories to try for RAM, most preferred
+                first. Default: ram_candidates()
+        """
+        self.size_limit = size_limit
+        self._ram = None
+        if not size_limit:
+            return
+        if candidates is None:
+            candidates = ram_candidates()
+        for candidate in candidates:
+            if not usable(candidate):
+                continue
+            try:
+                self._ram = tempfile.TemporaryDirectory(
+                    prefix='sshed-', dir=candidate)
+                # Whatever the umask, only the user may enter it.
+                os.chmod(self._ram.name, stat.S_IRWXU)
+            except OSError:
+                continue
+            logging.debug('Keeping working copies in %s.', self._ram.name)
+            break
+
+    @property
+    def ram(self):
+        """The private RAM-backed directory, or None if there isn't one."""
+        return None if self._ram is None else self._ram.name
+
+    def directory_for(self, size):
+        """Return the directory for a working copy, or None for the default.
+
+        Positional arguments:
+            size: The size of the file in bytes.
+        """
+        if self._ram is None or size > self.size_limit:
+            return None
+        try:
+            stats = os.statvfs(self._ram.name)
+        except OSError:
+            return None
+        if stats.f_bavail * stats.f_frsize < size * HEADROOM:
+            return None
+        return self._ram.name
+
+    def holds(self, path):
+        """Return whether a file is in the private RAM-backed directory."""
+        return (
+            self._ram is not None and
+            os.path.dirname(os.path.abspath(path)) == self._ram.name)
+
+    def cleanup(self):
+        """Remove the RAM directory and any working copies left in it."""
+        if self._ram is not None:
+            self._ram.cleanup()
+            self._ram = None
+
+
+def reflink(source, destination):
+    """Make an empty file share the whole of another's data (a reflink).
+
+    Positional arguments:
+        source: The file to share, open for reading.
+        destination: The empty file to share it, open for writing.
+
+    Returns:
+        Whether the data is shared. It isn't if the filesystem doesn't
+        support reflinks between the files.
+    """
+    try:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+    except OSError:
+        return False
+    return True
+
+
+def clone(source, destination):
+    """Copy the whole of one file over an empty one, inside the kernel.
+
+    Positional arguments:
+        source: The file to copy, open for reading.
+        destination: The empty file to copy into, open for writing.
+
+    Returns:
+        Whether the file was copied. It isn't if the filesystems can share
+        data neither by reflink nor by os.copy_file_range.
+    """
+    if reflink(source, destination):
+        return True
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        return False
+    size = os.fstat(source.fileno()).st_size
+    offset = 0
+    try:
+        while offset < size:
+            copied = copy_file_range(
+                source.fileno(), destination.fileno(), size - offset,
+                offset, offset)
+            if not copied:
+                break
+            offset += copied
+    except OSError as error:
+        if offset or error.errno not in _CANNOT_COPY:
+            raise
+        return False
+    return True
+
+
+def snapshot(file):
+    """Return a copy of an open file made by clone, or None if it can't be.
+
+    The copy is an anonymous temporary file beside the original, as both
+    must usually be on one filesystem. It's open for reading and writing, at
+    its start.
+    """
+    copy = tempfile.TemporaryFile(dir=os.path.dirname(file.name))
+    if not clone(file, copy):
+        copy.close()
+        return None
+    copy.seek(0)
+    return copy
+
+
+def _remove(path):
+    """Remove a file if it still exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class WorkingCopy(object):
+    """The file an editor opens, hashed block by block as it's received.
+
+    The file is removed when the WorkingCopy is closed (or garbage
+    collected), so a transfer that's abandoned part way doesn't leave it
+    behind.
+    """
+
+    def __init__(self, prefix, directory=None):
+        """Initialise a WorkingCopy, creating its file.
+
+        Positional arguments:
+            prefix: The start of the file's name.
+        Keyword arguments:
+            directory: The directory in which to create it, or None for the
+                default temporary directory.
+        """
+        self.file = tempfile.NamedTemporaryFile(
+            prefix=prefix, dir=directory, delete=False)
+        self.name = self.file.name
+        self._hasher = manifest.BlockHasher()
+        self._remove = weakref.finalize(self, _remove, self.name)
+
+    def write(self, data):
+        """Write data, hashing it if it continues what's been hashed."""
+        if self._hasher is not None:
+            if self.file.tell() == self._hasher.size:
+                self._hasher.update(data)
+            else:
+                self._hasher = None
+        return self.file.write(data)
+
+    def truncate(self, size=None):
+        """Truncate the file, which spoils the hashes if it shrinks."""
+        if size is None:
+            size = self.file.tell()
+        if self._hasher is not None and size < self._hasher.size:
+            self._hasher = None
+        return self.file.truncate(size)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def flush(self):
+        self.file.flush()
+
+    def manifest(self):
+        """Return a manifest.BlockManifest of the file.
+
+        The hashes made while it was written are used if they cover the
+        whole file, and otherwise it's read and hashed.
+        """
+        self.file.flush()
+        if (
+                self._hasher is not None and
+                self._hasher.size == os.fstat(self.file.fileno()).st_size):
+            return self._hasher.manifest()
+        return manifest.BlockManifest.from_file(self.file)
+
+    def release(self):
+        """Close the file, but leave it in place for the editor."""
+        self.file.close()
+
+    def close(self):
+        """Close and remove the file."""
+        self.file.close()
+        self._remove()
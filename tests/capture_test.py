@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Tests for sshed.capture"""
+
+import io
+import os
+import socket
+import stat
+import tempfile
+import unittest
+
+from sshed import capture, packethandler
+
+
+class TestRecorder(unittest.TestCase):
+    """Tests for recording a PacketHandler's packets."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='capture-')
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'session.capture')
+        self.sender, self.receiver = socket.socketpair()
+        self.addCleanup(self.sender.close)
+        self.addCleanup(self.receiver.close)
+
+    def exchange(self, payloads):
+        """Send two packets, recording both ends, and read the captures."""
+        sent_path = self.path + '.sent'
+        sending = capture.Recorder(sent_path, 'host', payloads=payloads)
+        receiving = capture.Recorder(self.path, 'client', payloads=payloads)
+        sender = packethandler.PacketHandler(self.sender, recorder=sending)
+        receiver = packethandler.PacketHandler(
+            self.receiver, recorder=receiving)
+        sender.send({'Filename': 'file'}, io.BytesIO(b'contents'))
+        sender.send({'Done': True})
+        data_file = io.BytesIO(b'old')
+        data_file.seek(3)
+        headers = receiver.get(data_file=data_file)
+        self.assertEqual(b'oldcontents', data_file.getvalue())
+        self.assertEqual(11, data_file.tell())
+        self.assertEqual(({'Done': True, 'Size': 0}, b''), receiver.get())
+        self.assertEqual('file', headers['Filename'])
+        sending.close()
+        receiving.close()
+        return capture.read_capture(sent_path), capture.read_capture(self.path)
+
+    def testPayloads(self):
+        """Both ends record the same packets, with their data."""
+        (sent_info, sent), (info, received) = self.exchange(payloads=True)
+        self.assertEqual('host', sent_info['side'])
+        self.assertEqual('client', info['side'])
+        self.assertTrue(info['payloads'])
+        self.assertEqual(
+            ['sent', 'sent'], [packet.direction for packet in sent])
+        self.assertEqual(
+            ['received', 'received'],
+            [packet.direction for packet in received])
+        for packets in (sent, received):
+            self.assertEqual(
+                {'Filename': 'file', 'Size': 8}, packets[0].headers)
+            self.assertEqual(b'contents', packets[0].payload)
+            self.assertEqual(b'', packets[1].payload)
+            self.assertLessEqual(packets[0].time, packets[1].time)
+
+    def testSizesOnly(self):
+        """Without payloads, only the sizes of the data are recorded."""
+        _, (info, received) = self.exchange(payloads=False)
+        self.assertFalse(info['payloads'])
+        self.assertEqual([8, 0], [packet.size for packet in received])
+        self.assertEqual([None, None], [packet.payload for packet in received])
+
+    def testPrivate(self):
+        """Only the user may read a capture."""
+        capture.Recorder(self.path, 'host').close()
+        self.assertEqual(
+            stat.S_IRUSR | stat.S_IWUSR,
+            stat.S_IMODE(os.stat(self.path).st_mode))
+
+
+class TestReadCapture(unittest.TestCase):
+    """Tests for read_capture."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='capture-')
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'session.capture')
+
+    def testNotCapture(self):
+        """A file that isn't a capture is refused."""
+        with open(self.path, 'wb') as file:
+            file.write(b'line 1\n')
+        self.assertRaises(ValueError, capture.read_capture, self.path)
+
+    def testTruncated(self):
+        """A capture cut off in the middle of a payload is refused."""
+        recorder = capture.Recorder(self.path, 'host', payloads=True)
+        recorder.record('sent', {'Size': 8}, b'contents')
+        recorder.close()
+        with open(self.path, 'r+b') as file:
+            file.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(ValueError, capture.read_capture, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
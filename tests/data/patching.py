@@ -0,0 +1,12 @@
+"""Helpers shared by the tests that check diffs by applying them."""
+
+import io
+
+from sshed import sshed
+
+
+def patch(original, diff):
+    """Apply a diff (as bytes) to original (as bytes) with sshed.Patcher."""
+    patcher = sshed.Patcher(
+        io.BytesIO(original), diff.splitlines(keepends=True))
+    return patcher.patch()
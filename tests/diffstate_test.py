@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Tests for sshed.diffstate"""
+
+import io
+import random
+import unittest
+from unittest import mock
+
+from sshed import diffstate, linehash
+
+from data.patching import patch
+
+
+def lines(*numbers):
+    """Return a list of lines, one for each number."""
+    return [b'%d\n' % number for number in numbers]
+
+
+class TestDiffState(unittest.TestCase):
+    """Tests for DiffState, with lines keyed on their bytes."""
+
+    vectorised = False
+
+    def index(self, lines_list):
+        """Return a list of lines as a linehash.Lines."""
+        return linehash.Lines(b''.join(lines_list), vectorised=self.vectorised)
+
+    def assertPatches(self, diff_state, edited):
+        """Assert that the diff from diff_state turns it into edited."""
+        output = io.BytesIO()
+        self.assertIsNotNone(diff_state.write_diff(edited, output))
+        self.assertEqual(
+            edited.data, patch(diff_state.lines.data, output.getvalue()))
+
+    def testSuccessiveSaves(self):
+        """Each save is diffed against the one before it."""
+        diff_state = diffstate.DiffState(self.index(lines(*range(100))))
+        saves = [
+            lines(*range(50)) + lines(*range(60, 100)),
+            lines(1000) + lines(*range(50)) + lines(*range(60, 100)),
+            lines(1000) + lines(*range(50)) + lines(7, 7, 7) + lines(99),
+        ]
+        for edited in saves:
+            edited = self.index(edited)
+            self.assertPatches(diff_state, edited)
+            diff_state.update(edited)
+
+    def testRepeatedLines(self):
+        """Lines that aren't unique are matched in the gaps."""
+        diff_state = diffstate.DiffState(
+            self.index(lines(1, 0, 0, 2, 0, 0, 3)))
+        self.assertEqual(
+            [('equal', 0, 5, 0, 5), ('delete', 5, 6, 5, 5),
+             ('equal', 6, 7, 5, 6)],
+            diff_state.opcodes(self.index(lines(1, 0, 0, 2, 0, 3))))
+
+    def testMovedLines(self):
+        """Diffs are correct when unique lines swap places."""
+        self.assertPatches(
+            diffstate.DiffState(self.index(lines(1, 2, 3, 4, 5))),
+            self.index(lines(4, 2, 3, 1, 5)))
+
+    def testRandomEdits(self):
+        """Diffs turn the baseline into each of a series of random edits."""
+        generator = random.Random(0)
+        edited = lines(*(generator.randrange(50) for _ in range(200)))
+        diff_state = diffstate.DiffState(self.index(edited))
+        for _ in range(20):
+            edited = list(edited)
+            for _ in range(5):
+                position = generator.randrange(len(edited))
+                edited[position:position + generator.randrange(3)] = lines(
+                    *(generator.randrange(60) for _ in range(
+                        generator.randrange(3))))
+            indexed = self.index(edited)
+            self.assertPatches(diff_state, indexed)
+            diff_state.update(indexed)
+
+    def testUnterminated(self):
+        """Changes to a last line without a newline aren't diffed."""
+        diff_state = diffstate.DiffState(
+            self.index(lines(*range(9)) + [b'9']))
+        self.assertIsNone(diff_state.write_diff(
+            self.index(lines(*range(9)) + [b'10']), io.BytesIO()))
+        self.assertPatches(
+            diff_state, self.index(lines(*range(-1, 9)) + [b'9']))
+
+
+@unittest.skipIf(linehash.numpy is None, 'NumPy is not installed.')
+class TestDiffStateVectorised(TestDiffState):
+    """Tests for DiffState, with lines keyed on their hashes."""
+
+    vectorised = True
+
+    def testCollision(self):
+        """Different lines with the same hash aren't diffed."""
+        original = self.index(lines(1, 2, 3))
+        edited = self.index(lines(1, 4, 3))
+        with mock.patch.object(edited, 'keys', original.keys):
+            self.assertIsNone(diffstate.DiffState(original).write_diff(
+                edited, io.BytesIO()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Tests for sshed.edssh"""
+
+import io
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import edssh
+
+OPENSSH_VERSION = (
+    'OpenSSH_7.2p2 Ubuntu-4ubuntu2.8, OpenSSL 1.0.2g  1 Mar 2016')
+
+
+class EdsshTestCase(unittest.TestCase):
+    """Runs each test with private runtime and cache directories."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.executable = os.path.join(self.directory.name, 'ssh')
+        with open(self.executable, 'w'):
+            pass
+        self.getoutput = mock.Mock(return_value=OPENSSH_VERSION)
+        patches = [
+            mock.patch.object(
+                edssh, 'find_executable', return_value=self.executable),
+            mock.patch('subprocess.getoutput', self.getoutput),
+            mock.patch.dict(os.environ, {
+                'XDG_RUNTIME_DIR': self.directory.name,
+                'XDG_CACHE_HOME': self.directory.name,
+            }),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+
+class TestSshClient(EdsshTestCase):
+    """Tests for SshClient."""
+
+    @mock.patch('os.execv')
+    def testMultiplexed(self, execv):
+        """Sessions share a master connection that forwards the socket."""
+        edssh.SshClient(socket='/tmp/sshed-x/socket').run(['host'])
+        arguments = execv.call_args[0][1]
+        self.assertIn('ControlMaster=auto', arguments)
+        self.assertIn(
+            'ControlPath=%s' % os.path.join(self.directory.name, 'edssh-%C'),
+            arguments)
+        self.assertIn('/tmp/sshed-x/socket:/tmp/sshed-x/socket', arguments)
+        self.assertNotIn('StreamLocalBindUnlink=yes', arguments)
+
+    @mock.patch('os.execv')
+    def testDropbear(self, execv):
+        """Clients that can't multiplex forward the socket every time."""
+        self.getoutput.return_value = 'Dropbear v2014.65'
+        edssh.SshClient(socket='/tmp/sshed-x/socket').run(['host'])
+        arguments = execv.call_args[0][1]
+        self.assertNotIn('ControlMaster=auto', arguments)
+        self.assertIn('-R', arguments)
+
+    def testVersionCached(self):
+        """The version is probed once per executable until it changes."""
+        client = edssh.SshClient()
+        self.assertEqual(
+            ('OpenSSH', '7.2p2'), (client.project, client.version))
+        client = edssh.SshClient()
+        self.assertEqual('7.2p2', client.version)
+        self.assertEqual(1, self.getoutput.call_count)
+        os.utime(self.executable, ns=(0, 0))
+        self.getoutput.return_value = 'Dropbear v2014.65'
+        client = edssh.SshClient()
+        self.assertEqual('Dropbear', client.project)
+        self.assertEqual(2, self.getoutput.call_count)
+
+
+class TestClientSocket(EdsshTestCase):
+    """Tests for find_client and start_client."""
+
+    def setUp(self):
+        super().setUp()
+        self.socket_address = os.path.join(self.directory.name, 'socket')
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.socket_address)
+        os.chmod(self.socket_address, 0o600)
+        self.server.listen(1)
+
+    def tearDown(self):
+        self.server.close()
+        super().tearDown()
+
+    @mock.patch('subprocess.Popen')
+    def testStartThenFind(self, popen):
+        """A started client is found again while it's running."""
+        popen.return_value.stdout = io.BytesIO(
+            b'export SSHED_SOCK=%s\n' % self.socket_address.encode())
+        with mock.patch.dict(os.environ, {'SSHED_SOCK': ''}):
+            self.assertIsNone(edssh.find_client())
+            self.assertEqual(self.socket_address, edssh.start_client())
+            self.assertEqual(self.socket_address, edssh.find_client())
+            self.server.close()
+            self.assertIsNone(edssh.find_client())
+
+    @mock.patch('subprocess.Popen')
+    def testStartFails(self, popen):
+        popen.return_value.stdout = io.BytesIO(b'')
+        self.assertIsNone(edssh.start_client())
+
+
+class TestControlDirectory(unittest.TestCase):
+    """Tests for control_directory."""
+
+    @mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': ''})
+    def testPrivateTemporaryDirectory(self):
+        """Without a runtime directory, use a private temporary directory."""
+        with tempfile.TemporaryDirectory() as temporary:
+            with mock.patch('tempfile.gettempdir', return_value=temporary):
+                directory = edssh.control_directory()
+                self.assertEqual(temporary, os.path.dirname(directory))
+                self.assertEqual(0o700, os.stat(directory).st_mode & 0o777)
+                os.chmod(directory, 0o755)
+                with self.assertRaises(ValueError):
+                    edssh.control_directory()
+
+
+if __name__ == '__main__':
+    unittest.main()
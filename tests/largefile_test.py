@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""Tests for sshed.largefile"""
+
+import difflib
+import io
+import os
+import unittest
+from unittest import mock
+
+from sshed import largefile
+
+from data import diff1
+from data.patching import patch
+
+
+class TestLineHashRun(unittest.TestCase):
+    """Tests for LineHashRun."""
+
+    def testLines(self):
+        """Read lines back by number, with and without a final newline."""
+        run = largefile.LineHashRun(io.BytesIO(b'one\ntwo\r\nthree'))
+        self.assertEqual(3, len(run))
+        self.assertEqual([b'two\r\n', b'three'], run.lines(1, 3))
+        self.assertEqual(run.hashes(0, 3), [
+            hash(b'one\n'), hash(b'two\r\n'), hash(b'three')])
+        self.assertEqual(4, run.offset(1))
+        self.assertEqual(14, run.offset(3))
+        run.close()
+
+    def testBlocks(self):
+        """Blocks of hashes cover the run in either direction."""
+        lines = [b'%d\n' % number for number in range(10)]
+        with mock.patch.object(largefile, 'RUN_BUFFER_RECORDS', 4):
+            run = largefile.LineHashRun(io.BytesIO(b''.join(lines)))
+            forward = sum(run.blocks(), [])
+            backward = sum(run.blocks(reverse=True), [])
+        self.assertEqual([hash(line) for line in lines], forward)
+        self.assertEqual(list(reversed(forward)), backward)
+
+
+class TestDiff(unittest.TestCase):
+    """Tests for diff_opcodes and write_unified_diff."""
+
+    def diff(self, original, edited, window=largefile.DIFF_WINDOW_LINES):
+        """Return the diff between two bytes objects."""
+        original_run = largefile.LineHashRun(io.BytesIO(original))
+        edited_run = largefile.LineHashRun(io.BytesIO(edited))
+        opcodes = largefile.diff_opcodes(
+            original_run, edited_run, window=window)
+        output = io.BytesIO()
+        written = largefile.write_unified_diff(
+            largefile.group_opcodes(opcodes), original_run, edited_run,
+            output)
+        self.assertEqual(written, len(output.getvalue()))
+        return output.getvalue()
+
+    def testRoundTrip(self):
+        """A generated diff patches the original into the edited file."""
+        with open(os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                'data/diff1_original.txt'), mode='rb') as original_file:
+            original = original_file.read()
+        diff = self.diff(original, diff1.FINAL)
+        self.assertEqual(diff1.FINAL, patch(original, diff))
+
+    def testMatchesDifflib(self):
+        """The diff is identical to the one difflib generates."""
+        original = b''.join(b'line %d\n' % number for number in range(100))
+        edited = original.replace(b'line 50\n', b'line fifty\n').replace(
+            b'line 3\n', b'') + b'line 100\n'
+        expected = ''.join(difflib.unified_diff(
+            original.decode().splitlines(keepends=True),
+            edited.decode().splitlines(keepends=True))).encode()
+        self.assertEqual(expected, self.diff(original, edited))
+
+    def testIdentical(self):
+        """Identical files produce an empty diff."""
+        self.assertEqual(b'', self.diff(b'a\nb\n', b'a\nb\n'))
+
+    def testSmallWindow(self):
+        """Edits spread over many windows still give a correct diff."""
+        original = b''.join(b'%d\n' % number for number in range(200))
+        edited = b''.join(
+            b'%d\n' % number if number % 7 else b'edited %d\n' % number
+            for number in range(200) if number % 11)
+        edited = b'first\n' + edited[:40] + b'inserted\n' * 12 + edited[40:]
+        for window in (1, 4, 10, 1000):
+            diff = self.diff(original, edited, window=window)
+            self.assertEqual(edited, patch(original, diff))
+
+    def testNothingMatchesInWindow(self):
+        """A window without any matching lines is replaced whole."""
+        original = b''.join(b'%d\n' % number for number in range(20))
+        edited = b''.join(b'x%d\n' % number for number in range(30))
+        diff = self.diff(original, edited, window=5)
+        self.assertEqual(edited, patch(original, diff))
+
+
+
+class TestExpressible(unittest.TestCase):
+    """Tests for expressible."""
+
+    def expressible(self, original, edited):
+        """Return whether the diff of two bytes objects can be written."""
+        original_run = largefile.LineHashRun(io.BytesIO(original))
+        edited_run = largefile.LineHashRun(io.BytesIO(edited))
+        groups = list(largefile.group_opcodes(
+            largefile.diff_opcodes(original_run, edited_run)))
+        return largefile.expressible(groups, original_run, edited_run)
+
+    def testUnterminatedLastLine(self):
+        """A hunk reaching a last line without a newline isn't expressible."""
+        self.assertFalse(self.expressible(b'a\nb\nc', b'a\nb\nd'))
+        self.assertFalse(self.expressible(b'a\nb\nc\n', b'a\nb\nd'))
+        self.assertFalse(self.expressible(b'a\nb\nc', b'a\nB\nc'))
+
+    def testTerminated(self):
+        """Hunks that stay clear of an unterminated last line are."""
+        self.assertTrue(self.expressible(b'a\nb\nc\n', b'a\nb\nd\n'))
+        self.assertTrue(self.expressible(b'', b'a\n'))
+        self.assertTrue(self.expressible(b'a\nb\nc', b'a\nb\nc'))
+        original = b''.join(b'%d\n' % number for number in range(20))
+        edited = original.replace(b'2\n', b'two\n', 1)
+        self.assertTrue(self.expressible(original + b'end', edited + b'end'))
+        self.assertFalse(self.expressible(original, edited + b'end'))
+
+
+class TestEqualLinesMatch(unittest.TestCase):
+    """Tests for equal_lines_match."""
+
+    def match(self, original, edited):
+        """Diff two bytes objects and check the lines called equal."""
+        original_run = largefile.LineHashRun(io.BytesIO(original))
+        edited_run = largefile.LineHashRun(io.BytesIO(edited))
+        opcodes = largefile.diff_opcodes(original_run, edited_run)
+        return largefile.equal_lines_match(
+            opcodes, original_run, edited_run, chunk_size=3)
+
+    def testEqual(self):
+        """Lines that really are equal match, compared in chunks."""
+        original = b''.join(b'line %d\n' % number for number in range(20))
+        edited = original.replace(b'line 5\n', b'')
+        self.assertTrue(self.match(original, edited))
+
+    def testCollision(self):
+        """Different lines with the same hash don't match."""
+        with mock.patch.object(
+                largefile, 'hash', create=True, side_effect=len):
+            self.assertFalse(self.match(b'one\ntwo\n', b'one\nsix\n'))
+            self.assertTrue(self.match(b'one\ntwo\n', b'one\ntwo\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
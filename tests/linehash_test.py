@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Tests for sshed.linehash"""
+
+import unittest
+
+from sshed import largefile, linehash
+
+DATA = b'one\ntwo\n\none\nthree'
+
+
+class TestLines(unittest.TestCase):
+    """Tests for Lines, without NumPy."""
+
+    vectorised = False
+
+    def testLines(self):
+        """Lines split exactly where a binary file's iteration does."""
+        lines = linehash.Lines(DATA, vectorised=self.vectorised)
+        self.assertEqual(5, len(lines))
+        self.assertEqual(largefile.split_lines(DATA), lines.lines(0, 5))
+        self.assertEqual([b'\n', b'one\n'], lines.lines(2, 4))
+        self.assertEqual(8, lines.offset(2))
+        self.assertFalse(lines.terminated)
+        self.assertTrue(linehash.Lines(b'', vectorised=self.vectorised)
+                        .terminated)
+
+    def testKeys(self):
+        """Equal lines have equal keys, and different lines different ones."""
+        keys = linehash.Lines(DATA, vectorised=self.vectorised).keys
+        self.assertEqual(keys[0], keys[3])
+        self.assertEqual(4, len(set(keys)))
+
+
+@unittest.skipIf(linehash.numpy is None, 'NumPy is not installed.')
+class TestLinesVectorised(TestLines):
+    """Tests for Lines, with NumPy."""
+
+    vectorised = True
+
+    def testBlocks(self):
+        """Hashes don't depend on how lines fall into blocks."""
+        data = b''.join(b'line %d\n' % (number % 7) for number in range(100))
+        data += b'a long line that is longer than a block\n' * 2
+        ends = linehash._line_ends(data)
+        hashes = linehash._line_hashes(data, ends, block_size=16).tolist()
+        self.assertEqual(
+            linehash._line_hashes(data, ends).tolist(), hashes)
+        self.assertEqual(hashes[0], hashes[7])
+        self.assertEqual(hashes[-1], hashes[-2])
+        self.assertEqual(8, len(set(hashes)))
+
+
+if __name__ == '__main__':
+    unittest.main()
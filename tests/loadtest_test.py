@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Tests for sshed.loadtest"""
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import loadtest
+
+
+class TestScriptedSave(unittest.TestCase):
+    """Tests for the scripted edits."""
+
+    def testDeterministic(self):
+        """The same saves always give the same contents."""
+        self.assertEqual(
+            loadtest.expected_saves(3, 4, lines=50),
+            loadtest.expected_saves(3, 4, lines=50))
+
+    def testSaves(self):
+        """Each save changes the file, keeping the line naming the session."""
+        versions = loadtest.expected_saves(7, 4, lines=50)
+        self.assertEqual(5, len(versions))
+        self.assertEqual(len(versions), len(set(versions)))
+        for version in versions:
+            self.assertEqual(7, loadtest.session_of(version))
+        self.assertEqual(51, len(versions[1].splitlines()))
+        self.assertEqual(52, len(versions[2].splitlines()))
+        self.assertIn(b'save 1\n', versions[1])
+
+    def testTinyFile(self):
+        """A file with no lines but the first can still be saved."""
+        contents = loadtest.original_contents(1, lines=0)
+        self.assertEqual(
+            b'loadtest session 1\nsave 1\n',
+            loadtest.scripted_save(contents, 1))
+
+
+class TestFakeEditor(unittest.TestCase):
+    """Tests for fake_editor and write_editor."""
+
+    def testFakeEditor(self):
+        """The editor makes its saves in order and logs each."""
+        with tempfile.TemporaryDirectory(prefix='loadtest-') as directory:
+            path = os.path.join(directory, 'file')
+            log = os.path.join(directory, 'log')
+            with open(path, 'wb') as file:
+                file.write(loadtest.original_contents(4, lines=20))
+            with mock.patch.dict(os.environ, {
+                    loadtest.SAVES_VARIABLE: '3',
+                    loadtest.INTERVAL_VARIABLE: '0',
+                    loadtest.LOG_VARIABLE: log}):
+                self.assertEqual(0, loadtest.fake_editor(['-x', path]))
+            with open(path, 'rb') as file:
+                self.assertEqual(
+                    loadtest.expected_saves(4, 3, lines=20)[-1], file.read())
+            self.assertEqual(
+                [(4, 1), (4, 2), (4, 3)],
+                sorted(loadtest._read_log(log)))
+
+    def testEditorPath(self):
+        """An editor that choose_editor would ignore is refused."""
+        with tempfile.TemporaryDirectory(prefix='sshed-') as directory:
+            self.assertRaises(ValueError, loadtest.write_editor, directory)
+        with tempfile.TemporaryDirectory(prefix='loadtest-') as directory:
+            path = loadtest.write_editor(directory)
+            self.assertTrue(os.access(path, os.X_OK))
+
+
+class TestLoadTest(unittest.TestCase):
+    """Tests for a whole load test."""
+
+    def testRun(self):
+        """Every save of every session is applied on the host."""
+        results = loadtest.run(loadtest.parse_arguments([
+            '--sessions', '3', '--saves', '2', '--interval', '0.05',
+            '--lines', '100', '--timeout', '30']))
+        self.assertEqual([], results['errors'])
+        self.assertEqual(3, results['complete'])
+        self.assertEqual(6, results['saves_made'])
+        self.assertEqual(
+            6, results['saves_applied'] + results['saves_coalesced'])
+        self.assertEqual(0, results['saves_unexpected'])
+        self.assertIn('p99', results['save_latency'])
+        self.assertIn('Sessions: 3 (3 complete)',
+                      loadtest.format_report(results))
+
+
+if __name__ == '__main__':
+    unittest.main()
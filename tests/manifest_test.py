@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Tests for sshed.manifest"""
+
+import io
+import unittest
+
+from sshed import manifest
+
+
+def range_patch(original, edited, block_size=4):
+    """Return the range patch turning original into edited (both bytes)."""
+    block_manifest = manifest.BlockManifest.from_file(
+        io.BytesIO(original), block_size=block_size)
+    digests, _ = block_manifest.scan(io.BytesIO(edited))
+    output = io.BytesIO()
+    manifest.write_range_patch(
+        manifest.changed_ranges(
+            io.BytesIO(original), io.BytesIO(edited),
+            block_manifest.changed_blocks(digests), block_size=block_size),
+        output)
+    return output.getvalue()
+
+
+class TestBlockManifest(unittest.TestCase):
+    """Tests for BlockManifest."""
+
+    def testUnchanged(self):
+        """A scan of the same contents matches the manifest."""
+        block_manifest = manifest.BlockManifest.from_file(
+            io.BytesIO(b'0123456789'), block_size=4)
+        self.assertEqual(10, block_manifest.size)
+        self.assertEqual(3, len(block_manifest.digests))
+        self.assertTrue(block_manifest.matches(
+            *block_manifest.scan(io.BytesIO(b'0123456789'))))
+
+    def testChangedBlocks(self):
+        """Only blocks whose contents changed are reported."""
+        block_manifest = manifest.BlockManifest.from_file(
+            io.BytesIO(b'0123456789'), block_size=4)
+        digests, size = block_manifest.scan(io.BytesIO(b'0123x56789ab'))
+        self.assertFalse(block_manifest.matches(digests, size))
+        self.assertEqual([1, 2], block_manifest.changed_blocks(digests))
+
+    def testTruncatedAtBlockBoundary(self):
+        """Shrinking to a block boundary changes the size, not the blocks."""
+        block_manifest = manifest.BlockManifest.from_file(
+            io.BytesIO(b'01234567'), block_size=4)
+        digests, size = block_manifest.scan(io.BytesIO(b'0123'))
+        self.assertFalse(block_manifest.matches(digests, size))
+        self.assertEqual([], block_manifest.changed_blocks(digests))
+
+
+class TestBlockHasher(unittest.TestCase):
+    """Tests for BlockHasher."""
+
+    def testMatchesFromFile(self):
+        """Hashing in pieces of any size gives the same manifest."""
+        contents = b'0123456789abcdefghij'
+        expected = manifest.BlockManifest.from_file(
+            io.BytesIO(contents), block_size=4)
+        for piece in (1, 3, 4, 7, 20):
+            hasher = manifest.BlockHasher(block_size=4)
+            for start in range(0, len(contents), piece):
+                hasher.update(contents[start:start + piece])
+            block_manifest = hasher.manifest()
+            self.assertTrue(block_manifest.matches(
+                expected.digests, expected.size))
+
+    def testEmpty(self):
+        """An empty file has no blocks."""
+        block_manifest = manifest.BlockHasher(block_size=4).manifest()
+        self.assertEqual([], block_manifest.digests)
+        self.assertEqual(0, block_manifest.size)
+
+
+class TestRangePatch(unittest.TestCase):
+    """Tests for generating and applying range patches."""
+
+    def assertPatches(self, original, edited):
+        """Assert that the range patch turns original into edited."""
+        file = io.BytesIO(original)
+        manifest.apply_range_patch(
+            io.BytesIO(range_patch(original, edited)), file, len(edited))
+        self.assertEqual(edited, file.getvalue())
+
+    def testTrimmedToChangedBytes(self):
+        """Ranges only cover the bytes that changed, merged if adjacent."""
+        self.assertEqual(
+            b'3 3\nxyz', range_patch(b'0123456789', b'012xyz6789'))
+        self.assertEqual(
+            b'1 1\nx7 1\ny', range_patch(b'0123456789', b'0x23456y89'))
+
+    def testRoundTrips(self):
+        """Patches apply for edits in place, appends and truncation."""
+        original = b'The quick brown fox jumps over the lazy dog.\n'
+        self.assertPatches(original, original.replace(b'fox', b'cat'))
+        self.assertPatches(original, original + b'And the cat.\n')
+        self.assertPatches(original, original[:10])
+        self.assertPatches(original, original[:8])
+        self.assertPatches(original, b'')
+
+    def testLimit(self):
+        """Give up once the patch is bigger than the limit."""
+        ranges = [(0, b'abcd'), (10, b'efgh')]
+        self.assertIsNone(
+            manifest.write_range_patch(ranges, io.BytesIO(), limit=10))
+        self.assertEqual(
+            17, manifest.write_range_patch(ranges, io.BytesIO(), limit=17))
+
+    def testTruncatedPatch(self):
+        """Raise a ValueError if the patch ends in the middle of a range."""
+        with self.assertRaises(ValueError):
+            manifest.apply_range_patch(
+                io.BytesIO(b'0 5\nabc'), io.BytesIO(), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
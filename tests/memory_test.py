@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Tests for sshed.memory"""
+
+import gc
+import unittest
+
+from sshed import memory
+
+
+class TestMemoryBudget(unittest.TestCase):
+    """Tests for MemoryBudget."""
+
+    def testReserve(self):
+        """Reservations are refused beyond the limit, and peak is kept."""
+        budget = memory.MemoryBudget(limit=10)
+        self.assertTrue(budget.reserve(6))
+        self.assertFalse(budget.reserve(5))
+        self.assertEqual(1, budget.spills)
+        reservation = [6]
+        budget.release(reservation)
+        self.assertEqual([0], reservation)
+        self.assertEqual(0, budget.used)
+        self.assertEqual(6, budget.peak)
+
+
+class TestSpooledFile(unittest.TestCase):
+    """Tests for SpooledFile."""
+
+    def setUp(self):
+        self.budget = memory.MemoryBudget(limit=10)
+
+    def testInMemory(self):
+        """A file within the budget stays in memory, holding its size."""
+        with memory.SpooledFile(self.budget) as file:
+            file.write(b'abcd')
+            file.writelines([b'ef', b'gh'])
+            file.seek(0)
+            file.write(b'AB')
+            self.assertFalse(file._rolled)
+            self.assertEqual(8, file.reserved)
+            self.assertEqual(8, self.budget.used)
+        self.assertEqual(0, self.budget.used)
+
+    def testOverBudget(self):
+        """A file rolls over once the budget is spent by others."""
+        first = memory.SpooledFile(self.budget)
+        first.write(b'x' * 8)
+        second = memory.SpooledFile(self.budget)
+        second.write(b'y' * 3)
+        self.assertTrue(second._rolled)
+        self.assertFalse(first._rolled)
+        self.assertEqual(0, second.reserved)
+        second.seek(0)
+        self.assertEqual(b'yyy', second.read())
+        self.assertEqual(8, self.budget.used)
+        first.close()
+        second.close()
+        self.assertEqual(0, self.budget.used)
+
+    def testMaxSize(self):
+        """A file still rolls over past its own max_size."""
+        file = memory.SpooledFile(memory.MemoryBudget(), max_size=4)
+        file.write(b'12345')
+        self.assertTrue(file._rolled)
+        self.assertEqual(0, file.budget.used)
+        file.close()
+
+    def testRollover(self):
+        """Rolling over returns the reservation."""
+        file = memory.SpooledFile(self.budget)
+        file.write(b'data')
+        file.rollover()
+        self.assertEqual(0, self.budget.used)
+        file.write(b'more data')
+        self.assertEqual(0, self.budget.used)
+        file.close()
+
+    def testGarbageCollected(self):
+        """A file dropped without closing returns its reservation."""
+        file = memory.SpooledFile(self.budget)
+        file.write(b'data')
+        del file
+        gc.collect()
+        self.assertEqual(0, self.budget.used)
+
+
+if __name__ == '__main__':
+    unittest.main()
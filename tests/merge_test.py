@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Tests for sshed.merge"""
+
+import unittest
+
+from sshed import merge, transfers
+
+
+def lines(*numbers):
+    """Return a list of lines, one for each number."""
+    return [b'%d\n' % number for number in numbers]
+
+
+class TestMerge3(unittest.TestCase):
+    """Tests for merge3."""
+
+    def testSeparateChanges(self):
+        """Changes to different lines are both kept."""
+        base = lines(1, 2, 3, 4, 5)
+        mine = lines(1, 20, 3, 4, 5)
+        theirs = lines(1, 2, 3, 4, 50, 6)
+        self.assertEqual(
+            (lines(1, 20, 3, 4, 50, 6), 0),
+            merge.merge3(base, mine, theirs))
+
+    def testSameChange(self):
+        """A change made on both sides is kept once."""
+        base = lines(1, 2, 3)
+        both = lines(1, 20, 3)
+        self.assertEqual((both, 0), merge.merge3(base, both, both))
+
+    def testUnchanged(self):
+        base = lines(1, 2, 3)
+        self.assertEqual((lines(4), 0), merge.merge3(base, base, lines(4)))
+        self.assertEqual((lines(4), 0), merge.merge3(base, lines(4), base))
+
+    def testConflict(self):
+        """Different changes to the same lines are kept between markers."""
+        base = lines(1, 2, 3)
+        self.assertEqual(
+            ([b'1\n', merge.LOCAL_MARKER, b'20\n', merge.SEPARATOR, b'21\n',
+              merge.HOST_MARKER, b'3\n'], 1),
+            merge.merge3(base, lines(1, 20, 3), lines(1, 21, 3)))
+
+    def testInsertionsConflict(self):
+        """Different insertions at the same place conflict."""
+        base = lines(1, 2)
+        merged, conflicts = merge.merge3(
+            base, lines(1, 3, 2), lines(1, 4, 2))
+        self.assertEqual(1, conflicts)
+        self.assertIn(merge.SEPARATOR, merged)
+
+    def testPreferMine(self):
+        """Conflicts can be resolved in favour of the local version."""
+        base = lines(1, 2, 3, 4)
+        self.assertEqual(
+            (lines(1, 20, 3, 40), 1),
+            merge.merge3(
+                base, lines(1, 20, 3, 4), lines(1, 21, 3, 40),
+                prefer_mine=True))
+
+    def testMissingNewline(self):
+        """Conflict markers always start on a new line."""
+        merged, _ = merge.merge3([b'a'], [b'b'], [b'c'])
+        self.assertEqual(b'<<<<<<< local\nb\n=======\nc\n>>>>>>> host\n',
+                         b''.join(merged))
+
+
+class TestBaselines(unittest.TestCase):
+    """Tests for Baselines."""
+
+    def testLookup(self):
+        """Versions are found by their checksums."""
+        baselines = merge.Baselines(b'one')
+        baselines.add(b'two')
+        self.assertEqual(b'two', baselines.current)
+        self.assertEqual(b'one', baselines.get(transfers.checksum(b'one')))
+        self.assertIsNone(baselines.get(transfers.checksum(b'three')))
+        self.assertIsNone(baselines.get(None))
+
+    def testLimit(self):
+        """Only the newest versions are kept."""
+        baselines = merge.Baselines(b'one', limit=2)
+        baselines.add(b'two')
+        baselines.add(b'three')
+        self.assertIsNone(baselines.get(transfers.checksum(b'one')))
+        baselines.reset(b'four')
+        self.assertEqual(1, len(baselines.versions))
+
+
+if __name__ == '__main__':
+    unittest.main()
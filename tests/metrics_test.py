@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Tests for sshed.metrics"""
+
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import memory, metrics, trace
+
+
+class FakeHandler(object):  # pylint: disable=too-few-public-methods
+    """Stands in for a SocketRequestHandler, with one end of a socket pair."""
+
+    def __init__(self):
+        self.request, self.far = socket.socketpair()
+        self.bytes_received = 10
+        self.bytes_sent = 5
+
+    def close(self):
+        self.request.close()
+        self.far.close()
+
+
+class TestHistogram(unittest.TestCase):
+    """Tests for Histogram."""
+
+    def testSamples(self):
+        """Buckets are cumulative, ending with +Inf."""
+        histogram = metrics.Histogram(buckets=(1, 2))
+        for value in (0.5, 1.5, 1.5, 3):
+            histogram.observe(value)
+        self.assertEqual([
+            'x_bucket{le="1.0"} 1',
+            'x_bucket{le="2.0"} 3',
+            'x_bucket{le="+Inf"} 4',
+            'x_count 4',
+            'x_sum 6.5',
+        ], histogram.samples('x'))
+
+
+class TestMetrics(unittest.TestCase):
+    """Tests for Metrics."""
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+        self.handler = FakeHandler()
+        self.addCleanup(self.handler.close)
+        self.metrics.open_session(1, self.handler)
+
+    def testSaves(self):
+        """Saves are counted from spans, with the diff in their latency."""
+        tracer = trace.Tracer(session='s', listener=self.metrics)
+        with mock.patch('time.perf_counter', side_effect=[0, 0.5, 1, 1.25]):
+            with tracer.span('diff'):
+                pass
+            with tracer.span('send', differential=True):
+                pass
+        self.assertEqual({'diff': 1, 'full': 0}, self.metrics.saves)
+        self.assertEqual(0.75, self.metrics.save_latency.sum)
+        exposition = self.metrics.exposition()
+        self.assertIn(
+            'sshed_client_saves_total{format="diff"} 1\n', exposition)
+        self.assertIn('sshed_client_diff_ratio 1.0\n', exposition)
+        self.assertIn('sshed_client_save_seconds_count 1\n', exposition)
+        self.assertTrue(exposition.endswith('# EOF\n'))
+
+    def testBytes(self):
+        """Bytes are counted live, and kept once a session finishes."""
+        self.handler.far.sendall(b'waiting')
+        exposition = self.metrics.exposition()
+        self.assertIn('sshed_client_sessions 1\n', exposition)
+        self.assertIn('sshed_client_received_bytes_total 10\n', exposition)
+        self.assertIn('sshed_client_queued_bytes{direction="in"} 7\n',
+                      exposition)
+        self.metrics.close_session(1)
+        exposition = self.metrics.exposition()
+        self.assertIn('sshed_client_sessions 0\n', exposition)
+        self.assertIn('sshed_client_sent_bytes_total 5\n', exposition)
+
+    def testMemory(self):
+        """The memory budget's usage is reported."""
+        self.metrics.memory = memory.MemoryBudget(limit=100)
+        self.metrics.memory.reserve(30)
+        exposition = self.metrics.exposition()
+        self.assertIn(
+            'sshed_client_spooled_memory_bytes{value="current"} 30\n',
+            exposition)
+        self.assertIn(
+            'sshed_client_spooled_memory_bytes{value="limit"} 100\n',
+            exposition)
+
+    def testSessionTable(self):
+        self.metrics.describe_session(1, {'View': True, 'Filename': 'log'})
+        self.assertRegex(
+            self.metrics.session_table(), r'\n1\tview\t\d+s\t10\t5\t0\tlog\n')
+
+    def testCancel(self):
+        """Cancelling a session closes its connection."""
+        self.assertTrue(self.metrics.cancel(1))
+        self.assertEqual(b'', self.handler.far.recv(1))
+        self.assertIn(self.handler.request, self.metrics.cancelled)
+        self.assertFalse(self.metrics.cancel(2))
+
+
+class TestAdminServer(unittest.TestCase):
+    """Tests for AdminServer and send_command."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_address = os.path.join(directory.name, 'socket')
+        self.metrics = metrics.Metrics()
+        server = metrics.AdminServer(
+            metrics.admin_address(self.socket_address), self.metrics)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        server.serve_in_background()
+
+    def testCommands(self):
+        handler = FakeHandler()
+        self.addCleanup(handler.close)
+        self.metrics.open_session(4, handler)
+        self.assertIn(
+            '\n4\tunknown\t',
+            metrics.send_command('sessions', self.socket_address))
+        self.assertEqual(
+            'Cancelled session 4.\n',
+            metrics.send_command('cancel 4', self.socket_address))
+        self.assertEqual(
+            'No session x.\n',
+            metrics.send_command('cancel x', self.socket_address))
+        self.assertTrue(metrics.send_command(
+            'metrics', self.socket_address).startswith('# TYPE'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@
 """Tests for packethandler"""
 
 import copy
+import io
+import socket
 from unittest import mock
 import tempfile
 import unittest
@@ -153,6 +155,32 @@ class TestGetBytes(unittest.TestCase):
             len(data.SOCKET_WITH_MULTIPLE_DATA),
             self.socket.recv.call_count)
 
+    def testNoBytes(self):
+        """Retrieve an empty packet body without reading the socket."""
+        self.assertEqual(b'', self.handler._get_bytes(0))
+        self.temporary_file.write(b'old data')
+        self.temporary_file.seek(0)
+        self.handler._get_bytes(0, data_file=self.temporary_file)
+        self.temporary_file.seek(0)
+        self.assertEqual(b'', self.temporary_file.read())
+        self.socket.recv.assert_not_called()
+
+    def testSocketMultipleRequestsLeavingData(self):
+        """Leave the start of the next packet after multiple requests."""
+        received = b''.join(data.SOCKET_WITH_MULTIPLE_DATA)
+        self.socket.recv.side_effect = data.SOCKET_WITH_MULTIPLE_DATA
+        self.assertEqual(
+            received[:-1], self.handler._get_bytes(len(received) - 1))
+        self.assertEqual(received[-1:], self.handler.buffer)
+
+        self.handler.buffer = b''
+        self.socket.recv.side_effect = data.SOCKET_WITH_MULTIPLE_DATA
+        self.handler._get_bytes(
+            len(received) - 1, data_file=self.temporary_file)
+        self.temporary_file.seek(0)
+        self.assertEqual(received[:-1], self.temporary_file.read())
+        self.assertEqual(received[-1:], self.handler.buffer)
+
 
 class TestGet(unittest.TestCase):
     """Tests for PacketHandler.get"""
@@ -188,6 +216,16 @@ class TestGet(unittest.TestCase):
         self.assertEqual(
             data.SOCKET_WITH_EVERYTHING_DATA, self.temporary_file.read())
 
+    def testCountsBytesReceived(self):
+        """Count the bytes received and the size of the headers."""
+        self.socket.recv.side_effect = data.MULTI_PART_SOCKET_WITH_EVERYTHING
+        self.handler.get()
+        received = b''.join(data.MULTI_PART_SOCKET_WITH_EVERYTHING)
+        self.assertEqual(len(received), self.handler.bytes_received)
+        self.assertEqual(
+            len(received) - len(data.SOCKET_WITH_EVERYTHING_DATA),
+            self.handler.header_size)
+
     def testSocketInFileMultipleParts(self):
         """Get a pcaket in multiple parts and put the data into a file."""
         self.socket.recv.side_effect = data.MULTI_PART_SOCKET_WITH_EVERYTHING
@@ -245,6 +283,14 @@ class TestSend(unittest.TestCase):
             ],
             any_order=True)
 
+    def testCountsBytesSent(self):
+        """Count every byte sent, including the headers."""
+        self.handler.send(
+            {'Differential': False}, contents=data.SOCKET_WITH_EVERYTHING_DATA)
+        sent = sum(
+            len(call[0][0]) for call in self.socket.sendall.call_args_list)
+        self.assertEqual(sent, self.handler.bytes_sent)
+
     def testNoData(self):
         self.handler.send(data.SOCKET_WITH_EVERYTHING_BASE_HEADERS)
         header_lines = copy.copy(data.EVERYTHING_HEADER_LINES)
@@ -255,5 +301,131 @@ class TestSend(unittest.TestCase):
             any_order=True)
 
 
+class TestPending(unittest.TestCase):
+    """Tests for PacketHandler.pending and ready"""
+
+    def setUp(self):
+        self.near, self.far = socket.socketpair()
+        self.handler = packethandler.PacketHandler(self.near)
+
+    def tearDown(self):
+        self.near.close()
+        self.far.close()
+
+    def testPending(self):
+        """A packet is pending once data arrives or is buffered."""
+        self.assertFalse(self.handler.pending())
+        self.far.sendall(b'Size: 0\n\nSize: 0\n\n')
+        self.assertTrue(self.handler.pending(1))
+        self.handler.get()
+        self.assertTrue(self.handler.pending())
+        self.handler.get()
+        self.assertFalse(self.handler.pending())
+
+    def testReady(self):
+        """A packet is only ready once all of its data has arrived."""
+        self.assertFalse(self.handler.ready())
+        self.far.sendall(b'Size: 4\n\nab')
+        self.assertFalse(self.handler.ready())
+        self.far.sendall(b'cdSize: 0\n')
+        self.assertTrue(self.handler.ready())
+        self.assertEqual(b'abcd', self.handler.get()[1])
+        self.assertFalse(self.handler.ready())
+        self.far.sendall(b'\n')
+        self.assertTrue(self.handler.ready())
+
+
+class TestStream(unittest.TestCase):
+    """Tests for PacketHandler.stream"""
+
+    def setUp(self):
+        self.near, self.far = socket.socketpair()
+        self.sender = packethandler.PacketHandler(self.far)
+        self.handler = packethandler.PacketHandler(self.near)
+
+    def tearDown(self):
+        self.near.close()
+        self.far.close()
+
+    def testReadsLines(self):
+        """Lines are read across receives, up to the end of the packet."""
+        self.far.sendall(b'Size: 9\n\nab\ncd')
+        reader = self.handler.stream(self.handler.get_headers())
+        self.assertEqual(b'ab\n', reader.readline())
+        self.far.sendall(b'e\nfgSize: 0\n\n')
+        self.assertEqual([b'cde\n', b'fg'], list(reader))
+        self.assertEqual(b'', reader.read())
+        reader.close()
+        self.assertEqual({'Size': 0}, self.handler.get()[0])
+
+    @mock.patch.object(packethandler, 'FILE_CHUNK_SIZE', 4)
+    def testReceivesOnlyThePacket(self):
+        """The socket is read a chunk at a time, and no further."""
+        self.sender.send({}, b'0123456789')
+        self.sender.send({}, b'next')
+        with self.handler.stream(self.handler.get_headers()) as reader:
+            self.assertEqual(b'012', reader.read(3))
+            self.assertEqual(b'3456789', reader.read())
+        self.assertEqual(b'next', self.handler.get()[1])
+
+    def testCloseSkipsTheRest(self):
+        """Closing the reader skips whatever of the packet wasn't read."""
+        self.sender.send({}, b'unread')
+        self.sender.send({}, b'next')
+        with self.handler.stream(self.handler.get_headers()) as reader:
+            self.assertEqual(b'un', reader.read(2))
+        self.assertEqual(b'next', self.handler.get()[1])
+
+    def testSocketClosed(self):
+        """Raise a SocketClosedError if the packet is cut short."""
+        self.far.sendall(b'Size: 5\n\nab')
+        self.far.close()
+        reader = self.handler.stream(self.handler.get_headers())
+        with self.assertRaises(packethandler.SocketClosedError):
+            reader.read()
+
+    def testRecords(self):
+        """A streamed packet is recorded whole once it's been read."""
+        recorded = []
+        self.handler.recorder = mock.Mock(payloads=True)
+        self.handler.recorder.record.side_effect = (
+            lambda direction, headers, payload, when: recorded.append(
+                (direction, headers, payload.read())))
+        self.sender.send({'Name': 'x'}, b'payload')
+        with self.handler.stream(self.handler.get_headers()) as reader:
+            reader.read(3)
+            self.assertEqual([], recorded)
+        self.assertEqual(
+            [('received', {'Name': 'x', 'Size': 7}, b'payload')], recorded)
+
+
+class TestRanges(unittest.TestCase):
+    """Tests for PacketHandler.request_range and answer_range"""
+
+    def setUp(self):
+        self.near, self.far = socket.socketpair()
+        self.requester = packethandler.PacketHandler(self.near)
+        self.answerer = packethandler.PacketHandler(self.far)
+
+    def tearDown(self):
+        self.near.close()
+        self.far.close()
+
+    def testRange(self):
+        """A range request is answered with that range of the file."""
+        self.requester.send({'Range-Offset': 3, 'Range-Length': 4})
+        headers, _ = self.answerer.get()
+        self.answerer.answer_range(headers, io.BytesIO(b'0123456789'))
+        headers, data = self.requester.get()
+        self.assertEqual(3, headers['Offset'])
+        self.assertEqual(b'3456', data)
+
+    def testWrongRange(self):
+        """Raise ValueError if the reply is for a different range."""
+        self.answerer.send({'Offset': 1}, b'x')
+        with self.assertRaises(ValueError):
+            self.requester.request_range(0, 1)
+
+
 if __name__ == '__main__':
     unittest.main()
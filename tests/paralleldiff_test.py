@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""Tests for sshed.paralleldiff"""
+
+import difflib
+import io
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import largefile, paralleldiff
+
+from data.patching import patch
+
+
+def temporary_file(contents):
+    """Return a temporary file containing contents."""
+    file = tempfile.TemporaryFile()
+    file.write(contents)
+    file.seek(0)
+    return file
+
+
+class TestFindAnchors(unittest.TestCase):
+    """Tests for find_anchors."""
+
+    def testUniqueLines(self):
+        """Only lines occurring once in each file are anchors."""
+        original = [1, 2, 2, 3, 4, 5, 6, 7]
+        edited = [1, 2, 3, 4, 4, 5, 6, 7]
+        with mock.patch.object(paralleldiff, 'ANCHOR_SEARCH_LINES', 2):
+            anchors = paralleldiff.find_anchors(original, edited, 4)
+        self.assertEqual([(3, 2), (5, 5), (6, 6)], anchors)
+
+    def testIncreasing(self):
+        """Anchors that would cross an earlier one are skipped."""
+        original = [1, 2, 3, 4]
+        edited = [4, 3, 2, 1]
+        anchors = paralleldiff.find_anchors(original, edited, 4)
+        self.assertEqual([(1, 2)], anchors)
+
+
+class TestDiffFiles(unittest.TestCase):
+    """Tests for diff_files."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pools = {
+            workers: paralleldiff.WorkerPool(workers) for workers in (1, 2, 3)}
+
+    @classmethod
+    def tearDownClass(cls):
+        for pool in cls.pools.values():
+            pool.close()
+
+    def diff(self, original, edited, workers=2):
+        """Return the diff between two bytes objects."""
+        with temporary_file(original) as original_file, \
+                temporary_file(edited) as edited_file:
+            opcodes, original_lines, edited_lines = paralleldiff.diff_files(
+                self.pools[workers], original_file, edited_file)
+            output = io.BytesIO()
+            largefile.write_unified_diff(
+                largefile.group_opcodes(opcodes), original_lines,
+                edited_lines, output)
+            original_lines.close()
+            edited_lines.close()
+        return output.getvalue()
+
+    def testMatchesDifflib(self):
+        """The diff is identical to the one difflib generates."""
+        original = b''.join(b'line %d\n' % number for number in range(400))
+        edited = original.replace(b'line 50\n', b'line fifty\n').replace(
+            b'line 300\n', b'').replace(b'line 3\n', b'') + b'line 400\n'
+        expected = ''.join(difflib.unified_diff(
+            original.decode().splitlines(keepends=True),
+            edited.decode().splitlines(keepends=True))).encode()
+        self.assertEqual(expected, self.diff(original, edited))
+
+    def testRoundTrip(self):
+        """Scattered edits with repeated lines patch back correctly."""
+        original = b''.join(
+            b'%d\n' % (number % 13) if number % 5 else b'unique %d\n' % number
+            for number in range(1000))
+        lines = original.splitlines(keepends=True)
+        del lines[100:150]
+        lines[500:500] = [b'inserted\n'] * 30
+        lines[800] = b'changed\n'
+        edited = b''.join(lines) + b'no newline'
+        for workers in (1, 3):
+            diff = self.diff(original, edited, workers=workers)
+            self.assertEqual(edited, patch(original, diff))
+
+    def testEmptyFiles(self):
+        """Files that are empty before or after are diffed."""
+        self.assertEqual(b'', self.diff(b'', b''))
+        self.assertEqual(b'a\nb\n', patch(b'', self.diff(b'', b'a\nb\n')))
+        self.assertEqual(b'', patch(b'a\nb\n', self.diff(b'a\nb\n', b'')))
+
+
+if __name__ == '__main__':
+    unittest.main()
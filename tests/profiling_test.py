@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Tests for sshed.profiling"""
+
+import os
+import pstats
+import signal
+import tempfile
+import tracemalloc
+import unittest
+from unittest import mock
+
+from sshed import profiling, trace
+
+
+class TestProfiler(unittest.TestCase):
+    """Tests for Profiler and SessionProfile."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='profiling-')
+        self.addCleanup(self.directory.cleanup)
+
+    def testDisabled(self):
+        """Without a directory, profiling starts off."""
+        self.assertIsNone(profiling.Profiler().start('session'))
+
+    def testProfile(self):
+        """A session's profile is written when it stops."""
+        profiler = profiling.Profiler(self.directory.name)
+        profile = profiler.start('session')
+        sorted(range(1000))
+        profile.stop()
+        path = os.path.join(self.directory.name, 'session.pstats')
+        stats = pstats.Stats(path)
+        self.assertTrue(any(
+            function == '<built-in method builtins.sorted>'
+            for _, _, function in stats.stats))
+        self.assertEqual(['session.pstats'], os.listdir(self.directory.name))
+
+    def testMemory(self):
+        """The peak of each traced phase is recorded, with a snapshot."""
+        profiler = profiling.Profiler(self.directory.name, memory=True)
+        tracer = trace.Tracer()
+        tracer.profile = profiler.start('session')
+        for size in (2 ** 20, 2 ** 22, 2 ** 21):
+            with tracer.span('diff'):
+                data = bytearray(size)
+                del data
+        with tracer.span('edit'):
+            pass
+        tracer.profile.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+        peaks = [
+            span.get('process_peak_memory') for span in tracer.spans]
+        self.assertGreaterEqual(peaks[1], 2 ** 22)
+        self.assertLess(peaks[0], peaks[1])
+        self.assertIsNone(peaks[3])
+        self.assertFalse(any(span.get('shared_peak') for span in tracer.spans))
+        self.assertEqual(
+            ['session-diff.tracemalloc', 'session.pstats'],
+            sorted(os.listdir(self.directory.name)))
+        tracemalloc.Snapshot.load(
+            os.path.join(self.directory.name, 'session-diff.tracemalloc'))
+
+    def testOverlapping(self):
+        """Peaks aren't reset under another phase, and overlaps are marked."""
+        profiler = profiling.Profiler(self.directory.name, memory=True)
+        first, second = trace.Tracer(), trace.Tracer()
+        first.profile = profiler.start('first')
+        second.profile = profiler.start('second')
+        with first.span('receive'):
+            data = bytearray(2 ** 22)
+            del data
+            with second.span('diff'):
+                pass
+        with second.span('patch'):
+            pass
+        first.profile.stop()
+        second.profile.stop()
+        receive, diff, patch = first.spans[0], second.spans[0], second.spans[1]
+        self.assertGreaterEqual(diff['process_peak_memory'], 2 ** 22)
+        self.assertTrue(receive['shared_peak'])
+        self.assertTrue(diff['shared_peak'])
+        self.assertFalse(patch['shared_peak'])
+        self.assertLess(patch['process_peak_memory'], 2 ** 22)
+
+    def testAlreadyProfiling(self):
+        """A session isn't profiled if another profiler can't run with it."""
+        profiler = profiling.Profiler(self.directory.name)
+        with mock.patch(
+                'cProfile.Profile.enable',
+                side_effect=ValueError('Another profiler is active')):
+            self.assertIsNone(profiler.start('session'))
+
+    def testToggle(self):
+        """The signal turns profiling on, in a new directory, and off."""
+        profiler = profiling.Profiler()
+        previous = signal.getsignal(profiling.TOGGLE_SIGNAL)
+        self.addCleanup(signal.signal, profiling.TOGGLE_SIGNAL, previous)
+        profiling.install_toggle(profiler)
+        with self.assertLogs(level='WARNING'):
+            os.kill(os.getpid(), profiling.TOGGLE_SIGNAL)
+        self.assertTrue(profiler.enabled)
+        self.addCleanup(os.rmdir, profiler.directory)
+        self.assertTrue(os.path.isdir(profiler.directory))
+        with self.assertLogs(level='WARNING'):
+            os.kill(os.getpid(), profiling.TOGGLE_SIGNAL)
+        self.assertFalse(profiler.enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
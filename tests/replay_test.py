@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Tests for sshed.replay"""
+
+import io
+import os
+import tempfile
+import unittest
+
+from sshed import capture, manifest, replay, transfers
+
+ORIGINAL = b''.join(b'line %d\n' % line for line in range(100))
+
+
+def range_patch(offset, data):
+    """Return a range patch writing data at offset."""
+    patch = io.BytesIO()
+    manifest.write_range_patch([(offset, data)], patch)
+    return patch.getvalue()
+
+
+class TestCapturedSession(unittest.TestCase):
+    """Tests for reconstructing a session from a capture."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory(prefix='replay-')
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, 'session.capture')
+
+    def write_capture(self, packets, payloads=True, side='host'):
+        """Write (direction, time, headers, payload) tuples to a capture."""
+        recorder = capture.Recorder(self.path, side, payloads=payloads)
+        for direction, when, headers, payload in packets:
+            headers = dict(headers, Size=len(payload))
+            recorder.record(direction, headers, payload, when=when)
+        recorder.close()
+
+    def saves(self, direction='received'):
+        """Return captured packets for a range patch and a whole file save."""
+        first = ORIGINAL.replace(b'line 0\n', b'LINE 0\n')
+        return [
+            (direction, 1.5, {
+                'Differential': True, 'Diff-Format': 'ranges',
+                'Filesize': len(first),
+                'Checksum': transfers.checksum(first)},
+             range_patch(0, b'LINE')),
+            (direction, 2.5, {'Differential': False}, b'replaced\n'),
+        ], first
+
+    def testVersions(self):
+        """Each save is applied to the file as sent."""
+        saves, first = self.saves()
+        self.write_capture([
+            ('sent', 0.5, {'Version': 1, 'Filesize': len(ORIGINAL)},
+             ORIGINAL)] + saves)
+        session = replay.load(self.path)
+        self.assertEqual([ORIGINAL, first, b'replaced\n'], session.versions)
+        self.assertEqual([1.0, 2.0], session.delays)
+        self.assertNotIn('Size', session.headers)
+
+    def testResumable(self):
+        """A file sent in chunks is put back together."""
+        saves, first = self.saves(direction='sent')
+        self.write_capture([
+            ('received', 0, {
+                'Version': 1, 'Filesize': len(ORIGINAL), 'Resumable': True,
+                'Transfer-Id': 'id'}, b''),
+            ('sent', 0.1, {'Resume-Offset': 0}, b''),
+            ('received', 0.2, {'Offset': 0}, ORIGINAL[:300]),
+            ('received', 0.5, {'Offset': 300}, ORIGINAL[300:]),
+        ] + saves, side='client')
+        session = replay.load(self.path)
+        self.assertEqual([ORIGINAL, first, b'replaced\n'], session.versions)
+        self.assertEqual([1.0, 2.0], session.delays)
+
+    def testNoPayloads(self):
+        """A capture without payloads can't be replayed."""
+        self.write_capture(
+            [('sent', 0, {'Version': 1}, ORIGINAL)], payloads=False)
+        self.assertRaises(ValueError, replay.load, self.path)
+
+    def testNotEditing(self):
+        """Only sessions editing a single file can be replayed."""
+        self.write_capture([('sent', 0, {'Version': 1, 'View': True}, b'')])
+        self.assertRaises(ValueError, replay.load, self.path)
+
+
+class TestReplay(unittest.TestCase):
+    """Tests for replaying a session against sshed and sshed_client."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory(prefix='replay-')
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'session.capture')
+        first = ORIGINAL.replace(b'line 5\n', b'LINE 5\n')
+        recorder = capture.Recorder(path, 'host', payloads=True)
+        recorder.record('sent', {
+            'Version': 1, 'Filename': 'file', 'Filesize': len(ORIGINAL),
+            'Differential': True, 'Diff-Formats': 'unified,ranges',
+            'Size': len(ORIGINAL)}, ORIGINAL, when=0)
+        patch = range_patch(ORIGINAL.index(b'line 5'), b'LINE')
+        recorder.record('received', {
+            'Differential': True, 'Diff-Format': 'ranges',
+            'Filesize': len(first), 'Checksum': transfers.checksum(first),
+            'Size': len(patch)}, patch, when=0.1)
+        recorder.close()
+        self.session = replay.load(path)
+
+    def testHost(self):
+        """sshed ends up with the file as last saved."""
+        results = replay.replay_host(self.session, speed=0, timeout=30)
+        self.assertEqual(0, results['exit_status'])
+        self.assertTrue(results['matches'])
+        self.assertIn('Final file matches the capture: yes',
+                      replay.format_results(results))
+
+    def testClient(self):
+        """The saves made through sshed_client reach the host."""
+        results = replay.replay_client(self.session, timeout=30)
+        self.assertEqual([], results['errors'])
+        self.assertTrue(results['matches'])
+        self.assertEqual(1, results['saves_applied'])
+
+
+if __name__ == '__main__':
+    unittest.main()
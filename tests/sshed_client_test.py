@@ -71,6 +71,36 @@ class TestWaitUntilEditOrExit(unittest.TestCase):
         self.assertEqual(2, sleep.call_count)
         sleep.assert_called_with(0.001)
 
+    @mock.patch('time.sleep')
+    @mock.patch('os.path.getmtime')
+    def testPacketArrives(self, getmtime, sleep):
+        """Return when a packet arrives on the packet handler passed."""
+        self.process.poll.return_value = None
+        getmtime.return_value = 0
+        packet_handler = mock.Mock()
+        packet_handler.pending.side_effect = [False, True]
+        self.assertIsNone(sshed_client.wait_until_edit_or_exit(
+            'filename', 0, self.process, sleep_time=0.001,
+            packet_handler=packet_handler))
+        packet_handler.pending.assert_called_with(0.001)
+        self.assertEqual(2, packet_handler.pending.call_count)
+        self.assertEqual(0, sleep.call_count)
+
+    @mock.patch('time.monotonic')
+    @mock.patch('time.sleep')
+    @mock.patch('os.path.getmtime')
+    def testIdle(self, getmtime, sleep, monotonic):
+        """Call on_idle once when the wait passes idle_time."""
+        del sleep
+        monotonic.side_effect = [0, 5, 10]
+        self.process.poll.side_effect = [None, None, None, 0]
+        getmtime.return_value = 0
+        on_idle = mock.Mock()
+        sshed_client.wait_until_edit_or_exit(
+            'filename', 0, self.process, on_idle=on_idle, idle_time=10)
+        on_idle.assert_called_once_with()
+        self.assertEqual(4, self.process.poll.call_count)
+
 
 class TestSocketRequestHandler(unittest.TestCase):
     # TODO: Tests for SocketRequestHandler
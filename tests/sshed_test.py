@@ -2,6 +2,8 @@
 """Tests for sshed.sshed"""
 
 from copy import copy
+import difflib
+import io
 import logging
 import os
 import socket
@@ -10,7 +12,7 @@ import tempfile
 import unittest
 from unittest import mock
 
-from sshed import sshed
+from sshed import merge, packethandler, sshed, trace, transfers
 
 from data import diff1
 from data import hunks_data
@@ -53,6 +55,99 @@ class TestParseArguments(unittest.TestCase):
         self.assertEqual(args.file, 'filename')
         self.assertEqual(args.socket_address, 'socket_address')
 
+    def testPrefetch(self):
+        args = sshed.parse_arguments(args=['--prefetch', 'one', 'two'])
+        self.assertIsNone(args.file)
+        self.assertEqual(['one', 'two'], args.prefetch)
+
+    @mock.patch('sys.stderr')
+    def testPrefetchAndFile(self, _):
+        """A file can't be edited while prefetching."""
+        with self.assertRaises(SystemExit):
+            sshed.parse_arguments(['filename', '--prefetch', 'other'])
+
+
+class TestExpandPaths(unittest.TestCase):
+    """Tests for sshed.expand_paths."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for name in ('a.txt', 'b.log', 'sub/c.txt', 'sub/deeper/d.txt'):
+            path = os.path.join(self.directory.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as file:
+                file.write(name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        """Return the path of a file in the temporary directory."""
+        return os.path.join(self.directory.name, name)
+
+    def testGlobsAndDirectories(self):
+        """Expand globs, search directories and remove duplicates."""
+        self.assertEqual(
+            [self.path('a.txt'), self.path('sub/c.txt'),
+             self.path('sub/deeper/d.txt')],
+            sshed.expand_paths([
+                self.path('*.txt'), self.path('sub'), self.path('a.txt')]))
+
+    def testMissingFiles(self):
+        """Paths that don't exist are skipped."""
+        self.assertEqual([], sshed.expand_paths([self.path('missing')]))
+
+    @mock.patch('os.fork')
+    @mock.patch('sshed.sshed.find_socket', return_value='socket')
+    def testPrefetchSmallFiles(self, _, fork):
+        """Each file too small to prefetch is logged, and nothing is sent."""
+        args = sshed.parse_arguments(
+            ['--prefetch', self.path('*.txt'), self.path('sub')])
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(0, sshed.prefetch(args, trace.Tracer()))
+        self.assertEqual(4, len(logs.output))
+        self.assertIn(self.path('a.txt'), logs.output[0])
+        fork.assert_not_called()
+
+
+class TestApplyTreeChange(unittest.TestCase):
+    """Tests for sshed.apply_tree_change."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+
+    def testWrite(self):
+        """A whole file is written at its path in the tree."""
+        sshed.apply_tree_change(self.root, {'Path': 'sub/new.txt'}, b'new\n')
+        with open(os.path.join(self.root, 'sub/new.txt'), 'rb') as file:
+            self.assertEqual(b'new\n', file.read())
+
+    def testNoPath(self):
+        """A change without a path is refused."""
+        for headers in ({}, {'Path': ''}, {'Path': 3}):
+            with self.assertRaises(ValueError):
+                sshed.apply_tree_change(self.root, headers, b'data')
+        self.assertEqual([], os.listdir(self.root))
+
+    def testMalformed(self):
+        """A diff that can't be applied leaves the file alone."""
+        with open(os.path.join(self.root, 'file'), 'wb') as file:
+            file.write(b'a\nb\n')
+        with self.assertRaises(sshed.MalformedDiff):
+            sshed.apply_tree_change(
+                self.root, {'Path': 'file', 'Differential': True},
+                b'@@ -5,1 +5,1 @@\n-x\n+y\n')
+        with open(os.path.join(self.root, 'file'), 'rb') as file:
+            self.assertEqual(b'a\nb\n', file.read())
+
+    def testEditorFile(self):
+        """Changes to editor swap and backup files are ignored."""
+        for path in ('.file.swp', 'sub/file~', '4913'):
+            sshed.apply_tree_change(self.root, {'Path': path}, b'swap')
+        self.assertEqual([], os.listdir(self.root))
+
 
 class TestChooseEditor(unittest.TestCase):
     """Test editor options."""
@@ -332,6 +427,430 @@ class testPatcher(unittest.TestCase):
             self.assertEqual(output, expected_file.read())
 
 
+class TestMappedPatcher(unittest.TestCase):
+    """Tests for MappedPatcher."""
+
+    def patch(self, original, diff):
+        """Patch original (as bytes) with both patchers, checking they agree.
+
+        Returns:
+            The patched file, as bytes.
+        """
+        with tempfile.TemporaryFile() as file:
+            file.write(original)
+            file.seek(0)
+            patched = sshed.MappedPatcher(file, list(diff)).patch()
+        self.assertEqual(
+            sshed.Patcher(io.BytesIO(original), list(diff)).patch(), patched)
+        return patched
+
+    def testPatch(self):
+        with open(os.path.join(
+                os.path.dirname(os.path.realpath(__file__)),
+                'data/diff1_original.txt'), mode='rb') as original_file:
+            original = original_file.read()
+        self.assertEqual(diff1.FINAL, self.patch(original, diff1.DIFF))
+
+    @mock.patch.object(sshed, 'SKIP_BLOCK_SIZE', 16)
+    @mock.patch.object(sshed, 'IOV_MAX', 3)
+    def testManyHunks(self):
+        """Unchanged lines are skipped in blocks and written in batches."""
+        original = b''.join(b'line %d\n' % number for number in range(500))
+        edited = original.replace(b'line 7\n', b'').replace(
+            b'line 250\n', b'changed\nadded\n') + b'last\n'
+        diff = list(difflib.diff_bytes(
+            difflib.unified_diff, original.splitlines(keepends=True),
+            edited.splitlines(keepends=True)))
+        self.assertEqual(edited, self.patch(original, diff))
+
+    def testShortWrites(self):
+        """Writes that stop short carry on from where they stopped."""
+        writev = os.writev
+
+        def short_writev(descriptor, buffers):
+            """Write at most five bytes."""
+            return writev(descriptor, [bytes(b''.join(buffers)[:5])])
+
+        with mock.patch('os.writev', short_writev):
+            self.assertEqual(
+                b'a\nc\n', self.patch(b'a\nb\n', [
+                    b'@@ -1,2 +1,2 @@\n', b' a\n', b'-b\n', b'+c\n']))
+
+    def testStreaming(self):
+        """StreamingPatcher reads the diff as it goes."""
+        original = b''.join(b'line %d\n' % number for number in range(50))
+        edited = original.replace(b'line 20\n', b'changed\n')
+        diff = difflib.diff_bytes(
+            difflib.unified_diff, original.splitlines(keepends=True),
+            edited.splitlines(keepends=True))
+        with tempfile.TemporaryFile() as file:
+            file.write(original)
+            self.assertEqual(
+                edited, sshed.StreamingPatcher(file, diff).patch())
+
+    def testMalformed(self):
+        with tempfile.TemporaryFile() as file:
+            file.write(b'a\nb\n')
+            file.seek(0)
+            patcher = sshed.MappedPatcher(
+                file, [b'@@ -1,2 +1,1 @@\n', b' a\n', b'-c\n'])
+            with self.assertRaises(sshed.MalformedDiff):
+                patcher.patch()
+
+
+class TestAwaitAcceptance(unittest.TestCase):
+    """Tests for await_acceptance."""
+
+    def setUp(self):
+        self.near, self.far = socket.socketpair()
+        self.addCleanup(self.near.close)
+        self.addCleanup(self.far.close)
+        self.host = packethandler.PacketHandler(self.near)
+        self.client = packethandler.PacketHandler(self.far)
+
+    def testVersion1(self):
+        """Version 1 sessions aren't answered."""
+        sshed.await_acceptance(self.host, {'Version': 1})
+        self.assertFalse(self.host.pending())
+
+    def testAccepted(self):
+        self.client.send({'Accepted-Version': 2})
+        sshed.await_acceptance(self.host, {'Version': 2})
+
+    def testDropped(self):
+        """A client that drops the connection is too old."""
+        self.far.close()
+        with self.assertRaises(sshed.ClientTooOld):
+            sshed.await_acceptance(self.host, {'Version': 2})
+
+    def testVersion1Headers(self):
+        headers = sshed.version_1_headers({
+            'Version': 2, 'Filename': 'f', 'Resumable': True,
+            'Transfer-Id': 'x', 'Chunk-Size': 4, 'External': True})
+        self.assertEqual({'Version': 1, 'Filename': 'f'}, headers)
+
+
+class TestSendExternalChange(unittest.TestCase):
+    """Tests for send_external_change."""
+
+    def setUp(self):
+        self.handler = mock.Mock()
+
+    def sent(self):
+        """Return the headers and data sent."""
+        return self.handler.send.call_args[0]
+
+    def testDiff(self):
+        """A small change to a large file is sent as a diff that applies."""
+        baseline = b''.join(b'line %d\n' % number for number in range(100))
+        contents = baseline.replace(b'line 50\n', b'changed\n')
+        sshed.send_external_change(self.handler, baseline, contents)
+        headers, data = self.sent()
+        self.assertIs(True, headers['Differential'])
+        self.assertEqual(transfers.checksum(baseline), headers['Base-Checksum'])
+        patched = sshed.Patcher(
+            io.BytesIO(baseline), data.splitlines(keepends=True)).patch()
+        self.assertEqual(contents, patched)
+
+    def testNoNewlineAtEnd(self):
+        """A file without a newline at its end is sent whole."""
+        sshed.send_external_change(self.handler, b'a\nb', b'a\nc')
+        headers, data = self.sent()
+        self.assertIs(False, headers['Differential'])
+        self.assertEqual(b'a\nc', data)
+
+
+DIFF_B_TO_C = b'@@ -1,2 +1,2 @@\n a\n-b\n+c\n'
+DIFF_C_TO_D = b'@@ -1,2 +1,2 @@\n a\n-c\n+d\n'
+
+
+class TestStagedFile(unittest.TestCase):
+    """Tests for StagedFile."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'file')
+        with open(self.path, 'wb') as file:
+            file.write(b'old')
+        os.chmod(self.path, 0o640)
+
+    def install(self):
+        """Stage new contents and install them, returning the file."""
+        staged = sshed.StagedFile(self.path)
+        staged.file.write(b'new')
+        file = staged.install(open(self.path, 'r+b'))
+        self.addCleanup(file.close)
+        file.seek(0)
+        return file
+
+    def testRenamed(self):
+        """The new version takes the file's place, keeping its mode."""
+        inode = os.stat(self.path).st_ino
+        self.assertEqual(b'new', self.install().read())
+        self.assertNotEqual(inode, os.stat(self.path).st_ino)
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(self.path).st_mode))
+        self.assertEqual(['file'], os.listdir(os.path.dirname(self.path)))
+
+    def testHardLinkCopied(self):
+        """A file with other links is written in place."""
+        os.link(self.path, self.path + '.link')
+        self.assertEqual(b'new', self.install().read())
+        with open(self.path + '.link', 'rb') as link:
+            self.assertEqual(b'new', link.read())
+        self.assertEqual(
+            ['file', 'file.link'],
+            sorted(os.listdir(os.path.dirname(self.path))))
+
+    def testExtendedAttributesKept(self):
+        """The file's extended attributes are copied to the new version."""
+        try:
+            os.setxattr(self.path, 'user.sshed', b'kept')
+        except (AttributeError, OSError):
+            self.skipTest('Extended attributes are not supported here.')
+        inode = os.stat(self.path).st_ino
+        self.assertEqual(b'new', self.install().read())
+        self.assertNotEqual(inode, os.stat(self.path).st_ino)
+        self.assertEqual(b'kept', os.getxattr(self.path, 'user.sshed'))
+
+    @mock.patch(
+        'sshed.sshed.copy_extended_attributes', return_value=False)
+    def testExtendedAttributesLost(self, _):
+        """Where extended attributes can't be kept, it's written in place."""
+        inode = os.stat(self.path).st_ino
+        self.assertEqual(b'new', self.install().read())
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+        self.assertEqual(['file'], os.listdir(os.path.dirname(self.path)))
+
+
+class TestApplySaves(unittest.TestCase):
+    """Tests for apply_saves."""
+
+    def setUp(self):
+        near, far = socket.socketpair()
+        self.addCleanup(near.close)
+        self.addCleanup(far.close)
+        self.sender = packethandler.PacketHandler(far)
+        self.receiver = packethandler.PacketHandler(near)
+        self.tracer = trace.Tracer()
+        file = tempfile.NamedTemporaryFile(delete=False)
+        file.write(b'a\nb\n')
+        file.close()
+        self.path = file.name
+        self.addCleanup(os.remove, self.path)
+
+    def apply(self, *saves):
+        """Send saves and apply them, returning the file's new contents."""
+        for headers, data in saves:
+            self.sender.send(headers, data)
+        file = open(self.path, 'r+b')
+        try:
+            file = sshed.apply_saves(
+                self.receiver, self.tracer, self.receiver.get_headers(), file)
+        finally:
+            file.close()
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def testWhole(self):
+        self.assertEqual(
+            b'new', self.apply(({'Differential': False}, b'new')))
+
+    def testDifferential(self):
+        self.assertEqual(
+            b'a\nc\n', self.apply(({'Differential': True}, DIFF_B_TO_C)))
+
+    def testClosed(self):
+        """A save is still applied when the client hangs up after it."""
+        self.sender.send({'Differential': False}, b'new')
+        self.sender.socket.close()
+        with open(self.path, 'r+b') as file:
+            sshed.apply_saves(
+                self.receiver, self.tracer, self.receiver.get_headers(),
+                file).close()
+        with open(self.path, 'rb') as file:
+            self.assertEqual(b'new', file.read())
+
+    def testRangePatch(self):
+        self.assertEqual(b'a\nx\n', self.apply(({
+            'Differential': True, 'Diff-Format': 'ranges',
+            'Filesize': 4}, b'2 1\nx')))
+
+    def testRangePatchChecksumMismatch(self):
+        """A range patch that doesn't match its checksum isn't applied."""
+        with self.assertRaises(sshed.ChecksumMismatch):
+            self.apply(({
+                'Differential': True, 'Diff-Format': 'ranges',
+                'Filesize': 4, 'Checksum': 'bogus'}, b'2 1\nx'))
+        with open(self.path, 'rb') as file:
+            self.assertEqual(b'a\nb\n', file.read())
+
+    @mock.patch('sshed.workdir.reflink', return_value=False)
+    def testRangePatchInPlace(self, _):
+        """Without reflinks, a range patch is written to the file in place."""
+        inode = os.stat(self.path).st_ino
+        self.assertEqual(b'a\nx\n', self.apply(({
+            'Differential': True, 'Diff-Format': 'ranges',
+            'Filesize': 4}, b'2 1\nx')))
+        self.assertEqual(inode, os.stat(self.path).st_ino)
+
+    def cutShort(self):
+        """Send a range patch cut short, checking the file is left alone."""
+        self.sender.socket.sendall(
+            b'Differential: True\nDiff-Format: ranges\nFilesize: 4\n'
+            b'Size: 100\n\n0 3\nxyz')
+        self.sender.socket.close()
+        with self.assertRaises(packethandler.SocketClosedError):
+            self.apply()
+        with open(self.path, 'rb') as file:
+            self.assertEqual(b'a\nb\n', file.read())
+
+    @mock.patch('sshed.workdir.reflink', return_value=True)
+    def testCutShort(self, _):
+        """A save cut short by the connection closing isn't applied."""
+        self.cutShort()
+
+    @mock.patch('sshed.workdir.reflink', return_value=False)
+    def testCutShortInPlace(self, _):
+        """Nor is one that would have been applied in place."""
+        self.cutShort()
+
+    def testMalformed(self):
+        """A save that doesn't apply is skipped, and the next one read."""
+        with self.assertRaises(sshed.MalformedDiff):
+            self.apply(({'Differential': True}, DIFF_C_TO_D))
+        with open(self.path, 'rb') as file:
+            self.assertEqual(b'a\nb\n', file.read())
+        self.sender.send({'Differential': True}, DIFF_B_TO_C)
+        self.assertEqual(b'a\nc\n', self.apply())
+
+    def testComposed(self):
+        """Queued saves are applied in turn, and the file replaced once."""
+        self.assertEqual(b'a\nd\n', self.apply(
+            ({'Differential': False}, b'a\nc\n'),
+            ({'Differential': True,
+              'Checksum': transfers.checksum(b'a\nd\n')}, DIFF_C_TO_D)))
+        self.assertEqual(2, self.tracer.summary()['saves'])
+        patches = [
+            span for span in self.tracer.spans if span['span'] == 'patch']
+        self.assertEqual([2], [span['saves'] for span in patches])
+
+    def testComposedOnce(self):
+        """However many saves queue up, one file is staged beside the file."""
+        staged = mock.Mock(wraps=sshed.StagedFile)
+        with mock.patch.object(sshed, 'StagedFile', staged):
+            self.assertEqual(b'a\nc\n', self.apply(
+                ({'Differential': False}, b'a\nb\n'),
+                ({'Differential': True}, DIFF_B_TO_C),
+                ({'Differential': True}, DIFF_C_TO_D),
+                ({'Differential': False}, b'a\nb\n'),
+                ({'Differential': True}, DIFF_B_TO_C)))
+        staged.assert_called_once_with(self.path)
+
+    def testChecksumMismatch(self):
+        """The file is left alone and the saves queued behind skipped."""
+        with self.assertRaises(sshed.ChecksumMismatch):
+            self.apply(
+                ({'Differential': True,
+                  'Checksum': transfers.checksum(b'a\nb\n')}, DIFF_B_TO_C),
+                ({'Differential': True}, DIFF_C_TO_D))
+        with open(self.path, 'rb') as file:
+            self.assertEqual(b'a\nb\n', file.read())
+        self.assertFalse(self.receiver.pending())
+        directory, name = os.path.split(self.path)
+        self.assertEqual([], [
+            staged for staged in os.listdir(directory)
+            if staged.startswith('.%s.' % name)])
+
+
+class TestReceiveSaves(unittest.TestCase):
+    """Tests for receive_saves."""
+
+    def testQueued(self):
+        """Every save that has fully arrived is received together."""
+        near, far = socket.socketpair()
+        self.addCleanup(near.close)
+        self.addCleanup(far.close)
+        sender = packethandler.PacketHandler(far)
+        receiver = packethandler.PacketHandler(near)
+        sender.send({'Differential': False}, b'one')
+        sender.send({'Differential': False}, b'two')
+        far.sendall(b'Size: 5\n\nthr')
+        saves = sshed.receive_saves(
+            receiver, trace.Tracer(), receiver.get_headers())
+        self.assertEqual([b'one', b'two'], [data for _, data in saves])
+
+
+class TestMergeSaves(unittest.TestCase):
+    """Tests for merge_saves."""
+
+    def testQueuedWithHostChange(self):
+        """Each queued save is merged with what the host has changed."""
+        baselines = merge.Baselines(b'a\nb\nx\n')
+        result, saved = sshed.merge_saves([
+            ({'Differential': False,
+              'Base-Checksum': transfers.checksum(b'a\nb\nx\n')},
+             b'a\nc\nx\n'),
+            ({'Differential': True,
+              'Base-Checksum': transfers.checksum(b'a\nc\nx\n')},
+             DIFF_C_TO_D),
+        ], baselines, b'a\nb\ny\n')
+        self.assertEqual(b'a\nd\ny\n', result)
+        self.assertEqual(b'a\nd\nx\n', saved)
+        self.assertEqual(saved, baselines.current)
+
+
+
+class TestEditSynced(unittest.TestCase):
+    """Tests for edit_synced."""
+
+    def setUp(self):
+        near, far = socket.socketpair()
+        self.addCleanup(near.close)
+        self.sender = packethandler.PacketHandler(far)
+        self.receiver = packethandler.PacketHandler(near)
+        file = tempfile.NamedTemporaryFile(delete=False)
+        file.write(b'a\nb\nx\n')
+        file.close()
+        self.path = file.name
+        self.addCleanup(os.remove, self.path)
+
+    def edit(self, host_change=None):
+        """Send a save of b'a\nc\nx\n' and return the file afterwards."""
+        self.sender.send({
+            'Differential': False,
+            'Base-Checksum': transfers.checksum(b'a\nb\nx\n')},
+            b'a\nc\nx\n')
+        self.sender.socket.close()
+        args = mock.Mock(file=self.path)
+        if host_change is None:
+            self.assertEqual(0, sshed.edit_synced(
+                args, trace.Tracer(), self.receiver, b'a\nb\nx\n'))
+        else:
+            # The file changes on the host after it was sent.
+            state = sshed._file_state(self.path)
+            with open(self.path, 'wb') as file:
+                file.write(host_change)
+            with mock.patch.object(
+                    sshed, '_file_state',
+                    side_effect=[state, sshed._file_state(self.path)]):
+                self.assertEqual(0, sshed.edit_synced(
+                    args, trace.Tracer(), self.receiver, b'a\nb\nx\n'))
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    @mock.patch('sshed.sshed.apply_saves', wraps=sshed.apply_saves)
+    def testApplied(self, apply_saves):
+        """Saves are applied by apply_saves while the host leaves the file."""
+        self.assertEqual(b'a\nc\nx\n', self.edit())
+        apply_saves.assert_called_once()
+
+    @mock.patch('sshed.sshed.apply_saves', wraps=sshed.apply_saves)
+    def testMerged(self, apply_saves):
+        """Saves are merged with changes the host made meanwhile."""
+        self.assertEqual(b'a\nc\ny\n', self.edit(b'a\nb\ny\n'))
+        apply_saves.assert_not_called()
+
 if __name__ == "__main__":
     # logging.basicConfig(level=logging.DEBUG)
     unittest.main()
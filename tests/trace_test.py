@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tests for sshed.trace"""
+
+import json
+import tempfile
+import unittest
+
+from sshed import trace
+
+
+class TestTracer(unittest.TestCase):
+    """Tests for Tracer."""
+
+    def testSpanRecordsDurationAndCounts(self):
+        """A span keeps its counts, including those added while running."""
+        tracer = trace.Tracer(session='session')
+        with tracer.span('receive', raw_size=10) as span:
+            span['received'] = 4
+        self.assertEqual(1, len(tracer.spans))
+        span = tracer.spans[0]
+        self.assertEqual('session', span['session'])
+        self.assertEqual('receive', span['span'])
+        self.assertEqual(10, span['raw_size'])
+        self.assertEqual(4, span['received'])
+        self.assertGreaterEqual(span['duration'], 0)
+
+    def testSpanRecordedOnException(self):
+        """A span is still recorded when its body raises."""
+        tracer = trace.Tracer()
+        with self.assertRaises(ValueError):
+            with tracer.span('patch'):
+                raise ValueError()
+        self.assertEqual('patch', tracer.spans[0]['span'])
+
+    def testWritesJsonLines(self):
+        """Each span is appended to the trace file as a line of JSON."""
+        with tempfile.NamedTemporaryFile(mode='r') as trace_file:
+            tracer = trace.Tracer(trace_file.name)
+            with tracer.span('connect'):
+                pass
+            with tracer.span('send', sent=3):
+                pass
+            lines = [json.loads(line) for line in trace_file]
+        self.assertEqual(['connect', 'send'], [l['span'] for l in lines])
+        self.assertEqual(3, lines[1]['sent'])
+
+    def testSummary(self):
+        """The summary adds up the bytes saved by differential saves."""
+        tracer = trace.Tracer()
+        with tracer.span(
+                'receive', differential=True, raw_size=1000, received=100):
+            pass
+        with tracer.span(
+                'receive', differential=False, raw_size=50, received=60):
+            pass
+        summary = tracer.summary()
+        self.assertEqual(2, summary['saves'])
+        self.assertEqual(1, summary['differential'])
+        self.assertEqual(1050, summary['raw'])
+        self.assertEqual(160, summary['transferred'])
+        self.assertEqual(890, summary['saved'])
+        self.assertIn('890 bytes', tracer.format_summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Tests for sshed.transfers"""
+
+import io
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import packethandler, transfers
+
+
+class TestTransferId(unittest.TestCase):
+    """Tests for transfer_id."""
+
+    def testChangesWithFile(self):
+        """The ID changes when the file is modified."""
+        with tempfile.NamedTemporaryFile() as file:
+            file.write(b'contents')
+            file.flush()
+            first = transfers.transfer_id(file.name)
+            self.assertEqual(first, transfers.transfer_id(file.name))
+            os.utime(file.name, ns=(0, 0))
+            self.assertNotEqual(first, transfers.transfer_id(file.name))
+
+
+class TestSendChunks(unittest.TestCase):
+    """Tests for send_chunks."""
+
+    def testFromOffset(self):
+        """Send checksummed chunks starting from an offset."""
+        handler = mock.Mock()
+        transfers.send_chunks(
+            handler, io.BytesIO(b'0123456789'), 3, 10, chunk_size=4)
+        self.assertEqual([
+            mock.call({
+                'Offset': 3, 'Checksum': transfers.checksum(b'3456')},
+                b'3456'),
+            mock.call({
+                'Offset': 7, 'Checksum': transfers.checksum(b'789')},
+                b'789'),
+        ], handler.send.call_args_list)
+
+    def testFileShrank(self):
+        """Raise EOFError if the file is shorter than expected."""
+        with self.assertRaises(EOFError):
+            transfers.send_chunks(mock.Mock(), io.BytesIO(b'0123'), 0, 10)
+
+
+class TestChunkStream(unittest.TestCase):
+    """Tests for ChunkWriter and ChunkReader."""
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def testRoundTrip(self):
+        """Data written in pieces is read back whole, then nothing."""
+        writer = transfers.ChunkWriter(
+            packethandler.PacketHandler(self.sender), chunk_size=4)
+        writer.write(b'0123456')
+        writer.write(b'789')
+        writer.close()
+        reader = transfers.ChunkReader(
+            packethandler.PacketHandler(self.receiver))
+        self.assertEqual(b'01', reader.read(2))
+        self.assertEqual(b'23456', reader.read(5))
+        self.assertEqual(b'789', reader.read())
+        self.assertTrue(reader.finished)
+        self.assertEqual(b'', reader.read(1))
+
+    def testCorruptChunk(self):
+        """A chunk that doesn't match its checksum raises ValueError."""
+        packethandler.PacketHandler(self.sender).send(
+            {'Offset': 0, 'Checksum': transfers.checksum(b'other')}, b'data')
+        reader = transfers.ChunkReader(
+            packethandler.PacketHandler(self.receiver))
+        with self.assertRaises(ValueError):
+            reader.read()
+
+
+class TestTransferStore(unittest.TestCase):
+    """Tests for TransferStore."""
+
+    def setUp(self):
+        self.store = transfers.TransferStore(timeout=10)
+
+    def testClaimNew(self):
+        """Claiming an unknown transfer starts a new one."""
+        partial = self.store.claim('id')
+        self.assertEqual(0, partial.size)
+
+    def testClaimIntoFile(self):
+        """A new transfer can be received into a given file."""
+        with tempfile.TemporaryFile() as file:
+            partial = self.store.claim('id', file=file)
+            self.assertIs(file, partial.file)
+            partial.write(b'data')
+            self.store.suspend('id', partial)
+            self.assertIs(partial, self.store.claim('id', file=io.BytesIO()))
+            file.seek(0)
+            self.assertEqual(b'data', file.read())
+
+    def testResume(self):
+        """A suspended transfer can be claimed once."""
+        partial = self.store.claim('id')
+        partial.write(b'data')
+        self.store.suspend('id', partial)
+        self.assertEqual(1, len(self.store))
+        resumed = self.store.claim('id')
+        self.assertIs(partial, resumed)
+        self.assertEqual(4, resumed.size)
+        self.assertEqual(0, len(self.store))
+        self.assertTrue(resumed.file._rolled)
+
+    def testHeld(self):
+        """Report how much of a suspended transfer is held."""
+        self.assertEqual(0, self.store.held('id'))
+        partial = self.store.claim('id')
+        partial.write(b'data')
+        self.store.suspend('id', partial)
+        self.assertEqual(4, self.store.held('id'))
+
+    @mock.patch('time.monotonic')
+    def testExpire(self, monotonic):
+        """Suspended transfers are discarded after the timeout."""
+        monotonic.return_value = 100
+        partial = self.store.claim('id')
+        self.store.suspend('id', partial)
+        monotonic.return_value = 109
+        self.store.expire()
+        self.assertEqual(1, len(self.store))
+        monotonic.return_value = 110
+        self.store.expire()
+        self.assertEqual(0, len(self.store))
+        self.assertTrue(partial.file.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
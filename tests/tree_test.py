@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Tests for sshed.tree"""
+
+import io
+import os
+import tarfile
+import tempfile
+import unittest
+
+from sshed import tree
+
+
+class TestIncluded(unittest.TestCase):
+    """Tests for included."""
+
+    def testNoFilters(self):
+        self.assertTrue(tree.included('a/b.txt'))
+
+    def testInclude(self):
+        """Paths must match an include pattern if there are any."""
+        self.assertTrue(tree.included('a/b.conf', include=['*.conf']))
+        self.assertTrue(tree.included('conf.d/b', include=['conf.d']))
+        self.assertFalse(tree.included('a/b.txt', include=['*.conf']))
+
+    def testExclude(self):
+        """Excluding a directory excludes everything in it."""
+        self.assertFalse(tree.included('.git/config', exclude=['.git']))
+        self.assertFalse(
+            tree.included('a.conf', include=['*.conf'], exclude=['a.*']))
+        self.assertTrue(tree.included('b.conf', exclude=['a.*']))
+
+    def testEditorFiles(self):
+        """Editor swap and backup files are always excluded."""
+        for path in ('.a.swp', 'a/.b.conf.swo', 'b.conf~', '.#b', '#b#'):
+            self.assertFalse(tree.included(path, include=['*']), path)
+        self.assertTrue(tree.included('a/b.swap'))
+
+
+class TestTree(unittest.TestCase):
+    """Tests for the functions that look at a directory tree."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        for name in ('b.txt', 'a/c.txt', '.git/config'):
+            self.write(name, name)
+        os.symlink('/etc/passwd', os.path.join(self.root, 'link'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, contents):
+        """Write contents to a file in the tree."""
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(contents)
+
+    def testWalkFiles(self):
+        """Only regular files that pass the filters are found."""
+        self.assertEqual(
+            ['a/c.txt', 'b.txt'], tree.walk_files(self.root, exclude=['.git']))
+
+    def testChangedPaths(self):
+        """Modified, new and removed files are all changes."""
+        before = tree.snapshot(self.root)
+        self.write('b.txt', 'longer contents')
+        self.write('new.txt', 'new')
+        os.remove(os.path.join(self.root, 'a/c.txt'))
+        self.assertEqual(
+            ['a/c.txt', 'b.txt', 'new.txt'],
+            tree.changed_paths(before, tree.snapshot(self.root)))
+
+    def testSafePath(self):
+        """Paths may not leave the tree."""
+        self.assertEqual(
+            os.path.join(self.root, 'a', 'c.txt'),
+            tree.safe_path(self.root, 'a/c.txt'))
+        for path in ('', '/etc/passwd', '../outside', 'a/../../outside',
+                     'link'):
+            with self.assertRaises(ValueError):
+                tree.safe_path(self.root, path)
+
+
+class TestExtract(unittest.TestCase):
+    """Tests for extract."""
+
+    def testSkipsUnsafeMembers(self):
+        """Only regular files and directories inside the root are extracted."""
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode='w|') as archive:
+            for name in ('good.txt', '../evil.txt', 'dir/nested.txt'):
+                info = tarfile.TarInfo(name)
+                info.size = len(name)
+                archive.addfile(info, io.BytesIO(name.encode()))
+            link = tarfile.TarInfo('link')
+            link.type = tarfile.SYMTYPE
+            link.linkname = '/etc/passwd'
+            archive.addfile(link)
+        data.seek(0)
+        with tempfile.TemporaryDirectory() as directory:
+            root = os.path.join(directory, 'root')
+            os.mkdir(root)
+            with tarfile.open(fileobj=data, mode='r|') as archive:
+                tree.extract(archive, root)
+            self.assertEqual(
+                ['dir/nested.txt', 'good.txt'], tree.walk_files(root))
+            self.assertFalse(os.path.lexists(os.path.join(root, 'link')))
+            self.assertFalse(
+                os.path.exists(os.path.join(directory, 'evil.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
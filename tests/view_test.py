@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Tests for sshed.view"""
+
+import io
+import unittest
+from unittest import mock
+
+from sshed import view
+
+DATA = b''.join(b'line %02d\n' % number for number in range(40))
+
+
+class TestSparseIndex(unittest.TestCase):
+    """Tests for sparse_index."""
+
+    def testLineAligned(self):
+        """Each offset is the start of the first line in its block."""
+        index = view.sparse_index(io.BytesIO(DATA), len(DATA), block_size=20)
+        self.assertEqual(0, index[0])
+        for offset in index[1:]:
+            self.assertEqual(b'\n', DATA[offset - 1:offset])
+        self.assertEqual([0, 24, 40, 64], index[:4])
+
+    def testLongLines(self):
+        """Blocks without a line starting in them are merged."""
+        data = b'a' * 50 + b'\n' + b'b' * 10 + b'\n'
+        self.assertEqual(
+            [0, 51], view.sparse_index(io.BytesIO(data), len(data), 20))
+
+
+class TestWriteExcerpt(unittest.TestCase):
+    """Tests for write_excerpt."""
+
+    def setUp(self):
+        self.fetches = []
+        self.index = view.sparse_index(
+            io.BytesIO(DATA), len(DATA), block_size=16)
+
+    def fetch(self, offset, length):
+        """Record a fetch and return the range of DATA."""
+        self.fetches.append((offset, length))
+        return DATA[offset:offset + length]
+
+    def excerpt(self, limit, offset=None):
+        """Return the excerpt of DATA within limit and the bytes omitted."""
+        output = io.BytesIO()
+        omitted = view.write_excerpt(
+            output, len(DATA), self.index, self.fetch, limit=limit,
+            offset=offset)
+        return output.getvalue(), omitted
+
+    @mock.patch.object(view, 'FETCH_BLOCKS', 2)
+    def testWhole(self):
+        """A file within the limit is fetched whole, in a few requests."""
+        self.assertEqual((DATA, 0), self.excerpt(len(DATA)))
+        self.assertEqual(
+            (len(self.index) + 1) // 2, len(self.fetches))
+
+    def testStartAndEnd(self):
+        """A larger file is shown as its start and end, whole lines only."""
+        text, omitted = self.excerpt(128)
+        head, marker, tail = text.partition(view.OMITTED % omitted)
+        self.assertTrue(marker)
+        self.assertTrue(DATA.startswith(head))
+        self.assertTrue(DATA.endswith(tail))
+        self.assertTrue(head.endswith(b'\n'))
+        self.assertEqual(len(DATA), len(head) + omitted + len(tail))
+        self.assertLessEqual(len(head) + len(tail), 128)
+        self.assertNotIn(b'\0', text)
+
+    def testTinyLimit(self):
+        """The first and last blocks are shown however small the limit."""
+        text, omitted = self.excerpt(1)
+        bounds = self.index + [len(DATA)]
+        self.assertEqual(
+            DATA[:bounds[1]] + view.OMITTED % omitted + DATA[bounds[-2]:],
+            text)
+
+
+    def testOffset(self):
+        """Given an offset, the part around it is shown, whole lines only."""
+        text, omitted = self.excerpt(64, offset=DATA.index(b'line 20\n'))
+        bounds = self.index + [len(DATA)]
+        [(first, stop)] = view.excerpt_blocks(
+            bounds, 64, offset=DATA.index(b'line 20\n'))
+        shown = DATA[bounds[first]:bounds[stop]]
+        self.assertIn(b'line 20\n', shown)
+        self.assertLessEqual(len(shown), 64)
+        self.assertEqual(
+            view.OMITTED % bounds[first] + shown +
+            view.OMITTED % (len(DATA) - bounds[stop]), text)
+        self.assertEqual(len(DATA) - len(shown), omitted)
+
+    def testOffsetAtEnd(self):
+        """An offset past the end shows the end of the file."""
+        text, omitted = self.excerpt(64, offset=len(DATA) * 2)
+        marker = view.OMITTED % omitted
+        self.assertTrue(text.startswith(marker))
+        self.assertTrue(DATA.endswith(text[len(marker):]))
+
+    def testOneBlock(self):
+        """A file of one block larger than the limit is shown whole."""
+        data = b'x' * 100 + b'\n'
+        output = io.BytesIO()
+        self.assertEqual(0, view.write_excerpt(
+            output, len(data), [0], lambda offset, length: data, limit=10))
+        self.assertEqual(data, output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Tests for sshed.watch"""
+
+import os
+import socket
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import watch
+
+
+class TestFollower(unittest.TestCase):
+    """Tests for Follower."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'log')
+        self.append(b'first\n')
+        self.follower = watch.Follower(self.path, open(self.path, 'rb'), 6)
+
+    def tearDown(self):
+        self.follower.close()
+        self.directory.cleanup()
+
+    def append(self, data, path=None):
+        """Append data to the followed file (or another)."""
+        with open(path or self.path, 'ab') as file:
+            file.write(data)
+
+    def testNoChange(self):
+        self.assertIsNone(self.follower.poll(100))
+
+    def testAppended(self):
+        """Appends are returned in pieces of at most limit bytes."""
+        self.append(b'second\n')
+        self.assertEqual(
+            watch.Change(watch.APPENDED, 6, b'seco'), self.follower.poll(4))
+        self.assertEqual(
+            watch.Change(watch.APPENDED, 10, b'nd\n'), self.follower.poll(4))
+        self.assertIsNone(self.follower.poll(4))
+
+    def testTruncated(self):
+        """After truncation, the file is followed from its start."""
+        with open(self.path, 'wb'):
+            pass
+        self.assertEqual(watch.TRUNCATED, self.follower.poll(100).kind)
+        self.append(b'new\n')
+        self.assertEqual(
+            watch.Change(watch.APPENDED, 0, b'new\n'), self.follower.poll(100))
+
+    def testRotated(self):
+        """The rest of a rotated file is returned before the new file."""
+        self.append(b'last\n')
+        os.rename(self.path, self.path + '.1')
+        self.append(b'new\n')
+        self.assertEqual(
+            watch.Change(watch.APPENDED, 6, b'last\n'),
+            self.follower.poll(100))
+        self.assertEqual(watch.ROTATED, self.follower.poll(100).kind)
+        self.assertEqual(
+            watch.Change(watch.APPENDED, 0, b'new\n'), self.follower.poll(100))
+
+
+class TestWatcher(unittest.TestCase):
+    """Tests for Watcher."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'log')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def testReadableFile(self):
+        """Return the files passed that are readable."""
+        near, far = socket.socketpair()
+        watcher = watch.Watcher(self.path)
+        try:
+            self.assertEqual([], watcher.wait(0, [near]))
+            far.sendall(b'x')
+            self.assertEqual([near], watcher.wait(1, [near]))
+        finally:
+            watcher.close()
+            near.close()
+            far.close()
+
+    @mock.patch.object(watch, '_INOTIFY', None)
+    def testPolling(self):
+        """Without inotify, waits last at most the poll interval."""
+        watcher = watch.Watcher(self.path, poll_interval=0)
+        self.assertIsNone(watcher.descriptor)
+        self.assertEqual([], watcher.wait(60))
+
+
+if __name__ == '__main__':
+    unittest.main()
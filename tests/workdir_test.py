@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Tests for sshed.workdir"""
+
+import errno
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from sshed import workdir
+
+MOUNTS = """\
+/dev/sda1 / ext4 rw,relatime 0 0
+tmpfs /dev/shm tmpfs rw,nosuid,nodev 0 0
+tmpfs /run/user/1000 tmpfs rw,nosuid,nodev,mode=700 0 0
+/dev/sdb1 /mnt/my\\040disk ext4 rw 0 0
+"""
+
+
+class TestFilesystemType(unittest.TestCase):
+    """Tests for filesystem_type."""
+
+    def setUp(self):
+        file = tempfile.NamedTemporaryFile('w', delete=False)
+        self.addCleanup(os.remove, file.name)
+        with file:
+            file.write(MOUNTS)
+        self.mounts = file.name
+
+    def testLongestMatch(self):
+        """The deepest mount point holding the path decides."""
+        with mock.patch('os.path.realpath', side_effect=lambda path: path):
+            self.assertEqual('tmpfs', workdir.filesystem_type(
+                '/dev/shm/x', mounts=self.mounts))
+            self.assertEqual('tmpfs', workdir.filesystem_type(
+                '/run/user/1000', mounts=self.mounts))
+            self.assertEqual('ext4', workdir.filesystem_type(
+                '/dev/shmem', mounts=self.mounts))
+            self.assertEqual('ext4', workdir.filesystem_type(
+                '/mnt/my disk/file', mounts=self.mounts))
+
+    def testNoMounts(self):
+        """Without a list of mounts, the type is unknown."""
+        self.assertIsNone(workdir.filesystem_type(
+            '/', mounts=self.mounts + '.missing'))
+
+
+class TestWorkingDirectories(unittest.TestCase):
+    """Tests for WorkingDirectories."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.candidate = directory.name
+
+    @mock.patch('sshed.workdir.usable', return_value=True)
+    def testRam(self, _):
+        """Small files go in a private directory, removed on cleanup."""
+        directories = workdir.WorkingDirectories(
+            size_limit=100, candidates=[self.candidate])
+        ram = directories.ram
+        self.assertEqual(self.candidate, os.path.dirname(ram))
+        self.assertEqual(
+            stat.S_IRWXU, stat.S_IMODE(os.stat(ram).st_mode))
+        self.assertEqual(ram, directories.directory_for(100))
+        self.assertIsNone(directories.directory_for(101))
+        self.assertTrue(directories.holds(os.path.join(ram, 'file')))
+        self.assertFalse(
+            directories.holds(os.path.join(self.candidate, 'file')))
+        directories.cleanup()
+        self.assertFalse(directories.holds(os.path.join(ram, 'file')))
+        self.assertFalse(os.path.exists(ram))
+        self.assertIsNone(directories.directory_for(1))
+
+    @mock.patch('os.statvfs')
+    @mock.patch('sshed.workdir.usable', return_value=True)
+    def testFull(self, _, statvfs):
+        """Files go on disk when the RAM filesystem is short of space."""
+        statvfs.return_value = mock.Mock(f_bavail=1, f_frsize=100)
+        directories = workdir.WorkingDirectories(
+            size_limit=100, candidates=[self.candidate])
+        self.addCleanup(directories.cleanup)
+        self.assertIsNotNone(directories.directory_for(50))
+        self.assertIsNone(directories.directory_for(51))
+
+    @mock.patch('sshed.workdir.usable', return_value=False)
+    def testNoRam(self, _):
+        """Without a usable candidate, every file goes on disk."""
+        directories = workdir.WorkingDirectories(candidates=[self.candidate])
+        self.assertIsNone(directories.ram)
+        self.assertIsNone(directories.directory_for(1))
+
+    def testDisabled(self):
+        """A size limit of 0 keeps every file on disk."""
+        directories = workdir.WorkingDirectories(
+            size_limit=0, candidates=[self.candidate])
+        self.assertIsNone(directories.ram)
+        self.assertEqual([], os.listdir(self.candidate))
+
+    def testUsable(self):
+        """A directory on disk isn't used."""
+        with mock.patch(
+                'sshed.workdir.filesystem_type', return_value='ext4'):
+            self.assertFalse(workdir.usable(self.candidate))
+        with mock.patch(
+                'sshed.workdir.filesystem_type', return_value='tmpfs'):
+            self.assertTrue(workdir.usable(self.candidate))
+            self.assertFalse(workdir.usable(self.candidate + '/missing'))
+
+
+class TestWorkingCopy(unittest.TestCase):
+    """Tests for WorkingCopy, clone and snapshot."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='workdir-')
+        self.addCleanup(os.rmdir, self.directory)
+        self.working = workdir.WorkingCopy('file', directory=self.directory)
+        self.addCleanup(self.working.close)
+
+    def testManifest(self):
+        """Sequential writes are hashed as they're made."""
+        self.working.write(b'0' * 100000)
+        self.working.write(b'1' * 100000)
+        with mock.patch('sshed.manifest.BlockManifest.from_file') as scan:
+            block_manifest = self.working.manifest()
+        scan.assert_not_called()
+        self.assertEqual(200000, block_manifest.size)
+        with open(self.working.name, 'rb') as file:
+            self.assertTrue(block_manifest.matches(
+                *block_manifest.scan(file)))
+
+    def testOutOfOrder(self):
+        """The file is read back if it wasn't written from start to end."""
+        self.working.write(b'0123')
+        self.working.seek(0)
+        self.working.write(b'x')
+        block_manifest = self.working.manifest()
+        with open(self.working.name, 'rb') as file:
+            self.assertTrue(block_manifest.matches(
+                *block_manifest.scan(file)))
+
+    def testClose(self):
+        """Releasing the file leaves it for the editor; closing removes it."""
+        self.working.write(b'data')
+        self.working.release()
+        self.assertTrue(os.path.exists(self.working.name))
+        self.working.close()
+        self.assertFalse(os.path.exists(self.working.name))
+
+    def testSnapshot(self):
+        """A snapshot copies the file and is unaffected by later changes."""
+        self.working.write(b'data')
+        self.working.flush()
+        copy = workdir.snapshot(self.working.file)
+        if copy is None:
+            self.skipTest('The kernel cannot copy files here.')
+        with copy:
+            with open(self.working.name, 'wb') as file:
+                file.write(b'changed')
+            self.assertEqual(b'data', copy.read())
+
+    def testCannotClone(self):
+        """snapshot returns None where the kernel can't copy the file."""
+        self.working.write(b'data')
+        self.working.flush()
+        error = OSError(errno.EXDEV, 'Invalid cross-device link')
+        with mock.patch('fcntl.ioctl', side_effect=error), mock.patch(
+                'os.copy_file_range', side_effect=error, create=True):
+            self.assertIsNone(workdir.snapshot(self.working.file))
+
+
+if __name__ == '__main__':
+    unittest.main()